@@ -0,0 +1,63 @@
+import pandas as pd
+import streamlit as st
+
+from src.metrics.confusion_matrix import load_error_matrices
+from src.utils.operations.cache_operations import files_signature
+from src.utils.operations.file_operations import load_config_file
+from src.utils.operations.file_operations import read_datasets_from_dict
+from src.utils.operations.volume_cache_operations import configure_volume_cache
+
+# Load configuration file
+config = load_config_file("./src/configs/app.yml")
+max_cached_tables = config.get("cache_max_entries", 16)
+configure_volume_cache(config.get("volume_cache_path"), config.get("volume_cache_max_gb", 20))
+
+
+@st.cache_data(max_entries=max_cached_tables, show_spinner=False)
+def _read_datasets(name_path_dict: dict, col_name: str, columns: list, signature: list) -> pd.DataFrame:
+    # the signature is only part of the cache key: any change in the size or modification time of the files
+    # produces a new key, so stale tables are never served
+    return read_datasets_from_dict(name_path_dict, col_name=col_name, columns=columns)
+
+
+def load_datasets(name_path_dict: dict, col_name: str = "set", columns: list = None) -> pd.DataFrame:
+    """
+    Memoized version of `read_datasets_from_dict` shared by all the pages and sessions of the app, so widget
+    interactions do not read the files again.
+
+    Entries are invalidated as soon as any of the files changes on disk and the least recently used ones are evicted
+    once `cache_max_entries` (app config) tables are cached.
+
+    Args:
+        name_path_dict: A dictionary where keys are dataset names and values are file paths to CSV or Parquet files.
+        col_name: The name of the column to add that will contain the dataset name. Defaults to "set".
+        columns: Optional list of columns to load from each file. Defaults to all of them.
+
+    Returns:
+        pd.DataFrame: A concatenated DataFrame containing all the datasets. Each call returns its own copy, so pages
+                      can modify it freely.
+    """
+    signature = files_signature(list(name_path_dict.values()))
+
+    return _read_datasets(name_path_dict, col_name, columns, signature)
+
+
+@st.cache_data(max_entries=max_cached_tables, show_spinner=False)
+def _read_error_matrices(path: str, signature: list):
+    return load_error_matrices(path)
+
+
+def load_error_matrices_store(path: str):
+    """
+    Memoized version of `load_error_matrices`, invalidated as soon as the file changes on disk.
+
+    Args:
+        path: Path of the .npz file written by the metric extractor. If None, an empty store is returned.
+
+    Returns:
+        tuple: The label values and the (signature, matrix) tuples per model and subject.
+    """
+    if not path:
+        return [], {}
+
+    return _read_error_matrices(path, files_signature([path]))
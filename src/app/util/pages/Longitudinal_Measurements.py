@@ -3,7 +3,7 @@ import streamlit as st
 
 from src.app.util.constants.descriptions import LongitudinalAnalysisPage
 from src.utils.operations.file_operations import load_config_file
-from src.utils.operations.file_operations import read_datasets_from_dict
+from src.app.util.commons.data_loader import load_datasets
 from src.app.util.commons.data_preprocessing import processing_data
 from src.app.util.commons.sidebars import setup_sidebar_single_dataset
 from src.app.util.commons.sidebars import setup_sidebar_single_model
@@ -68,9 +68,9 @@ def longitudinal():
     st.header(const.header)
     st.markdown(const.sub_header)
 
-    # Reading feature data
-    features_df = read_datasets_from_dict(features_paths)
-    metrics_df = read_datasets_from_dict(metrics_paths)
+    # Reading feature data (only the columns plotted)
+    features_df = load_datasets(features_paths, columns=["ID", "longitudinal_id", "time_point", "lesion_size"])
+    metrics_df = load_datasets(metrics_paths, columns=["ID", "model", "SIZE"])
     merged = merge_features_metrics(features_df, metrics_df)
 
     # Sidebar setup
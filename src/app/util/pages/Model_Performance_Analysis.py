@@ -13,7 +13,7 @@ from src.app.util.commons.sidebars import setup_aggregation_button
 from src.app.util.commons.sidebars import setup_sidebar_regions
 from src.app.util.constants.descriptions import ModelPerformanceAnalysisPage
 from src.utils.operations.file_operations import load_config_file
-from src.utils.operations.file_operations import read_datasets_from_dict
+from src.app.util.commons.data_loader import load_datasets
 from src.utils.operations.misc_operations import pretty_string
 from src.visualization.scatter_plots import multivariate_metric_feature
 from src.app.util.commons.checks import dataset_sanity_check
@@ -127,8 +127,8 @@ def performance():
     st.markdown(const_descriptions.sub_header)
 
     # Load the data
-    features_df = read_datasets_from_dict(features_paths)
-    metrics_df = read_datasets_from_dict(metrics_paths)
+    features_df = load_datasets(features_paths)
+    metrics_df = load_datasets(metrics_paths)
     agg = setup_aggregation_button()
     st.markdown("**Double click on a point to highlight it in red and then visualize it disaggregated.**")
     merged_data = merge_features_and_metrics(features=features_df, metrics=metrics_df, aggregate=agg)
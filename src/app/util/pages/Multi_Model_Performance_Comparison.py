@@ -8,7 +8,7 @@ from src.app.util.commons.sidebars import setup_sidebar_multi_model
 from src.app.util.commons.sidebars import setup_sidebar_regions
 from src.app.util.commons.sidebars import setup_sidebar_multi_metrics
 from src.app.util.commons.sidebars import setup_aggregation_button
-from src.utils.operations.file_operations import read_datasets_from_dict
+from src.app.util.commons.data_loader import load_datasets
 
 from src.visualization.boxplot import models_performance_boxplot
 from src.app.util.commons.data_preprocessing import processing_data
@@ -75,7 +75,7 @@ def multi_model():
     st.markdown(const_descriptions.sub_header)
 
     # Load the data
-    raw_metrics = read_datasets_from_dict(metrics_paths)
+    raw_metrics = load_datasets(metrics_paths)
     agg = setup_aggregation_button()
 
     # calling main function
@@ -10,7 +10,7 @@ from src.app.util.commons.checks import health_checks
 from src.app.util.constants.descriptions import MultivariatePage
 from src.app.util.constants.features import Features
 from src.utils.operations.file_operations import load_config_file
-from src.utils.operations.file_operations import read_datasets_from_dict
+from src.app.util.commons.data_loader import load_datasets
 from src.utils.operations.itk_operations import run_itk_snap
 from src.visualization.scatter_plots import multivariate_features_highlighter
 
@@ -76,7 +76,7 @@ def multivariate():
     st.markdown(const_descriptions.sub_header)
 
     # Load datasets
-    df = read_datasets_from_dict(features_information)
+    df = load_datasets(features_information)
 
     # Sidebar setup
     selected_sets, select_x_feature_name, select_y_feature_name, select_color_feature_name = setup_sidebar(df, features_information)
@@ -19,7 +19,7 @@ from src.metrics.statistical_tests import normality_test
 from src.metrics.statistical_tests import paired_ttest
 from src.metrics.statistical_tests import wilcoxon_test
 from src.utils.operations.file_operations import load_config_file
-from src.utils.operations.file_operations import read_datasets_from_dict
+from src.app.util.commons.data_loader import load_datasets
 from src.visualization.barplots import aggregated_pairwise_model_performance
 from src.visualization.barplots import individual_pairwise_model_performance
 from src.visualization.histograms import plot_histogram
@@ -184,8 +184,8 @@ def pairwise_comparison():
     agg = setup_aggregation_button()
 
     # Load datasets
-    raw_metrics = read_datasets_from_dict(metrics_paths)
-    raw_features = read_datasets_from_dict(features_paths)
+    raw_metrics = load_datasets(metrics_paths)
+    raw_features = load_datasets(features_paths)
     df_stats = raw_metrics.drop(columns="region").groupby(["ID", "model", "set"]).mean().reset_index()
 
     # Setup sidebar
@@ -1,17 +1,23 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import numpy as np
 import streamlit as st
 from stqdm import stqdm
 
+from src.app.util.commons.data_loader import load_error_matrices_store
 from src.app.util.constants.descriptions import SegmentationErrorMatrixPage
 from src.metrics.confusion_matrix import mistakes_per_class_optim
 from src.metrics.confusion_matrix import normalize_matrix_per_row
+from src.metrics.confusion_matrix import reorder_matrix
+from src.metrics.confusion_matrix import sources_signature
 from src.utils.operations.file_operations import load_config_file
 from src.utils.operations.itk_operations import run_comparison_segmentation_itk_snap
 from src.utils.operations.misc_operations import capitalizer
 from src.utils.operations.misc_operations import pretty_string
 from src.utils.operations.misc_operations import snake_case
+from src.utils.operations.parallel_operations import resolve_n_workers
 from src.utils.sequences import load_nii_by_id
 from src.visualization.confusion_matrices import plt_confusion_matrix_plotly
 from src.visualization.sequences import plot_seq
@@ -24,6 +30,8 @@ classes = list(labels_dict.keys())
 labels = list(labels_dict.values())
 datasets = list(config.get("predictions", {}).keys())
 raw_datasets = config.get("raw_datasets", {})
+error_matrices_paths = config.get("error_matrices", {})
+n_workers = resolve_n_workers(config.get("error_matrix_workers", 4))
 
 
 def setup_sidebar(config, datasets):
@@ -112,9 +120,35 @@ def compute_and_display_cm(seg, pred, labels, classes, normalized):
     visualize_confusion_matrix(cm, classes, normalized)
 
 
+@lru_cache(maxsize=4096)
+def subject_error_matrix(root_gt, root_pred, patient_id, labels, signature):
+    """
+    Compute the error matrix of a single patient from its files. Results are memoized per (dataset, model, patient),
+    so toggling the page options does not read the segmentations again.
+
+    Args:
+        root_gt (str): Path to the dataset containing the ground truth segmentations.
+        root_pred (str): Path to the predictions of the model.
+        patient_id (str): Patient ID.
+        labels (tuple): Label values.
+        signature (str): Signature of the source files. It is only part of the cache key, so modified files are
+                         computed again.
+
+    Returns:
+        np.array: Error matrix of the patient (read-only).
+    """
+    seg = load_nii_by_id(root=root_gt, patient_id=patient_id, seq="_seg", as_array=True)
+    pred = load_nii_by_id(root=root_pred, patient_id=patient_id, seq="_pred", as_array=True)
+    cm = mistakes_per_class_optim(seg, pred, list(labels))
+    cm.setflags(write=False)
+    return cm
+
+
 def compute_accumulated_cm(patients_in_path, selected_dataset, models, selected_model, labels):
     """
-    Compute the accumulated confusion matrix over all patients.
+    Compute the accumulated confusion matrix over all patients. Matrices precomputed by the metric extractor are reused
+    and only the patients missing from the store, or whose segmentations changed, are computed from their files, in
+    a pool of threads (reading the files releases the GIL).
 
     Args:
         patients_in_path (list): List of patient paths.
@@ -126,14 +160,24 @@ def compute_accumulated_cm(patients_in_path, selected_dataset, models, selected_
     Returns:
         np.array: Accumulated confusion matrix.
     """
-    accumulated = None
-    for p in stqdm(patients_in_path, desc=f"Calculating confusion matrix for {len(patients_in_path)} patients"):
-        seg = load_nii_by_id(root=raw_datasets.get(selected_dataset, ""), patient_id=p, seq="_seg", as_array=True)
-        pred = load_nii_by_id(root=models[snake_case(selected_model)], patient_id=p, seq="_pred", as_array=True)
-        cm = mistakes_per_class_optim(seg, pred, list(labels))
-        if accumulated is None:
-            accumulated = np.zeros_like(cm)
-        accumulated += cm
+    root_gt, root_pred = raw_datasets.get(selected_dataset, ""), models[snake_case(selected_model)]
+    stored_labels, store = load_error_matrices_store(error_matrices_paths.get(selected_dataset))
+    stored = store.get(snake_case(selected_model), {})
+
+    def patient_cm(p):
+        signature = sources_signature([f"{root_gt}/{p}/{p}_seg.nii.gz", f"{root_pred}/{p}/{p}_pred.nii.gz"])
+        if p in stored and stored[p][0] == signature:
+            cm = reorder_matrix(stored[p][1], stored_labels, list(labels))
+            if cm is not None:
+                return cm
+        return subject_error_matrix(root_gt, root_pred, p, tuple(labels), signature)
+
+    accumulated = np.zeros((len(labels), len(labels)), dtype=np.int64)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        matrices = executor.map(patient_cm, patients_in_path)
+        for cm in stqdm(matrices, total=len(patients_in_path),
+                        desc=f"Calculating confusion matrix for {len(patients_in_path)} patients"):
+            accumulated += cm
     return accumulated
 
 
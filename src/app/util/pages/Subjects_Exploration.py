@@ -8,7 +8,7 @@ from src.app.util.commons.sidebars import setup_sidebar_single_dataset
 from src.app.util.commons.sidebars import setup_sidebar_single_subjects
 from src.app.util.commons.data_preprocessing import processing_data
 from src.utils.operations.file_operations import load_config_file
-from src.utils.operations.file_operations import read_datasets_from_dict
+from src.app.util.commons.data_loader import load_datasets
 from src.utils.operations.misc_operations import pretty_string
 from src.app.util.constants.features import Features
 
@@ -102,7 +102,7 @@ def subjects():
     st.markdown(const_descriptions.sub_header)
 
     # Load datasets
-    df = read_datasets_from_dict(features)
+    df = load_datasets(features)
 
     # Set up sidebar options
     selected_set, selected_subject = setup_sidebar(df)
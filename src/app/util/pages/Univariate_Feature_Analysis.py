@@ -11,7 +11,7 @@ from src.app.util.commons.sidebars import setup_histogram_options
 from src.app.util.commons.checks import health_checks
 from src.app.util.constants.descriptions import UnivariatePage
 from src.utils.operations.file_operations import load_config_file
-from src.utils.operations.file_operations import read_datasets_from_dict
+from src.app.util.commons.data_loader import load_datasets
 from src.utils.operations.itk_operations import run_itk_snap
 from src.visualization.boxplot import boxplot_highlighter
 from src.visualization.histograms import custom_distplot
@@ -117,7 +117,7 @@ def univariate():
     st.markdown(const_descriptions.sub_header)
 
     # Load datasets
-    df = read_datasets_from_dict(features_paths)
+    df = load_datasets(features_paths)
 
     # Set up sidebar and plot options
     selected_sets, selected_feature = setup_sidebar(df, features_paths)
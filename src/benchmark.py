@@ -0,0 +1,189 @@
+import argparse
+import sys
+from datetime import datetime
+from pprint import pformat
+
+import numpy as np
+from colorama import Fore
+from loguru import logger
+
+from src.features.spatial import SpatialFeatures
+from src.features.statistical import StatisticalFeatures
+from src.features.texture import TextureFeatures
+from src.features.tumor import TumorFeatures
+from src.metrics.confusion_matrix import mistakes_per_class_optim
+from src.metrics.custom_metrics import calculate_metrics
+from src.utils.operations.benchmark_operations import benchmark_metadata
+from src.utils.operations.benchmark_operations import check_sketches
+from src.utils.operations.benchmark_operations import compare_benchmarks
+from src.utils.operations.benchmark_operations import load_benchmark
+from src.utils.operations.benchmark_operations import prepare_synthetic_dataset
+from src.utils.operations.benchmark_operations import run_isolated
+from src.utils.operations.benchmark_operations import save_benchmark
+from src.utils.operations.benchmark_operations import summarize_benchmark
+from src.utils.operations.benchmark_operations import time_benchmark
+from src.utils.operations.file_operations import load_config_file
+from src.utils.operations.misc_operations import configure_logging
+from src.utils.operations.misc_operations import fancy_print
+from src.utils.operations.volume_cache_operations import configure_volume_cache
+from src.utils.sequences import get_spacing
+from src.utils.sequences import load_nii_with_metadata
+from src.utils.sequences import load_subject
+
+
+def build_benchmarks(config: dict) -> dict:
+    """
+    Defines the benchmarks: for each one, a function that reads the inputs of a subject (not timed) and a function
+    that performs the work being measured on them.
+
+    Args:
+        config: Config file 'benchmark.yml'.
+
+    Returns:
+        dict: A (setup, run) tuple per benchmark name.
+    """
+    path_images, path_predictions = f"{config['data_path']}/images", f"{config['data_path']}/predictions"
+    label_names, label_values = list(config["labels"].keys()), list(config["labels"].values())
+
+    def load_images(subject_id):
+        sequences, metadata = load_subject(path_images, subject_id)
+        return sequences, metadata
+
+    def load_segmentations(subject_id):
+        ground_truth, metadata = load_nii_with_metadata(f"{path_images}/{subject_id}/{subject_id}_seg.nii.gz")
+        prediction, _ = load_nii_with_metadata(f"{path_predictions}/{subject_id}/{subject_id}_pred.nii.gz")
+        return subject_id, ground_truth, prediction, get_spacing(metadata)
+
+    def load_tumor(subject_id):
+        sequences, metadata = load_subject(path_images, subject_id, sequences=("_t1ce", "_seg"))
+        brain = SpatialFeatures(sequences["t1ce"], get_spacing(metadata["t1ce"])).calculate_brain_center_mass()
+        return sequences["seg"], get_spacing(metadata["seg"]), brain.values()
+
+    benchmarks = {
+        "nifti_loading": (lambda subject_id: subject_id, lambda subject_id: load_subject(path_images, subject_id)),
+        "statistical": (load_images, lambda inputs: [
+            StatisticalFeatures(
+                seq[seq > 0], dtype=config.get("statistical_dtype"), overwrite_input=True
+            ).extract_features()
+            for key, seq in inputs[0].items() if key != "seg"
+        ]),
+        "texture": (load_images, lambda inputs: [
+            TextureFeatures(seq, remove_empty_planes=True, levels=config.get("texture_levels", 256)).extract_features()
+            for key, seq in inputs[0].items() if key != "seg"
+        ]),
+        "spatial": (load_images, lambda inputs: SpatialFeatures(
+            inputs[0]["t1ce"], get_spacing(inputs[1]["t1ce"])
+        ).extract_features()),
+        "tumor": (load_tumor, lambda inputs: TumorFeatures(
+            inputs[0], inputs[1], mapping_names=dict(zip(label_values, label_names))
+        ).extract_features(inputs[2])),
+        "error_matrix": (load_segmentations, lambda inputs: mistakes_per_class_optim(
+            inputs[1], inputs[2], label_values
+        )),
+    }
+    for metric in config.get("metrics", []):
+        benchmarks[f"metric_{metric}"] = (load_segmentations, lambda inputs, metric=metric: calculate_metrics(
+            inputs[1], inputs[2], inputs[0], list(label_names), [metric], spacing=inputs[3], labels=label_values
+        ))
+
+    return benchmarks
+
+
+def run_benchmark(name: str, config: dict, subjects: list) -> dict:
+    """
+    Times a single benchmark. It is meant to run in a fresh process (see `run_isolated`).
+
+    Args:
+        name: Name of the benchmark.
+        config: Config file 'benchmark.yml'.
+        subjects: IDs of the synthetic subjects.
+
+    Returns:
+        dict: The output of `time_benchmark`.
+    """
+    # the volume cache would hide the cost of decoding the NIfTI files
+    configure_volume_cache(None)
+    setup, run = build_benchmarks(config)[name]
+
+    return time_benchmark(setup, run, subjects, config["repetitions"])
+
+
+def selected_benchmarks(config: dict, only: list = None) -> list:
+    """Names of the benchmarks enabled in the config file, optionally restricted to the ones given in `only`."""
+    names = []
+    for name, enabled in config["benchmarks"].items():
+        if enabled:
+            names += [f"metric_{m}" for m in config.get("metrics", [])] if name == "metrics" else [name]
+
+    return [name for name in names if not only or name in only or name.split("_")[0] in only]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the feature and metric extraction on synthetic data")
+    parser.add_argument("--only", nargs="+", help="Benchmarks to run (e.g. statistical texture metric)")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    args = parser.parse_args()
+
+    logger.remove()
+    current_time = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+    configure_logging(log_filename=f"./logs/benchmark/{current_time}.log")
+    logger.info("Starting benchmark")
+
+    # config variables
+    config = load_config_file("./src/configs/benchmark.yml")
+    logger.info(f"Config file: \n{pformat(config)}")
+
+    # the merge invariants of the dataset-level sketches are checked first, and the run fails if any does not hold
+    if config.get("check_sketches", True):
+        fancy_print("Checking intensity sketches", Fore.LIGHTMAGENTA_EX, "\n✨")
+        checks = check_sketches(
+            config["sketch_size"], config["sketch_bin_width"], config["sketch_check_values"],
+            config["sketch_check_parts"], config["seed"]
+        )
+        for distribution, check, value, bound, passed in checks:
+            color, symbol = (Fore.GREEN, "✅") if passed else (Fore.RED, "❌")
+            fancy_print(f"{distribution:<10} {check:<20} {value:>12.6g} (expected {bound:.6g})", color, symbol)
+        failures = [entry for entry in checks if not entry[-1]]
+        if failures:
+            logger.error(f"{len(failures)} sketch checks failed: {failures}")
+            sys.exit(1)
+
+    fancy_print("Preparing synthetic dataset", Fore.LIGHTMAGENTA_EX, "\n✨")
+    subjects = prepare_synthetic_dataset(config)
+    voxels = int(np.prod(config["shape"]))
+
+    results = {"metadata": benchmark_metadata(config), "results": {}}
+    for name in selected_benchmarks(config, args.only):
+        summary = summarize_benchmark(run_isolated(run_benchmark, name, config, subjects), voxels)
+        results["results"][name] = summary
+        fancy_print(
+            f"{name:<20} {summary['latency_s']:>9.4f} s/subject  {summary['voxels_per_s'] or 0:>14,.0f} voxels/s  "
+            f"{summary['peak_rss_mb'] or float('nan'):>9.1f} MB peak RSS "
+            f"(+{summary['peak_rss_increase_mb'] or float('nan'):.1f} MB)",
+            Fore.CYAN, "🔹"
+        )
+        logger.info(f"Benchmark {name}: {summary}")
+
+    output_file = f"{config['output_path']}/benchmark_{current_time}.json"
+    save_benchmark(output_file, results)
+    logger.info(f"Results stored in {output_file}")
+
+    if args.save_baseline:
+        save_benchmark(config["baseline_path"], results)
+        fancy_print(f"Baseline stored in {config['baseline_path']}", Fore.LIGHTMAGENTA_EX, "✨")
+        sys.exit(0)
+
+    # compare against the baseline, failing if any benchmark regressed
+    baseline = load_benchmark(config["baseline_path"])
+    if baseline is None:
+        fancy_print("No baseline found. Run with --save-baseline to create it", Fore.YELLOW, "🔸")
+        sys.exit(0)
+
+    comparison = compare_benchmarks(results, baseline, config.get("regression_threshold", 0.2))
+    for name, measure, reference, current, ratio, regression in comparison:
+        color, symbol = (Fore.RED, "❌") if regression else (Fore.GREEN, "✅")
+        fancy_print(f"{name:<20} {measure:<22} {reference:>10.4f} -> {current:>10.4f} ({ratio:.2f}x)", color, symbol)
+    regressions = [entry for entry in comparison if entry[-1]]
+    if regressions:
+        logger.warning(f"{len(regressions)} regressions found against {config['baseline_path']}")
+        sys.exit(1)
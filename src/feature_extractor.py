@@ -1,3 +1,4 @@
+import argparse
 from pathlib import Path
 from datetime import datetime
 from pprint import pformat
@@ -6,11 +7,20 @@ from loguru import logger
 
 from src.features.main import extract_features
 from src.utils.operations.file_operations import load_config_file
+from src.utils.operations.file_operations import export_table
+from src.utils.operations.file_operations import remove_streamed_table
 from src.utils.operations.misc_operations import fancy_print
 from src.utils.operations.misc_operations import configure_logging
+from src.utils.operations.volume_cache_operations import configure_volume_cache
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract features from all the datasets defined in the config file")
+    parser.add_argument(
+        "--resume", action="store_true", help="Reuse the cached features of the subjects already processed"
+    )
+    args = parser.parse_args()
+
     logger.remove()
     current_time = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
     configure_logging(log_filename=f"./logs/feature_extraction/{current_time}.log")
@@ -20,18 +30,40 @@ if __name__ == "__main__":
     config = load_config_file("./src/configs/feature_extractor.yml")
     data_paths = config["data_paths"]
     output_path = config["output_path"]
+    if args.resume:
+        if not config.get("cache_path"):
+            logger.warning("--resume has no effect because 'cache_path' is not defined in the config file")
+        config["incremental"] = True
     Path(output_path).mkdir(parents=True, exist_ok=True)
     logger.info(f"Config file: \n{pformat(config)}")
+    configure_volume_cache(config.get("volume_cache_path"), config.get("volume_cache_max_gb", 20))
 
     # iterate over all paths
     for dataset_name, src_path in data_paths.items():
         fancy_print(f"Starting feature extraction for {dataset_name}", Fore.LIGHTMAGENTA_EX, "\n✨")
         logger.info(f"Starting feature extraction for {dataset_name}")
 
-        # features extraction
-        extracted_feats = extract_features(path_images=src_path, config_file=config, dataset_name=dataset_name)
+        # features extraction, streaming the partial results while it runs
+        stream_path = None
+        if config.get("stream_results", False):
+            stream_format = config.get("stream_format", "csv")
+            stream_path = f"{output_path}/extracted_information_{dataset_name}.partial.{stream_format}"
+        sketches_path = None
+        if config.get("intensity_sketches", False):
+            sketches_path = f"{output_path}/intensity_sketches_{dataset_name}.json"
+        extracted_feats = extract_features(
+            path_images=src_path, config_file=config, dataset_name=dataset_name, stream_path=stream_path,
+            sketches_path=sketches_path
+        )
         logger.info(f"Finishing feature extraction for {dataset_name}")
 
         # TODO: Should it have nan values or they must be 0? When NAN value, they do not appear in plots.
-        extracted_feats.to_csv(f"{output_path}/extracted_information_{dataset_name}.csv", index=False)
-        logger.info(f"Results exported to CSV for {dataset_name}")
+        output_format = config.get("output_format", "csv")
+        export_table(
+            extracted_feats, f"{output_path}/extracted_information_{dataset_name}.{output_format}", output_format
+        )
+        logger.info(f"Results exported to {output_format.upper()} for {dataset_name}")
+
+        # the partial results are superseded by the final output
+        if stream_path:
+            remove_streamed_table(stream_path)
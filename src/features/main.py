@@ -1,101 +1,366 @@
+import os
+from functools import partial
+
+import numpy as np
 import pandas as pd
 from colorama import Fore
 from loguru import logger
 
+from src.features.sketches import IntensitySketch
+from src.features.sketches import merge_intensity_sketches
+from src.features.sketches import save_intensity_sketches
 from src.features.spatial import SpatialFeatures
 from src.features.texture import TextureFeatures
 from src.features.statistical import StatisticalFeatures
+from src.features.statistical import StatisticsAccumulator
+from src.features.tumor import LabelMarginalsAccumulator
 from src.features.tumor import TumorFeatures
+from src.utils.operations.cache_operations import cache_key
+from src.utils.operations.cache_operations import config_signature
+from src.utils.operations.cache_operations import files_signature
+from src.utils.operations.cache_operations import load_cached_result
+from src.utils.operations.cache_operations import store_cached_result
 from src.utils.operations.file_operations import ls_dirs
+from src.utils.operations.file_operations import ls_files
+from src.utils.operations.file_operations import StreamingTableWriter
 from src.utils.operations.misc_operations import fancy_print
 from src.utils.operations.misc_operations import fancy_tqdm
+from src.utils.operations.parallel_operations import map_subjects
+from src.utils.sequences import crop_to_bounding_box
+from src.utils.sequences import get_axis_marginals
+from src.utils.sequences import get_bounding_box
 from src.utils.sequences import get_spacing
-from src.utils.sequences import load_nii_by_id
-from src.utils.sequences import read_sequences_dict
+from src.utils.sequences import iter_slabs
+from src.utils.sequences import load_nii_with_metadata
+from src.utils.sequences import load_subject
+from src.utils.sequences import offset_slab_marginals
+from src.utils.sequences import read_image_information
+
+# config keys that do not change the features of a subject, so they must not invalidate its cache entry. slab_size is
+# not one of them: the percentiles of float scans are estimated in slab mode, and they depend on the slab boundaries
+CACHE_IGNORED_KEYS = (
+    "data_paths", "output_path", "n_workers", "cache_path", "incremental", "longitudinal", "volume_cache_path",
+    "volume_cache_max_gb", "prefetch_subjects", "stream_results", "stream_format", "stream_batch_size", "output_format"
+)
 
 
 @logger.catch
-def extract_features(path_images: str, config_file: dict, dataset_name: str) -> pd.DataFrame:
+def extract_features(
+    path_images: str, config_file: dict, dataset_name: str, stream_path: str = None, sketches_path: str = None
+) -> pd.DataFrame:
     """
     Extracts features from all the MRIs located in the specified directory and compiles them into a DataFrame.
 
+    Subjects can be spread across a process pool by setting `n_workers` in the config file. Workers only send back the
+    per-subject feature dictionaries, and the output keeps the order of the subjects in the directory. A subject that
+    fails is logged and skipped without aborting the whole run.
+
+    When `cache_path` is set, the features of each subject are cached on disk, keyed by its files (path, size and
+    modification time) and by the feature configuration. If `incremental` is enabled, only new or modified subjects are
+    computed and the rest are taken from the cache, which also allows resuming an interrupted run.
+
     Args:
         path_images (str): The path to the directory containing patient image data.
         config_file (str): Config file 'feature_extractor.yml'
         dataset_name (str): Name of dataset being processed
+        stream_path (str): If given, the row of each subject is appended to this table as soon as it is available
+                           (see `StreamingTableWriter`), so partial results are usable during long runs.
+        sketches_path (str): If given (and `intensity_sketches` is enabled), the intensity sketches of all the subjects
+                             are merged into dataset-level distributions per sequence and stored in this JSON file
+                             (see `save_intensity_sketches`).
 
     Returns:
         pd.DataFrame: A DataFrame containing extracted features for each patient, including spatial, tumor, and
                       statistical features.
     """
     # get configuration
-    label_names, numeric_label = list(config_file["labels"].keys()), list(config_file["labels"].values())
-    features_to_extract = [key for key, value in config_file["features"].items() if value]
-    spatial_features, tumor_features, stats_features, texture_feats = {}, {}, {}, {}
     patients_list = ls_dirs(path_images)
-
-    # loop over all the elements in the root folder
-    data = pd.DataFrame()
-
-    with fancy_tqdm(total=len(patients_list), desc=f"{Fore.CYAN}Progress", leave=True) as pbar:
-        for n, subject_id in enumerate(patients_list):
-            logger.info(f"Processing subject: {subject_id}")
-
+    n_workers = config_file.get("n_workers", 1)
+    cache_dir = os.path.join(config_file["cache_path"], dataset_name) if config_file.get("cache_path") else None
+
+    # reuse the features of the subjects that did not change since the last run
+    extracted, keys = {}, {}
+    if cache_dir:
+        config_key = config_signature(config_file, ignore_keys=CACHE_IGNORED_KEYS)
+        for subject_id in patients_list:
+            subject_files = [os.path.join(path_images, subject_id, f) for f in ls_files(f"{path_images}/{subject_id}")]
+            keys[subject_id] = cache_key(files_signature(subject_files), config_key)
+            if config_file.get("incremental", False):
+                extracted[subject_id] = load_cached_result(cache_dir, subject_id, keys[subject_id])
+    pending = [subject_id for subject_id in patients_list if extracted.get(subject_id) is None]
+    if len(pending) < len(patients_list):
+        logger.info(f"Reusing cached features for {len(patients_list) - len(pending)} subjects")
+        fancy_print(f"Reusing cached features for {len(patients_list) - len(pending)} patients", Fore.CYAN, "🔹")
+
+    # stream the rows to disk as they are produced, starting with the ones taken from the cache
+    writer = None
+    if stream_path:
+        writer = StreamingTableWriter(
+            stream_path, config_file.get("stream_format", "csv"), config_file.get("stream_batch_size", 10)
+        )
+        for subject_id in patients_list:
+            if extracted.get(subject_id) is not None:
+                writer.write([store_subject_information(subject_id, **extracted[subject_id])])
+
+    # loop over all the elements in the root folder. Subjects read slab by slab are not prefetched, since that would
+    # bring their whole volumes into memory
+    slab_mode = bool(config_file.get("slab_size"))
+    with fancy_tqdm(total=len(pending), desc=f"{Fore.CYAN}Progress", leave=True) as pbar:
+        subjects = map_subjects(
+            extract_subject_features,
+            pending,
+            n_workers,
+            loader=None if slab_mode else partial(load_subject, path_images),
+            n_prefetch=config_file.get("prefetch_subjects", 2),
+            path_images=path_images,
+            config_file=config_file
+        )
+        for n, (subject_id, subject_features) in enumerate(subjects):
             # updating progress bar
             pbar.set_postfix_str(f"{Fore.CYAN}Current patient: {Fore.LIGHTBLUE_EX}{subject_id}{Fore.CYAN}")
             pbar.update(1)
             if n % 10 == 0 and n > 0:  # Every 10 patients
                 fancy_print(f"Processed {n} patients", Fore.CYAN, "🔹")
 
-            # read sequences and segmentation
-            sequences = read_sequences_dict(root=path_images, patient_id=subject_id)
-            seg = load_nii_by_id(root=path_images, patient_id=subject_id, as_array=True)
+            extracted[subject_id] = subject_features
+            if cache_dir and subject_features is not None:
+                store_cached_result(cache_dir, subject_id, keys[subject_id], subject_features)
+            if writer and subject_features is not None:
+                writer.write([store_subject_information(subject_id, **subject_features)])
+
+    if writer:
+        writer.close()
+
+    # Add info to the main df keeping the order of the subjects. Rows are buffered and the DataFrame is built once
+    rows = [
+        store_subject_information(subject_id, **extracted[subject_id])
+        for subject_id in patients_list
+        if extracted.get(subject_id) is not None
+    ]
+    data = pd.DataFrame(rows)
+
+    # dataset-level intensity distributions, merged in the order of the subjects so they are reproducible
+    if sketches_path and config_file.get("intensity_sketches", False):
+        sketches = merge_intensity_sketches([
+            extracted[subject_id].get("intensity_sketches")
+            for subject_id in patients_list
+            if extracted.get(subject_id) is not None
+        ])
+        save_intensity_sketches(sketches_path, sketches)
+        logger.info(f"Intensity sketches stored in {sketches_path}")
+
+    data = extract_longitudinal_info(config_file, data, dataset_name)
+
+    return data
+
+
+def extract_subject_features(subject_id: str, path_images: str, config_file: dict, preloaded: tuple = None) -> dict:
+    """
+    Extracts all the features selected in the config file for a single subject.
+
+    Args:
+        subject_id (str): The ID of the patient.
+        path_images (str): The path to the directory containing patient image data.
+        config_file (dict): Config file 'feature_extractor.yml'
+        preloaded (tuple): Sequences and metadata of the subject already read by `load_subject`. They are read from
+                           disk if not given.
+
+    Returns:
+        dict: A dictionary with the spatial, tumor, statistical and texture features of the subject.
+    """
+    logger.info(f"Processing subject: {subject_id}")
+
+    if config_file.get("slab_size") and preloaded is None:
+        return extract_subject_features_by_slabs(subject_id, path_images, config_file)
+
+    label_names, numeric_label = list(config_file["labels"].keys()), list(config_file["labels"].values())
+    features_to_extract = [key for key, value in config_file["features"].items() if value]
+    spatial_features, tumor_features, stats_features, texture_feats, sketches = {}, {}, {}, {}, {}
+
+    # read sequences and segmentation (each file is decoded only once)
+    sequences, metadata = preloaded or load_subject(root=path_images, patient_id=subject_id)
+    seg = sequences.pop("seg")
+
+    # calculating spacing
+    sequences_spacing = get_spacing(img=metadata.get("t1ce"))
+    seg_spacing = get_spacing(img=metadata.get("seg"))
+
+    # bounding boxes of the brain in each sequence and of the tumor, computed once from axis projections, so the
+    # features below only scan the voxels inside them
+    brain_boxes = {}
+    if any(feature in features_to_extract for feature in ('statistical', 'texture', 'spatial')):
+        brain_boxes = {key: get_bounding_box(seq) for key, seq in sequences.items() if seq is not None}
+    tumor_box = get_bounding_box(seg) if 'tumor' in features_to_extract and seg is not None else None
+
+    # extract first order (statistical) information from sequences, sketching their intensity distributions
+    if 'statistical' in features_to_extract:
+        stats_features = {}
+        for key, seq in sequences.items():
+            if seq is not None:
+                brain = crop_to_bounding_box(seq, brain_boxes[key])
+                # private copy of the brain voxels, which the percentiles reorder in place (the sketch does not
+                # depend on their order)
+                values = brain[brain > 0]
+                stats_features[key] = StatisticalFeatures(
+                    values, dtype=config_file.get("statistical_dtype"), overwrite_input=True
+                ).extract_features()
+                if config_file.get("intensity_sketches", False):
+                    sketches[key] = new_intensity_sketch(config_file).update(values).to_dict()
+                del values
+
+    # extract second order (texture) information from sequences
+    if 'texture' in features_to_extract:
+        texture_feats = {
+            key: TextureFeatures(
+                seq, remove_empty_planes=True, levels=config_file.get("texture_levels", 256),
+                bounding_box=brain_boxes[key]
+            ).extract_features()
+            for key, seq in sequences.items()
+            if seq is not None
+        }
+
+    # calculate spatial features (dimensions and brain center mass)
+    if 'spatial' in features_to_extract:
+        sf = SpatialFeatures(
+            sequence=sequences.get("t1ce"), spacing=sequences_spacing, bounding_box=brain_boxes.get("t1ce")
+        )
+        spatial_features = sf.extract_features()
+
+    # calculate tumor features
+    if 'tumor' in features_to_extract:
+        tf = TumorFeatures(
+            segmentation=seg, spacing=seg_spacing, mapping_names=dict(zip(numeric_label, label_names)),
+            bounding_box=tumor_box
+        )
+        tumor_features = tf.extract_features(sf.center_mass.values() if 'spatial' in features_to_extract else {})
+
+    return {
+        "spatial_features": spatial_features,
+        "tumor_features": tumor_features,
+        "stats_features": stats_features,
+        "texture_feats": texture_feats,
+        "intensity_sketches": sketches,
+    }
+
+
+def extract_subject_features_by_slabs(subject_id: str, path_images: str, config_file: dict) -> dict:
+    """
+    Out-of-core version of `extract_subject_features` for scans too large to be held in memory. Each file is read in
+    axial slabs of `slab_size` planes (see `iter_slabs`) and the statistical, spatial and tumor features are
+    accumulated from mergeable partial results, so their peak memory is bounded by the size of a slab.
 
-            # calculating spacing
-            sequences_spacing = get_spacing(img=load_nii_by_id(path_images, subject_id, "_t1ce"))
-            seg_spacing = get_spacing(img=load_nii_by_id(path_images, subject_id, "_seg"))
+    Texture features need whole volumes, so each sequence is loaded on its own (one at a time) when they are enabled.
+    In that case the peak memory is bounded by the size of the largest sequence instead, so texture features should be
+    disabled for scans that do not fit in memory.
 
-            # extract first order (statistical) information from sequences
+    Args:
+        subject_id (str): The ID of the patient.
+        path_images (str): The path to the directory containing patient image data.
+        config_file (dict): Config file 'feature_extractor.yml'
+
+    Returns:
+        dict: A dictionary with the spatial, tumor, statistical and texture features of the subject.
+    """
+    label_names, numeric_label = list(config_file["labels"].keys()), list(config_file["labels"].values())
+    features_to_extract = [key for key, value in config_file["features"].items() if value]
+    slab_size = int(config_file["slab_size"])
+    spatial_features, tumor_features, stats_features, texture_feats, sketches = {}, {}, {}, {}, {}
+
+    # headers of the files, read without decoding their voxels
+    paths, shapes, metadata = {}, {}, {}
+    for seq in ("_t1", "_t1ce", "_t2", "_flair", "_seg"):
+        name = seq.replace("_", "")
+        paths[name], shapes[name], metadata[name] = f"{path_images}/{subject_id}/{subject_id}{seq}.nii.gz", None, None
+        if os.path.exists(paths[name]):
+            shapes[name], metadata[name] = read_image_information(paths[name])
+        else:
+            logger.warning(f" Sequence '{seq}' not found.")
+    sequences = [key for key in paths if key != "seg" and shapes[key] is not None]
+
+    # single pass over the slabs of each sequence, feeding the statistics and the brain marginals
+    brain_marginals = None
+    for key in sequences:
+        accumulator = StatisticsAccumulator(
+            dtype=config_file.get("statistical_dtype"), sketch_size=config_file.get("sketch_size", 400)
+        )
+        sketch = new_intensity_sketch(config_file)
+        for start, slab in iter_slabs(paths[key], slab_size):
             if 'statistical' in features_to_extract:
-                stats_features = {
-                    key: StatisticalFeatures(seq[seq > 0]).extract_features()
-                    for key, seq in sequences.items()
-                    if seq is not None
-                }
-
-            # extract second order (texture) information from sequences
-            if 'texture' in features_to_extract:
-                texture_feats = {
-                    key: TextureFeatures(seq, remove_empty_planes=True).extract_features()
-                    for key, seq in sequences.items()
-                    if seq is not None
-                }
-
-            # calculate spatial features (dimensions and brain center mass)
-            if 'spatial' in features_to_extract:
-                sf = SpatialFeatures(sequence=sequences.get("t1ce"), spacing=sequences_spacing)
-                spatial_features = sf.extract_features()
-
-            # calculate tumor features
-            if 'tumor' in features_to_extract:
-                tf = TumorFeatures(
-                    segmentation=seg, spacing=seg_spacing, mapping_names=dict(zip(numeric_label, label_names))
-                )
-                tumor_features = tf.extract_features(sf.center_mass.values() if 'spatial' in features_to_extract else {})
-
-            # Add info to the main df
-            patient_info_df = store_subject_information(
-                subject_id,
-                spatial_features,
-                tumor_features,
-                stats_features,
-                texture_feats
-            )
-            data = pd.concat([data, patient_info_df], ignore_index=True)
-
-        data = extract_longitudinal_info(config_file, data, dataset_name)
-
-        return data
+                values = slab[slab > 0]
+                accumulator.update(values)
+                if config_file.get("intensity_sketches", False):
+                    sketch.update(values)
+                del values
+            if 'spatial' in features_to_extract and key == "t1ce":
+                bounding_box = get_bounding_box(slab)
+                if bounding_box is not None:
+                    marginals = offset_slab_marginals(get_axis_marginals(slab, bounding_box), start, shapes[key][0])
+                    brain_marginals = marginals if brain_marginals is None else [
+                        a + b for a, b in zip(brain_marginals, marginals)
+                    ]
+            del slab
+        if 'statistical' in features_to_extract:
+            stats_features[key] = accumulator.extract_features()
+            if config_file.get("intensity_sketches", False):
+                sketches[key] = sketch.to_dict()
+
+    # texture features need the whole volume, so the sequences are loaded one at a time
+    if 'texture' in features_to_extract:
+        for key in sequences:
+            seq = load_nii_with_metadata(paths[key])[0]
+            texture_feats[key] = TextureFeatures(
+                seq, remove_empty_planes=True, levels=config_file.get("texture_levels", 256)
+            ).extract_features()
+            del seq
+
+    # calculate spatial features (dimensions and brain center mass)
+    if 'spatial' in features_to_extract:
+        if shapes["t1ce"] is not None and brain_marginals is None:
+            brain_marginals = [np.zeros(n, dtype=np.int64) for n in shapes["t1ce"]]
+        sf = SpatialFeatures(
+            sequence=None, spacing=get_spacing(img=metadata.get("t1ce")), marginals=brain_marginals,
+            shape=shapes["t1ce"]
+        )
+        spatial_features = sf.extract_features()
+
+    # calculate tumor features from the label marginals accumulated slab by slab
+    if 'tumor' in features_to_extract:
+        label_marginals = None
+        if shapes["seg"] is not None:
+            accumulator = LabelMarginalsAccumulator(shapes["seg"])
+            for start, slab in iter_slabs(paths["seg"], slab_size):
+                accumulator.update(slab, start)
+            label_marginals = accumulator.marginals
+        tf = TumorFeatures(
+            segmentation=None, spacing=get_spacing(img=metadata.get("seg")),
+            mapping_names=dict(zip(numeric_label, label_names)), label_marginals=label_marginals, shape=shapes["seg"]
+        )
+        tumor_features = tf.extract_features(sf.center_mass.values() if 'spatial' in features_to_extract else {})
+
+    return {
+        "spatial_features": spatial_features,
+        "tumor_features": tumor_features,
+        "stats_features": stats_features,
+        "texture_feats": texture_feats,
+        "intensity_sketches": sketches,
+    }
+
+
+def new_intensity_sketch(config_file: dict) -> IntensitySketch:
+    """
+    Builds an empty intensity sketch with the settings of the config file.
+
+    Args:
+        config_file (dict): Config file 'feature_extractor.yml'
+
+    Returns:
+        IntensitySketch: The empty sketch.
+    """
+    return IntensitySketch(
+        sketch_size=config_file.get("sketch_size", 400),
+        bin_width=config_file.get("sketch_bin_width", 10),
+        dtype=config_file.get("statistical_dtype")
+    )
 
 
 def store_subject_information(
@@ -103,10 +368,11 @@ def store_subject_information(
     spatial_features: dict,
     tumor_features: dict,
     stats_features: dict,
-    texture_feats: dict
-) -> pd.DataFrame:
+    texture_feats: dict,
+    intensity_sketches: dict = None
+) -> dict:
     """
-    Stores the extracted features for a single patient in a DataFrame.
+    Stores the extracted features for a single patient in a flat dictionary (a row of the output DataFrame).
 
     Args:
         subject_id (str): The ID of the patient.
@@ -114,9 +380,11 @@ def store_subject_information(
         tumor_features (dict): A dictionary containing tumor features extracted from the patient's segmentation.
         stats_features (dict): A dictionary containing statistical features extracted from the patient's images.
         texture_feats (dict): A dictionary containing texture features extracted from the patient's images.
+        intensity_sketches (dict): The intensity sketches of the patient's images. They are merged at dataset level,
+                                   so they are not part of the row.
 
     Returns:
-        pd.DataFrame: A DataFrame with the patient's ID and all extracted features, structured as a single row.
+        dict: A dictionary with the patient's ID and all extracted features, structured as a single row.
     """
 
     # storing information about patient
@@ -138,10 +406,7 @@ def store_subject_information(
         prefixed_textures = {f"{seq}_{k}": v for k, v in dict_stats.items()}
         patient_info.update(prefixed_textures)
 
-    # from dict to dataframe
-    patient_info_df = pd.DataFrame(patient_info, index=[0])
-
-    return patient_info_df
+    return patient_info
 
 
 def extract_longitudinal_info(config: dict, df: pd.DataFrame, dataset_name: str) -> pd.DataFrame:
@@ -0,0 +1,445 @@
+import json
+import os
+import zlib
+
+import numpy as np
+
+from src.features.statistical import StatisticsAccumulator
+
+# percentiles reported in the summaries of the dataset-level intensity distributions
+SUMMARY_PERCENTILES = (1, 5, 10, 25, 50, 75, 90, 95, 99)
+
+
+class QuantileSketch:
+    """
+    A KLL-style streaming quantile sketch (Karnin, Lang and Liberty, 2016) that summarizes any number of values in
+    O(k) memory. The rank error of an estimated percentile is unbiased, with a standard deviation of about 0.8 / k, and
+    stays below 2 / k in 99 % of the cases (the benchmark checks it against the exact percentiles).
+
+    Values are kept in a hierarchy of compactors: an item at level h stands for 2^h original values. Whenever a level
+    exceeds its capacity, it is sorted and every other item (starting at a random offset) is promoted to the next
+    level. Sketches built on different data (or workers) can be merged in any order.
+
+    Methods:
+    -------
+    update(values):
+        Adds a chunk of values to the sketch.
+
+    update_counts(values, counts):
+        Adds distinct values with their number of occurrences.
+
+    merge(other):
+        Adds the values summarized by another sketch.
+
+    get_percentiles(q):
+        Estimates percentiles of the values.
+
+    to_dict() / from_dict(data):
+        Converts the sketch to (and from) a JSON serializable dictionary.
+    """
+
+    def __init__(self, k=400, seed=0):
+        """
+        Constructs an empty sketch.
+
+        Parameters:
+        ----------
+        k : int, optional
+            Capacity of the top level, which controls the accuracy of the sketch (default is 400).
+        seed : int, optional
+            Seed of the random offsets used by the compactions. The offsets also depend on the values compacted, so
+            sketches of different data do not share them, while the same data always produces the same sketch.
+        """
+        self.k = int(k)
+        self.seed = int(seed)
+        self.n = 0
+        self.levels = [np.empty(0)]
+
+    def capacity(self, level):
+        """Number of items a level can hold before being compacted. Lower levels have geometrically smaller ones."""
+        return max(2, int(np.ceil(self.k * (2 / 3) ** (len(self.levels) - 1 - level))))
+
+    def update(self, values):
+        """
+        Adds a chunk of values to the sketch.
+
+        Parameters:
+        ----------
+        values : np.ndarray
+            The values of the chunk (any shape).
+
+        Returns:
+        -------
+        QuantileSketch
+            The sketch itself.
+        """
+        values = np.ravel(np.asarray(values, dtype=np.float64))
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.n += values.size
+        self._compress()
+
+        return self
+
+    def update_counts(self, values, counts):
+        """
+        Adds distinct values, each one repeated as many times as its count. A count is split into powers of two, and
+        each of them is inserted as an item of the level with that weight, so the total weight is preserved exactly.
+
+        Parameters:
+        ----------
+        values : np.ndarray
+            The distinct values.
+        counts : np.ndarray
+            The number of times each value appears.
+
+        Returns:
+        -------
+        QuantileSketch
+            The sketch itself.
+        """
+        values, counts = np.asarray(values, dtype=np.float64), np.asarray(counts, dtype=np.int64)
+        for level in range(int(counts.max()).bit_length() if counts.size else 0):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], values[(counts >> level) & 1 == 1]])
+        self.n += int(counts.sum())
+        self._compress()
+
+        return self
+
+    def merge(self, other):
+        """
+        Adds the values summarized by another sketch.
+
+        Parameters:
+        ----------
+        other : QuantileSketch
+            The sketch to merge. It is not modified.
+
+        Returns:
+        -------
+        QuantileSketch
+            The sketch itself.
+        """
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.n += other.n
+        self._compress()
+
+        return self
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            if self.levels[level].size > self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(self.levels[level])
+
+                # the offset depends on the items compacted, so sketches of the same size (e.g. equally sized parts
+                # of a dataset) do not share it and their errors cancel out instead of adding up when merged
+                offset = np.random.default_rng((self.seed, self.n, zlib.crc32(items.tobytes()))).integers(2)
+
+                # an odd item stays at its level, so the total weight is preserved exactly
+                kept, items = items[items.size - items.size % 2:], items[:items.size - items.size % 2]
+                self.levels[level] = kept
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], items[offset::2]])
+            level += 1
+
+    def get_percentiles(self, q):
+        """
+        Estimates percentiles of the values summarized by the sketch.
+
+        Parameters:
+        ----------
+        q : list
+            Percentiles to compute, between 0 and 100.
+
+        Returns:
+        -------
+        np.ndarray
+            The estimated percentiles, or NaN if the sketch is empty.
+        """
+        q = np.asarray(q, dtype=np.float64)
+        if self.n == 0:
+            return np.full(q.shape, np.nan)
+
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(items.size, 2 ** level) for level, items in enumerate(self.levels)])
+        order = np.argsort(items, kind="stable")
+        cumulative = np.cumsum(weights[order])
+        ranks = np.searchsorted(cumulative, q / 100 * (cumulative[-1] - 1), side="right")
+
+        return items[order][np.minimum(ranks, items.size - 1)]
+
+    def to_dict(self):
+        """Converts the sketch to a JSON serializable dictionary."""
+        return {"k": self.k, "seed": self.seed, "n": int(self.n), "levels": [items.tolist() for items in self.levels]}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Builds a sketch from the dictionary returned by `to_dict`."""
+        sketch = cls(data["k"], data.get("seed", 0))
+        sketch.n = data["n"]
+        sketch.levels = [np.array(items, dtype=np.float64) for items in data["levels"]]
+
+        return sketch
+
+
+class FixedWidthHistogram:
+    """
+    A sparse histogram with bins of a fixed width anchored at 0, so histograms built on different data (or workers)
+    always share their bin edges and can be merged by adding their counts. Only non-empty bins are stored.
+
+    Methods:
+    -------
+    update(values):
+        Adds a chunk of values to the histogram.
+
+    merge(other):
+        Adds the counts of another histogram with the same bin width.
+
+    to_dict() / from_dict(data):
+        Converts the histogram to (and from) a JSON serializable dictionary.
+    """
+
+    def __init__(self, bin_width=1.0):
+        """
+        Constructs an empty histogram.
+
+        Parameters:
+        ----------
+        bin_width : float, optional
+            Width of the bins. The bin i covers the values in [i * bin_width, (i + 1) * bin_width).
+        """
+        if bin_width <= 0:
+            raise ValueError(f"The bin width must be positive, got {bin_width}")
+        self.bin_width = float(bin_width)
+        self.bins = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+
+    def update(self, values):
+        """
+        Adds a chunk of values to the histogram.
+
+        Parameters:
+        ----------
+        values : np.ndarray
+            The values of the chunk (any shape).
+
+        Returns:
+        -------
+        FixedWidthHistogram
+            The histogram itself.
+        """
+        bins, counts = np.unique(
+            np.floor(np.ravel(values) / self.bin_width).astype(np.int64), return_counts=True
+        )
+
+        return self._add(bins, counts)
+
+    def merge(self, other):
+        """
+        Adds the counts of another histogram.
+
+        Parameters:
+        ----------
+        other : FixedWidthHistogram
+            The histogram to merge. It must have the same bin width, and it is not modified.
+
+        Returns:
+        -------
+        FixedWidthHistogram
+            The histogram itself.
+        """
+        if other.bin_width != self.bin_width:
+            raise ValueError(f"Histograms with bin widths {self.bin_width} and {other.bin_width} cannot be merged")
+
+        return self._add(other.bins, other.counts)
+
+    def _add(self, bins, counts):
+        bins, inverse = np.unique(np.concatenate([self.bins, bins]), return_inverse=True)
+        self.counts = np.bincount(np.ravel(inverse), weights=np.concatenate([self.counts, counts])).astype(np.int64)
+        self.bins = bins
+
+        return self
+
+    @property
+    def edges(self):
+        """Lower edges of the non-empty bins."""
+        return self.bins * self.bin_width
+
+    def to_dict(self):
+        """Converts the histogram to a JSON serializable dictionary."""
+        return {"bin_width": self.bin_width, "bins": self.bins.tolist(), "counts": self.counts.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Builds a histogram from the dictionary returned by `to_dict`."""
+        histogram = cls(data["bin_width"])
+        histogram.bins = np.array(data["bins"], dtype=np.int64)
+        histogram.counts = np.array(data["counts"], dtype=np.int64)
+
+        return histogram
+
+
+class IntensitySketch:
+    """
+    Mergeable summary of the intensity distribution of a sequence across many subjects, built on the same values as
+    `StatisticalFeatures` (the brain voxels). It combines the exact moments and extremes of a `StatisticsAccumulator`,
+    the percentiles of a `QuantileSketch` and a `FixedWidthHistogram`, and takes a bounded amount of memory however
+    many voxels it summarizes.
+
+    Methods:
+    -------
+    update(values):
+        Adds the values of a subject (or of a chunk of it).
+
+    merge(other):
+        Adds the values summarized by another sketch.
+
+    summary():
+        Computes the dataset-level statistics of the sketch.
+
+    to_dict() / from_dict(data):
+        Converts the sketch to (and from) a JSON serializable dictionary.
+    """
+
+    def __init__(self, sketch_size=400, bin_width=1.0, dtype=None):
+        """
+        Constructs an empty sketch.
+
+        Parameters:
+        ----------
+        sketch_size : int, optional
+            Capacity of the quantile sketch (see `QuantileSketch`).
+        bin_width : float, optional
+            Width of the bins of the histogram.
+        dtype : str or np.dtype, optional
+            Floating point type used to compute the moments (see `StatisticalFeatures`).
+        """
+        self.moments = StatisticsAccumulator(dtype, keep_counts=False)
+        self.quantiles = QuantileSketch(sketch_size)
+        self.histogram = FixedWidthHistogram(bin_width)
+
+    def update(self, values):
+        """Adds a chunk of values to the moments, the quantile sketch and the histogram."""
+        self.moments.update(values)
+        self.quantiles.update(values)
+        self.histogram.update(values)
+
+        return self
+
+    def merge(self, other):
+        """Adds the values summarized by another sketch."""
+        self.moments.merge(other.moments)
+        self.quantiles.merge(other.quantiles)
+        self.histogram.merge(other.histogram)
+
+        return self
+
+    def summary(self):
+        """
+        Computes the dataset-level statistics of the sketch.
+
+        Returns:
+        -------
+        dict
+            The number of voxels, the metrics of `StatisticalFeatures` (with the median and percentiles estimated by
+            the quantile sketch), the percentiles in `SUMMARY_PERCENTILES` and the histogram (lower edges and counts
+            of its non-empty bins).
+        """
+        if self.moments.n == 0:
+            return {"n_voxels": 0}
+
+        percentiles = dict(zip(SUMMARY_PERCENTILES, self.quantiles.get_percentiles(SUMMARY_PERCENTILES).tolist()))
+        statistics = self.moments.extract_features()
+        statistics.update(
+            {"median_intensity": percentiles[50], "10_perc_intensity": percentiles[10],
+             "90_perc_intensity": percentiles[90]}
+        )
+
+        return {
+            "n_voxels": int(self.moments.n),
+            **{key: float(value) for key, value in statistics.items()},
+            "percentiles": {str(q): value for q, value in percentiles.items()},
+            "histogram": {
+                "bin_width": self.histogram.bin_width,
+                "edges": self.histogram.edges.tolist(),
+                "counts": self.histogram.counts.tolist(),
+            },
+        }
+
+    def to_dict(self):
+        """Converts the sketch to a JSON serializable dictionary."""
+        return {
+            "moments": self.moments.to_dict(),
+            "quantiles": self.quantiles.to_dict(),
+            "histogram": self.histogram.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Builds a sketch from the dictionary returned by `to_dict`."""
+        sketch = cls()
+        sketch.moments = StatisticsAccumulator.from_dict(data["moments"])
+        sketch.quantiles = QuantileSketch.from_dict(data["quantiles"])
+        sketch.histogram = FixedWidthHistogram.from_dict(data["histogram"])
+
+        return sketch
+
+
+def merge_intensity_sketches(subject_sketches: list) -> dict:
+    """
+    Merges the sketches of several subjects into one sketch per sequence.
+
+    Args:
+        subject_sketches: List of dictionaries mapping each sequence to the `to_dict` output of its sketch. The
+                          sketches are merged in the order of the list, so the result is reproducible.
+
+    Returns:
+        dict: The merged `IntensitySketch` of each sequence.
+    """
+    merged = {}
+    for sketches in subject_sketches:
+        for seq, data in (sketches or {}).items():
+            sketch = IntensitySketch.from_dict(data)
+            merged[seq] = merged[seq].merge(sketch) if seq in merged else sketch
+
+    return merged
+
+
+def save_intensity_sketches(path: str, sketches: dict):
+    """
+    Stores the dataset-level sketches of each sequence in a JSON file, together with their summaries. The file is
+    written atomically.
+
+    Args:
+        path: Path of the JSON file.
+        sketches: The `IntensitySketch` of each sequence.
+    """
+    content = {seq: {"summary": sketch.summary(), "sketch": sketch.to_dict()} for seq, sketch in sketches.items()}
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(content, file)
+    os.replace(tmp_path, path)
+
+
+def load_intensity_sketches(path: str) -> dict:
+    """
+    Loads the sketches stored by `save_intensity_sketches`, so the sketches of several datasets (or runs) can be
+    merged with each other.
+
+    Args:
+        path: Path of the JSON file.
+
+    Returns:
+        dict: The `IntensitySketch` of each sequence.
+    """
+    with open(path, "r") as file:
+        content = json.load(file)
+
+    return {seq: IntensitySketch.from_dict(entry["sketch"]) for seq, entry in content.items()}
@@ -1,6 +1,10 @@
 import numpy as np
 from loguru import logger
 
+from src.utils.sequences import center_of_mass_from_marginals
+from src.utils.sequences import get_axis_marginals
+from src.utils.sequences import get_bounding_box
+
 
 class SpatialFeatures:
     """
@@ -21,7 +25,7 @@ class SpatialFeatures:
         Gets the dimensions of the sequence in axial, coronal, and sagittal planes.
     """
 
-    def __init__(self, sequence, spacing=None):
+    def __init__(self, sequence, spacing=None, bounding_box=None, marginals=None, shape=None):
         """
         Constructs all the necessary attributes for the SpatialFeatures object.
 
@@ -33,11 +37,21 @@ class SpatialFeatures:
             A numpy array representing the segmentation of the medical image.
         spacing : np.ndarray
             A numpy array representing the spacing of the medical image voxels.
+        bounding_box : tuple, optional
+            Bounding box of the brain (see `get_bounding_box`). Only the voxels inside it are scanned.
+        marginals : list, optional
+            Per-axis counts of the brain voxels (see `get_axis_marginals`), if they were already computed (e.g. slab
+            by slab). The sequence can be None then.
+        shape : tuple, optional
+            Shape of the sequence. Only required if the sequence is not given.
         """
         self.center_mass = None
         self.dimensions = None
         self.sequence = sequence
         self.spacing = spacing if spacing is not None else (1, 1, 1)
+        self.bounding_box = bounding_box
+        self.marginals = marginals
+        self.shape = sequence.shape if sequence is not None else shape
 
     def calculate_brain_center_mass(self):
         """
@@ -48,7 +62,7 @@ class SpatialFeatures:
         np.ndarray
             The center of mass coordinates adjusted by the voxel spacing.
         """
-        if self.sequence is None:
+        if self.sequence is None and self.marginals is None:
             logger.warning("Sequence '_t1ce' not found. Assigning brain center of mass (nan, nan, nan)")
             return {
                 "axial_brain_centre_mass": np.nan,
@@ -56,11 +70,16 @@ class SpatialFeatures:
                 "sagittal_brain_centre_mass": np.nan
             }
 
-        # Get the indices of the non-zero voxels
-        coordinates = np.argwhere(self.sequence != 0)
+        # Count the non-zero voxels per axis, scanning only the brain bounding box
+        marginals = self.marginals
+        if marginals is None:
+            bounding_box = self.bounding_box or get_bounding_box(self.sequence)
+            if bounding_box is None:
+                bounding_box = tuple(slice(0, 0) for _ in self.sequence.shape)
+            marginals = get_axis_marginals(self.sequence, bounding_box)
 
         # Calculate the center of mass
-        center_of_mass_mean = np.mean(coordinates, axis=0)
+        center_of_mass_mean = center_of_mass_from_marginals(marginals)
         return dict(
             zip(
                 ["axial_brain_centre_mass", "coronal_brain_centre_mass", "sagittal_brain_centre_mass"],
@@ -80,11 +99,11 @@ class SpatialFeatures:
             - coronal_dim
             - sagittal_dim
         """
-        if self.sequence is None:
+        if self.shape is None:
             logger.warning(" Sequence '_t1ce' not found. Assigning dimensions (nan, nan, nan)")
             return {"axial_dim": np.nan, "coronal_dim": np.nan, "sagittal_dim": np.nan}
 
-        axial, coronal, sagittal = self.sequence.shape
+        axial, coronal, sagittal = self.shape
         dimensions = {"axial_dim": int(axial), "coronal_dim": int(coronal), "sagittal_dim": int(sagittal)}
         return dimensions
 
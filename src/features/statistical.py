@@ -1,6 +1,45 @@
+import copy
+
 import numpy as np
-from scipy.stats import skew
-from scipy.stats import kurtosis
+
+# number of values processed at a time by `summarize_values`, so its temporary buffers stay in the CPU cache
+CHUNK_SIZE = 2 ** 16
+
+
+def summarize_values(values: np.ndarray, work_dtype) -> tuple:
+    """
+    Computes the extremes, the mean and the sums of the 2nd, 3rd and 4th powers of the deviations from the mean of
+    some values. The values are read in two sweeps (one for the extremes and the mean, the other one for the
+    deviations), in chunks of `CHUNK_SIZE` values, reusing two temporary buffers for all of them.
+
+    Args:
+        values: 1D array of values (not empty).
+        work_dtype: Floating point type used to compute the deviations.
+
+    Returns:
+        tuple: The maximum, minimum and mean (in `work_dtype`) of the values and the central moment sums m2, m3 and
+               m4 (accumulated in double precision).
+    """
+    max_value, min_value, total = values[0], values[0], 0.0
+    for i in range(0, values.size, CHUNK_SIZE):
+        chunk = values[i:i + CHUNK_SIZE]
+        max_value, min_value = np.maximum(max_value, chunk.max()), np.minimum(min_value, chunk.min())
+        total += float(chunk.sum(dtype=work_dtype))
+    mean = work_dtype(total / values.size)
+
+    deviations = np.empty(min(CHUNK_SIZE, values.size), dtype=work_dtype)
+    squared = np.empty_like(deviations)
+    m2 = m3 = m4 = 0.0
+    for i in range(0, values.size, CHUNK_SIZE):
+        chunk = values[i:i + CHUNK_SIZE]
+        d, d2 = deviations[:chunk.size], squared[:chunk.size]
+        np.subtract(chunk, mean, out=d)
+        np.multiply(d, d, out=d2)
+        m2 += float(d2.sum())
+        m3 += float(np.multiply(d2, d, out=d).sum())
+        m4 += float(np.multiply(d2, d2, out=d2).sum())
+
+    return max_value, min_value, mean, m2, m3, m4
 
 
 class StatisticalFeatures:
@@ -14,6 +53,9 @@ class StatisticalFeatures:
 
     Methods:
     -------
+    compute_statistics():
+        Computes all the statistical metrics at once, sharing the intermediate results.
+
     get_max_intensity():
         Computes the maximum intensity value in the sequence.
 
@@ -42,7 +84,7 @@ class StatisticalFeatures:
         Computes and returns all statistical metrics as a dictionary.
     """
 
-    def __init__(self, sequence):
+    def __init__(self, sequence, dtype=None, overwrite_input=False):
         """
         Constructs all the necessary attributes for the StatisticalFeatures object.
 
@@ -50,24 +92,80 @@ class StatisticalFeatures:
         ----------
         sequence : np.ndarray
             A numpy array representing the sequence from which statistical features are to be computed.
+        dtype : str or np.dtype, optional
+            Floating point type used to compute the features (e.g. float32 to halve the memory of the intermediate
+            arrays). By default, integer sequences are computed in float64 and floating point ones in their own type.
+        overwrite_input : bool, optional
+            Whether the values of the sequence can be reordered in place to compute the median and percentiles, when
+            they are a private copy (e.g. `seq[seq > 0]`). It avoids copying them once more.
         """
         self.sequence = sequence
+        self.dtype = dtype
+        self.overwrite_input = overwrite_input
+        self._statistics = None
+
+    @property
+    def statistics(self):
+        """All the statistical metrics, computed together the first time they are requested."""
+        if self._statistics is None:
+            self._statistics = self.compute_statistics()
+        return self._statistics
+
+    def compute_statistics(self):
+        """
+        Computes all the statistical metrics at once: the moments from two chunked sweeps over the values (see
+        `summarize_values`) and the median and percentiles from a single partition of the values.
+
+        Returns:
+        -------
+        dict
+            The statistical metrics, as returned by `extract_features`.
+        """
+        values = np.ravel(np.asarray(self.sequence, dtype=self.dtype))
+        work_dtype = values.dtype.type if values.dtype.kind == "f" else np.float64
+
+        # central moments (biased, as scipy.stats with bias=True)
+        max_intensity, min_intensity, mean, m2, m3, m4 = summarize_values(values, work_dtype)
+        m2, m3, m4 = (work_dtype(m / values.size) for m in (m2, m3, m4))
+
+        # nearly constant values: the standardized moments are not defined (same criterion as scipy.stats)
+        with np.errstate(all="ignore"):
+            is_constant = m2 <= (np.finfo(m2.dtype).resolution * mean) ** 2
+            skewness = np.nan if is_constant else m3 / m2 ** 1.5
+            kurt = np.nan if is_constant else m4 / m2 ** 2 - 3.0
+
+        # the partition can reorder the values in place when they are a private copy (made here or by the caller)
+        overwrite = self.overwrite_input or not np.may_share_memory(values, self.sequence)
+        percentile_10, median, percentile_90 = np.percentile(values, [10, 50, 90], overwrite_input=overwrite)
+
+        return {
+            "max_intensity": max_intensity,
+            "min_intensity": min_intensity,
+            "mean_intensity": mean,
+            "median_intensity": median,
+            "10_perc_intensity": percentile_10,
+            "90_perc_intensity": percentile_90,
+            "std_intensity": np.sqrt(m2),
+            "range_intensity": max_intensity - min_intensity,
+            "skewness": skewness,
+            "kurtosis": kurt,
+        }
 
     def get_max_intensity(self):
         """Computes the maximum intensity value in the sequence."""
-        return self.sequence.max()
+        return self.statistics["max_intensity"]
 
     def get_min_intensity(self):
         """Computes the minimum intensity value in the sequence."""
-        return self.sequence.min()
+        return self.statistics["min_intensity"]
 
     def get_mean_intensity(self):
         """Computes the mean intensity value in the sequence."""
-        return self.sequence.mean()
+        return self.statistics["mean_intensity"]
 
     def get_median_intensity(self):
         """Computes the median intensity value in the sequence."""
-        return np.median(self.sequence)
+        return self.statistics["median_intensity"]
 
     def get_percentile_n(self, n):
         """Computes the n-th percentile of the intensity values in the sequence."""
@@ -75,19 +173,19 @@ class StatisticalFeatures:
 
     def get_std_intensity(self):
         """Computes the standard deviation of intensity values in the sequence."""
-        return self.sequence.std()
+        return self.statistics["std_intensity"]
 
     def get_range_intensity(self):
         """Computes the range of intensity values in the sequence (max - min)."""
-        return self.sequence.max() - self.sequence.min()
+        return self.statistics["range_intensity"]
 
     def get_skewness(self):
         """Computes the skewness of the intensity values in the sequence."""
-        return skew(self.sequence.flatten())
+        return self.statistics["skewness"]
 
     def get_kurtosis(self):
         """Computes the kurtosis of the intensity values in the sequence."""
-        return kurtosis(self.sequence.flatten())
+        return self.statistics["kurtosis"]
 
     def extract_features(self):
         """
@@ -108,15 +206,268 @@ class StatisticalFeatures:
             - skewness
             - kurtosis
         """
+        return dict(self.statistics)
+
+
+class StatisticsAccumulator:
+    """
+    Mergeable version of `StatisticalFeatures` for volumes processed in chunks (e.g. axial slabs), so the whole
+    sequence never needs to be in memory.
+
+    Each chunk is summarized by its size, mean and central moments (combined with the pairwise formulas of Chan et
+    al. and Pébay) and its extremes. For the median and percentiles, integer values are summarized by the counts of
+    their distinct values, from which they are computed exactly, as long as there are at most `max_distinct` of them
+    (65536 covers the usual 16-bit scans). Float values, or integers with more distinct values, are summarized by a
+    `QuantileSketch` instead, so their percentiles are estimates. Partial accumulators built on different chunks (or
+    workers) can be merged in any order.
+
+    The memory taken is bounded by `max_distinct` and the size of the sketch, not by the size of the volume. If the
+    percentiles are not needed, the value counts can be disabled, and then the median and percentiles are NaN.
+
+    Methods:
+    -------
+    update(values):
+        Adds a chunk of values to the accumulator.
+
+    merge(other):
+        Adds the values summarized by another accumulator.
+
+    extract_features():
+        Computes and returns all statistical metrics as a dictionary, with the same keys as `StatisticalFeatures`.
+
+    to_dict() / from_dict(data):
+        Converts the accumulator to (and from) a JSON serializable dictionary.
+    """
+
+    def __init__(self, dtype=None, keep_counts=True, max_distinct=65536, sketch_size=400):
+        """
+        Constructs an empty accumulator.
+
+        Parameters:
+        ----------
+        dtype : str or np.dtype, optional
+            Floating point type used to compute the partial moments of each chunk (see `StatisticalFeatures`).
+        keep_counts : bool, optional
+            Whether to summarize the distribution of the values, required for the median and percentiles.
+        max_distinct : int, optional
+            Maximum number of distinct integer values counted exactly before switching to a quantile sketch.
+        sketch_size : int, optional
+            Capacity of the quantile sketch (see `QuantileSketch`).
+        """
+        self.dtype = dtype
+        self.keep_counts = keep_counts
+        self.max_distinct = max_distinct
+        self.sketch_size = sketch_size
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.m3 = 0.0
+        self.m4 = 0.0
+        self.max = None
+        self.min = None
+        self.values = None
+        self.counts = None
+        self.quantiles = None
+
+    def update(self, values):
+        """
+        Adds a chunk of values to the accumulator.
+
+        Parameters:
+        ----------
+        values : np.ndarray
+            The values of the chunk (any shape).
+
+        Returns:
+        -------
+        StatisticsAccumulator
+            The accumulator itself.
+        """
+        from src.features.sketches import QuantileSketch
+
+        raw = np.ravel(np.asarray(values))
+        if raw.size == 0:
+            return self
+        values = raw if self.dtype is None else raw.astype(self.dtype, copy=False)
+
+        work_dtype = values.dtype.type if values.dtype.kind == "f" else np.float64
+        chunk = StatisticsAccumulator(self.dtype, self.keep_counts, self.max_distinct, self.sketch_size)
+        chunk.n = values.size
+        chunk.max, chunk.min, chunk.mean, chunk.m2, chunk.m3, chunk.m4 = summarize_values(values, work_dtype)
+        if self.keep_counts and raw.dtype.kind in "uib":
+            chunk.values, chunk.counts = np.unique(raw, return_counts=True)
+        elif self.keep_counts:
+            chunk.quantiles = QuantileSketch(self.sketch_size).update(raw)
+
+        return self.merge(chunk)
+
+    def merge(self, other):
+        """
+        Adds the values summarized by another accumulator.
+
+        Parameters:
+        ----------
+        other : StatisticsAccumulator
+            The accumulator to merge. It is not modified.
+
+        Returns:
+        -------
+        StatisticsAccumulator
+            The accumulator itself.
+        """
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            for name in ("n", "mean", "m2", "m3", "m4", "max", "min", "values", "counts"):
+                setattr(self, name, getattr(other, name))
+            self.quantiles = copy.deepcopy(other.quantiles)
+            self.keep_counts = self.keep_counts and other.keep_counts
+            return self._limit_counts()
+
+        n_a, n_b = float(self.n), float(other.n)
+        n = n_a + n_b
+        delta = float(other.mean) - float(self.mean)
+        m2_a, m2_b = float(self.m2), float(other.m2)
+        m3_a, m3_b = float(self.m3), float(other.m3)
+
+        self.m4 = (
+            float(self.m4) + float(other.m4)
+            + delta ** 4 * n_a * n_b * (n_a ** 2 - n_a * n_b + n_b ** 2) / n ** 3
+            + 6 * delta ** 2 * (n_a ** 2 * m2_b + n_b ** 2 * m2_a) / n ** 2
+            + 4 * delta * (n_a * m3_b - n_b * m3_a) / n
+        )
+        self.m3 = (
+            m3_a + m3_b
+            + delta ** 3 * n_a * n_b * (n_a - n_b) / n ** 2
+            + 3 * delta * (n_a * m2_b - n_b * m2_a) / n
+        )
+        self.m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / n
+        self.mean = float(self.mean) + delta * n_b / n
+        self.n += other.n
+
+        self.max, self.min = max(self.max, other.max), min(self.min, other.min)
+        self.keep_counts = self.keep_counts and other.keep_counts
+        if not self.keep_counts:
+            self.values, self.counts, self.quantiles = None, None, None
+            return self
+        if self.quantiles is None and other.quantiles is None:
+            values, inverse = np.unique(np.concatenate([self.values, other.values]), return_inverse=True)
+            self.counts = np.bincount(np.ravel(inverse), weights=np.concatenate([self.counts, other.counts]))
+            self.values, self.counts = values, self.counts.astype(np.int64)
+            return self._limit_counts()
+
+        # one of them is summarized by a sketch, so the exact counts of the other are added to it
+        self._to_sketch()
+        if other.quantiles is None:
+            self.quantiles.update_counts(other.values, other.counts)
+        else:
+            self.quantiles.merge(other.quantiles)
+
+        return self
+
+    def _limit_counts(self):
+        if self.values is not None and self.values.size > self.max_distinct:
+            self._to_sketch()
+
+        return self
+
+    def _to_sketch(self):
+        from src.features.sketches import QuantileSketch
+
+        if self.quantiles is None:
+            self.quantiles = QuantileSketch(self.sketch_size).update_counts(self.values, self.counts)
+            self.values, self.counts = None, None
+
+    def get_percentiles(self, q):
+        """
+        Computes percentiles of the accumulated values from their counts, with the same linear interpolation as
+        `np.percentile`, or estimates them with the quantile sketch if the values are summarized by one.
+
+        Parameters:
+        ----------
+        q : list
+            Percentiles to compute, between 0 and 100.
+
+        Returns:
+        -------
+        np.ndarray
+            The percentiles.
+        """
+        if self.quantiles is not None:
+            return self.quantiles.get_percentiles(q)
+
+        # positions (in the sorted values) of the percentiles and of their upper neighbours
+        positions = (self.n - 1) * np.asarray(q, dtype=np.float64) / 100
+        lower = np.floor(positions)
+        upper = np.minimum(lower + 1, self.n - 1)
+        cumulative = np.cumsum(self.counts)
+        below = self.values[np.searchsorted(cumulative, lower, side="right")].astype(np.float64)
+        above = self.values[np.searchsorted(cumulative, upper, side="right")].astype(np.float64)
+
+        weight = positions - lower
+        difference = above - below
+        return np.where(weight >= 0.5, above - difference * (1 - weight), below + difference * weight)
+
+    def extract_features(self):
+        """
+        Computes and returns all statistical metrics as a dictionary.
+
+        Returns:
+        -------
+        dict
+            The same metrics returned by `StatisticalFeatures.extract_features`.
+        """
+        if self.n == 0:
+            raise ValueError("No values were accumulated, so the statistical features cannot be computed")
+
+        m2, m3, m4 = self.m2 / self.n, self.m3 / self.n, self.m4 / self.n
+
+        # nearly constant values: the standardized moments are not defined (same criterion as scipy.stats)
+        with np.errstate(all="ignore"):
+            is_constant = m2 <= (np.finfo(np.float64).resolution * self.mean) ** 2
+            skewness = np.nan if is_constant else m3 / m2 ** 1.5
+            kurt = np.nan if is_constant else m4 / m2 ** 2 - 3.0
+
+        percentile_10, median, percentile_90 = self.get_percentiles([10, 50, 90]) if self.keep_counts else [np.nan] * 3
+
         return {
-            "max_intensity": self.get_max_intensity(),
-            "min_intensity": self.get_min_intensity(),
-            "mean_intensity": self.get_mean_intensity(),
-            "median_intensity": self.get_median_intensity(),
-            "10_perc_intensity": self.get_percentile_n(10),
-            "90_perc_intensity": self.get_percentile_n(90),
-            "std_intensity": self.get_std_intensity(),
-            "range_intensity": self.get_range_intensity(),
-            "skewness": self.get_skewness(),
-            "kurtosis": self.get_kurtosis(),
+            "max_intensity": self.max,
+            "min_intensity": self.min,
+            "mean_intensity": self.mean,
+            "median_intensity": median,
+            "10_perc_intensity": percentile_10,
+            "90_perc_intensity": percentile_90,
+            "std_intensity": np.sqrt(m2),
+            "range_intensity": self.max - self.min,
+            "skewness": skewness,
+            "kurtosis": kurt,
         }
+
+    def to_dict(self):
+        """Converts the accumulator to a JSON serializable dictionary."""
+        data = {"n": int(self.n)}
+        for name in ("mean", "m2", "m3", "m4", "max", "min"):
+            value = getattr(self, name)
+            data[name] = None if value is None else float(value)
+        if self.keep_counts and self.quantiles is not None:
+            data["quantiles"] = self.quantiles.to_dict()
+        elif self.keep_counts and self.n:
+            data.update({"values": self.values.tolist(), "counts": self.counts.tolist()})
+
+        return data
+
+    @classmethod
+    def from_dict(cls, data, dtype=None):
+        """Builds an accumulator from the dictionary returned by `to_dict`."""
+        from src.features.sketches import QuantileSketch
+
+        accumulator = cls(dtype, keep_counts="values" in data or "quantiles" in data or not data["n"])
+        for name in ("n", "mean", "m2", "m3", "m4", "max", "min"):
+            setattr(accumulator, name, data[name])
+        if "values" in data:
+            accumulator.values, accumulator.counts = np.array(data["values"]), np.array(data["counts"], dtype=np.int64)
+        if "quantiles" in data:
+            accumulator.quantiles = QuantileSketch.from_dict(data["quantiles"])
+            accumulator.sketch_size = accumulator.quantiles.k
+
+        return accumulator
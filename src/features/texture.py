@@ -17,11 +17,13 @@ class TextureFeatures:
     -------
     compute_texture_values(texture="contrast"):
         Computes texture values for each 2D plane in the 3D image array.
+    compute_textures_values(textures):
+        Computes the values of several textures for each 2D plane, building each plane's GLCM only once.
     extract_features(texture="contrast") -> dict:
         Extracts texture features from the MRI image.
     """
 
-    def __init__(self, sequence, remove_empty_planes=False):
+    def __init__(self, sequence, remove_empty_planes=False, levels=256, bounding_box=None):
         """
         Constructs all the necessary attributes for the TextureFeatures object.
 
@@ -29,52 +31,101 @@ class TextureFeatures:
         ----------
         sequence : np.ndarray
             A 3D numpy array representing the MRI image.
+        remove_empty_planes : bool
+            Whether to crop the image to the brain boundaries before computing the textures.
+        levels : int
+            Number of gray levels used to quantize the image (up to 256). Fewer levels (e.g. 32 or 64) reduce the
+            memory and time needed to build the GLCMs.
+        bounding_box : tuple, optional
+            Bounding box of the brain (see `get_bounding_box`), if it was already computed. It is used to crop the
+            image when `remove_empty_planes` is enabled.
         """
+        if not 2 <= levels <= 256:
+            raise ValueError(f"The number of gray levels must be between 2 and 256, got {levels}")
+
         self.sequence = sequence
         self.remove_empty_planes = remove_empty_planes
+        self.levels = levels
+        self.bounding_box = bounding_box
+        self._image_array = None
 
-    def compute_texture_values(self, texture="contrast"):
+    def get_quantized_image(self):
         """
-        Computes texture values for each 2D plane in the 3D image array.
+        Crops (if required) and quantizes the image to the configured number of gray levels. The result is computed
+        once and reused by every texture.
+
+        Returns:
+        -------
+        np.ndarray
+            The quantized image as an uint8 array.
+        """
+        if self._image_array is None:
+            sequence = self.sequence
+            if self.remove_empty_planes:
+                sequence = fit_brain_boundaries(self.sequence, self.bounding_box)
+
+            # Normalize the image to values between 0 and levels - 1 (python floats, so integer scans do not overflow)
+            min_value, max_value = float(np.min(sequence)), float(np.max(sequence))
+            self._image_array = (
+                (self.levels - 1) * (sequence - min_value) / (max_value - min_value)
+            ).astype(np.uint8)
+
+        return self._image_array
+
+    def compute_textures_values(self, textures):
+        """
+        Computes the values of several textures for each 2D plane in the 3D image array. The GLCM of each plane is
+        computed once and all the requested properties are derived from it.
 
         Parameters:
         ----------
-        texture : str
-            The texture feature to compute (default is "contrast").
+        textures : list
+            The texture features to compute.
 
         Returns:
         -------
-        np.ndarray
-            An array of texture values for each 2D plane in the image.
+        dict
+            A dictionary with an array of texture values for each 2D plane in the image, per texture.
         """
-        sequence = self.sequence.copy()
-        if self.remove_empty_planes:
-            sequence = fit_brain_boundaries(self.sequence)
-
-        # Normalize the image to values between 0 and 255
-        image_array = (255 * (sequence - np.min(sequence)) / (np.max(sequence) - np.min(sequence))).astype(np.uint8)
+        image_array = self.get_quantized_image()
 
         # Define distances and angles for GLCM calculation
         distances = [1]
         angles = [0, np.pi / 4, np.pi / 2, 3 * np.pi / 4]
 
-        # Initialize a list to store the texture values for each plane
-        texture_values = []
+        # Initialize a dictionary to store the texture values for each plane
+        texture_values = {texture: np.empty(image_array.shape[0]) for texture in textures}
 
         # Iterate over each 2D plane in the Z dimension
         for z in range(image_array.shape[0]):
             plane = image_array[z, :, :]
 
             # Compute GLCM for the current plane
-            glcm = graycomatrix(plane, distances=distances, angles=angles, levels=256, symmetric=True, normed=True)
+            glcm = graycomatrix(
+                plane, distances=distances, angles=angles, levels=self.levels, symmetric=True, normed=True
+            )
+
+            # Compute all the texture features from the same GLCM
+            for texture in textures:
+                texture_values[texture][z] = graycoprops(glcm, prop=texture).mean()
 
-            # Compute the texture feature using skimage.feature.graycoprops
-            feature_value = graycoprops(glcm, prop=texture).mean()
+        return texture_values
+
+    def compute_texture_values(self, texture="contrast"):
+        """
+        Computes texture values for each 2D plane in the 3D image array.
 
-            # Store the texture value of the current plane
-            texture_values.append(feature_value)
+        Parameters:
+        ----------
+        texture : str
+            The texture feature to compute (default is "contrast").
 
-        return np.array(texture_values)
+        Returns:
+        -------
+        np.ndarray
+            An array of texture values for each 2D plane in the image.
+        """
+        return self.compute_textures_values([texture])[texture]
 
     def extract_features(self, textures=None) -> dict:
         """
@@ -94,9 +145,7 @@ class TextureFeatures:
             textures = ['contrast', 'dissimilarity', 'homogeneity', 'ASM', 'energy', 'correlation']
 
         features = {}
-        for texture in textures:
-            texture_values = self.compute_texture_values(texture=texture)
-
+        for texture, texture_values in self.compute_textures_values(textures).items():
             # Create a dictionary to store texture features
             features.update({f"mean_{texture}": np.mean(texture_values)})
             features.update({f"std_{texture}": np.std(texture_values)})
@@ -1,10 +1,142 @@
-from collections import Counter
-
 import numpy as np
 from scipy.spatial.distance import euclidean
 from loguru import logger
 
 from src.utils.operations.misc_operations import add_prefix_dict
+from src.utils.sequences import center_of_mass_from_marginals
+from src.utils.sequences import get_bounding_box
+from src.utils.sequences import offset_slab_marginals
+
+
+def compute_label_marginals(segmentation: np.ndarray, bounding_box: tuple = None, chunk_voxels: int = 2 ** 20) -> dict:
+    """
+    Computes the per-axis voxel counts (marginals) of every non-background label in a single sweep over the
+    segmentation.
+
+    Only the tumor bounding box is scanned, and it is read once, in blocks of planes along its first axis. In each
+    block, one bincount over the (plane, row, label) of every voxel and another one over its (column, label) give the
+    counts of all the labels in every plane along each axis at once, however many labels there are. Counts, centres of
+    mass and tumor slices can be derived from them without going through the volume again.
+
+    Parameters:
+    ----------
+    segmentation : np.ndarray
+        A 3D numpy array representing the segmentation of the medical image.
+    bounding_box : tuple, optional
+        Bounding box of the tumor (see `get_bounding_box`), if it was already computed. Otherwise it is found from the
+        projections of the non-zero voxels, which is much cheaper than the labelled sweep over the whole volume.
+    chunk_voxels : int, optional
+        Approximate number of voxels per block, which bounds the size of the temporary arrays.
+
+    Returns:
+    -------
+    dict
+        A dictionary mapping each non-background label (sorted) to a list with its marginal counts along each axis.
+    """
+    if bounding_box is None:
+        bounding_box = get_bounding_box(segmentation)
+    if bounding_box is None:
+        return {}
+
+    crop = segmentation[bounding_box]
+    depth, rows, columns = crop.shape
+    step = max(1, chunk_voxels // max(1, rows * columns))
+
+    counts = {}
+    for first in range(0, depth, step):
+        block = crop[first:first + step]
+        planes = block.shape[0]
+
+        # integer codes of the labels: the labels themselves when they are small non-negative integers
+        if block.dtype.kind in "ub" or (block.dtype.kind == "i" and block.size and block.min() >= 0):
+            n_labels = int(block.max()) + 1 if block.size else 1
+            labels, codes = np.arange(n_labels), block.reshape(planes * rows, columns)
+        else:
+            labels, codes = np.unique(block, return_inverse=True)
+            n_labels, codes = labels.size, np.ravel(codes).reshape(planes * rows, columns)
+
+        # one bincount over (plane, row, label) and one over (column, label)
+        plane_rows = np.arange(planes * rows, dtype=np.intp)[:, None] * n_labels + codes
+        per_plane_row = np.bincount(plane_rows.ravel(), minlength=planes * rows * n_labels)
+        per_plane_row = per_plane_row.reshape(planes, rows, n_labels)
+        del plane_rows
+        per_column = np.bincount(
+            (np.arange(columns, dtype=np.intp) * n_labels + codes).ravel(), minlength=columns * n_labels
+        ).reshape(columns, n_labels)
+
+        for code in np.flatnonzero(per_column.sum(axis=0)):
+            label = labels[code].item()
+            if label == 0:
+                continue
+            if label not in counts:
+                counts[label] = [np.zeros(n, dtype=np.int64) for n in (depth, rows, columns)]
+            counts[label][0][first:first + planes] += per_plane_row[:, :, code].sum(axis=1)
+            counts[label][1] += per_plane_row[:, :, code].sum(axis=0)
+            counts[label][2] += per_column[:, code]
+
+    # marginals in the frame of the whole segmentation
+    marginals = {}
+    for label in sorted(counts):
+        marginals[label] = [np.zeros(n, dtype=np.int64) for n in segmentation.shape]
+        for axis, box in enumerate(bounding_box):
+            marginals[label][axis][box] = counts[label][axis]
+
+    return marginals
+
+
+class LabelMarginalsAccumulator:
+    """
+    Mergeable version of `compute_label_marginals` for segmentations processed in axial slabs, so the whole
+    segmentation never needs to be in memory. The marginals of each slab are placed at its offset along the first axis
+    and summed, so partial accumulators can be merged in any order.
+
+    Attributes:
+    ----------
+    shape : tuple
+        Shape of the whole segmentation.
+    marginals : dict
+        The per-axis marginal counts of each non-background label accumulated so far.
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.marginals = {}
+
+    def update(self, slab, start):
+        """
+        Adds a slab of the segmentation.
+
+        Parameters:
+        ----------
+        slab : np.ndarray
+            Consecutive planes of the segmentation along its first axis.
+        start : int
+            Index of the first plane of the slab.
+
+        Returns:
+        -------
+        LabelMarginalsAccumulator
+            The accumulator itself.
+        """
+        for label, marginals in compute_label_marginals(slab).items():
+            self._add(label, offset_slab_marginals(marginals, start, self.shape[0]))
+
+        return self
+
+    def merge(self, other):
+        """Adds the marginals accumulated by another accumulator of the same shape."""
+        for label, marginals in other.marginals.items():
+            self._add(label, marginals)
+
+        return self
+
+    def _add(self, label, marginals):
+        if label in self.marginals:
+            self.marginals[label] = [a + b for a, b in zip(self.marginals[label], marginals)]
+        else:
+            # labels are kept sorted, as `compute_label_marginals` returns them
+            self.marginals[label] = [m.copy() for m in marginals]
+            self.marginals = dict(sorted(self.marginals.items()))
 
 
 class TumorFeatures:
@@ -35,7 +167,10 @@ class TumorFeatures:
         Gets the slices that contain tumor regions in axial, coronal, and sagittal planes.
     """
 
-    def __init__(self, segmentation, spacing=(1, 1, 1), mapping_names=None, planes=None):
+    def __init__(
+        self, segmentation, spacing=(1, 1, 1), mapping_names=None, planes=None, bounding_box=None,
+        label_marginals=None, shape=None
+    ):
         """
         Constructs all the necessary attributes for the TumorAnalysis object.
 
@@ -49,18 +184,36 @@ class TumorFeatures:
             A tuple representing the voxel spacing of the image (default is (1, 1, 1)).
         mapping_names : dict, optional
             A dictionary to map segmentation values to names.
+        bounding_box : tuple, optional
+            Bounding box of the tumor (see `get_bounding_box`). Only the voxels inside it are scanned.
+        label_marginals : dict, optional
+            Per-axis marginal counts of each tumor label (see `compute_label_marginals`), if they were already
+            computed (e.g. slab by slab with a `LabelMarginalsAccumulator`). The segmentation can be None then.
+        shape : tuple, optional
+            Shape of the segmentation. Only required if the segmentation is not given.
         """
         self.center_mass_dict = None
         self.lesion_size = None
         self.tumor_location = None
         self.number_pixels = None
         self.tumor_slices = None
+        self.tumor_slices_per_plane = None
         self.position_tumor_slices = None
         self.segmentation = segmentation
         self.spacing = spacing
         self.mapping_names = mapping_names
         self.planes = planes if planes is not None else ["axial", "coronal", "sagittal"]
         self.tumor_centre_mass_per_label = {}
+        self.bounding_box = bounding_box
+        self._label_marginals = label_marginals
+        self.shape = segmentation.shape if segmentation is not None else shape
+
+    @property
+    def label_marginals(self):
+        """Per-axis marginal counts of each tumor label, computed once from the segmentation."""
+        if self._label_marginals is None:
+            self._label_marginals = compute_label_marginals(self.segmentation, self.bounding_box)
+        return self._label_marginals
 
     def count_tumor_pixels(self):
         """
@@ -71,14 +224,16 @@ class TumorFeatures:
         dict
             A dictionary with the counts of each unique value in the segmentation.
         """
-        if self.segmentation is None:
+        if self.shape is None:
             if self.mapping_names:
                 return {k.lower(): np.nan for k in self.mapping_names.values()}
             else:
                 return {}
 
-        unique, counts = np.unique(self.segmentation, return_counts=True)
-        pixels_dict = dict(zip(unique, counts))
+        pixels_dict = {label: int(marginals[0].sum()) for label, marginals in self.label_marginals.items()}
+        background = int(np.prod(self.shape)) - sum(pixels_dict.values())
+        if background > 0:
+            pixels_dict = {0: background, **pixels_dict}
 
         if self.mapping_names:
             pixels_dict = {self.mapping_names.get(k, k).lower(): v for k, v in pixels_dict.items()}
@@ -94,10 +249,11 @@ class TumorFeatures:
         dict
             A dictionary containing the lesion size.
         """
-        if self.segmentation is None:
+        if self.shape is None:
             return {"lesion_size": np.nan}
 
-        lesion_size = (self.segmentation > 0).sum() * np.prod(self.spacing)
+        lesion_voxels = sum(int(m[0].sum()) for label, m in self.label_marginals.items() if label > 0)
+        lesion_size = lesion_voxels * np.prod(self.spacing)
         return {"lesion_size": lesion_size}
 
     def get_tumor_center_mass(self, label=None):
@@ -114,67 +270,68 @@ class TumorFeatures:
         np.ndarray
             The center of mass coordinates adjusted by the voxel spacing.
         """
-        if self.segmentation is None:
+        if self.shape is None:
             logger.warning("An image is required to calculate the tumor center of mass. Assigning (nan, nan, nan)")
             return np.array([np.nan]) * 3
 
-        if label is not None and not np.any(self.segmentation == label):
-            return np.array([np.nan] * len(self.segmentation.shape))
+        # coordinate sums and voxel counts per axis for the requested label
+        shape = self.shape
+        if label is None:
+            marginals = [sum(m[axis] for m in self.label_marginals.values()) for axis in range(len(shape))]
+        elif label == 0:
+            # background: every voxel of the grid minus the tumor ones
+            tumor = [sum(m[axis] for m in self.label_marginals.values()) for axis in range(len(shape))]
+            marginals = [int(np.prod(shape)) // dim - t for dim, t in zip(shape, tumor)]
+        else:
+            marginals = self.label_marginals.get(label)
 
-        coordinates = np.argwhere(self.segmentation != 0) if label is None else np.argwhere(self.segmentation == label)
-        center_of_mass_mean = np.mean(coordinates, axis=0)
+        center_of_mass_mean = center_of_mass_from_marginals(marginals)
         return center_of_mass_mean * self.spacing
 
     def get_tumor_slices(self):
-        if self.segmentation is None:
-            return np.nan, np.nan, np.nan
-
-        axial_dim, coronal_dim, sagittal_dim = self.segmentation.shape
-        axial_tumor_slices, coronal_tumor_slices, sagittal_tumor_slices = [], [], []
-
-        # axial plane
-        for n, s in enumerate(range(axial_dim)):
-            slc = self.segmentation[s, :, :]
-            if Counter(slc.flatten()).get(0) != (coronal_dim * sagittal_dim):
-                axial_tumor_slices.append(n)
+        """
+        Gets the slices that contain tumor regions in axial, coronal, and sagittal planes.
 
-        # coronal plane
-        for n, s in enumerate(range(coronal_dim)):
-            slc = self.segmentation[:, s, :]
-            if Counter(slc.flatten()).get(0) != (axial_dim * sagittal_dim):
-                coronal_tumor_slices.append(n)
+        Returns:
+        -------
+        tuple
+            Three lists with the indexes of the slices containing tumor in each plane.
+        """
+        if self.shape is None:
+            return np.nan, np.nan, np.nan
 
-        # sagittal plane
-        for n, s in enumerate(range(sagittal_dim)):
-            slc = self.segmentation[:, :, s]
-            if Counter(slc.flatten()).get(0) != (axial_dim * coronal_dim):
-                sagittal_tumor_slices.append(n)
+        if self.tumor_slices_per_plane is None:
+            self.tumor_slices_per_plane = tuple(
+                np.flatnonzero(sum(m[axis] for m in self.label_marginals.values())).tolist()
+                for axis in range(len(self.shape))
+            )
 
-        return axial_tumor_slices, coronal_tumor_slices, sagittal_tumor_slices
+        return self.tumor_slices_per_plane
 
     def calculate_tumor_slices(self):
-        if self.segmentation is None:
-            return {f"{k}_tumor_slice": np.nan for k, v in dict(zip(self.planes, self.get_tumor_slices())).items()}
+        if self.shape is None:
+            return {f"{k}_tumor_slice": np.nan for k in self.planes}
 
         return {f"{k}_tumor_slice": len(v) for k, v in dict(zip(self.planes, self.get_tumor_slices())).items()}
 
     def calculate_position_tumor_slices(self):
         position_tumor_slices = {}
-        if self.segmentation is None:
-            position_tumor_slices.update({f"lower_{k}_tumor_slice": np.nan for k, v in
-                                          dict(zip(self.planes, self.get_tumor_slices())).items()})
-            position_tumor_slices.update({f"upper_{k}_tumor_slice": np.nan for k, v in
-                                          dict(zip(self.planes, self.get_tumor_slices())).items()})
+        if self.shape is None:
+            position_tumor_slices.update({f"lower_{k}_tumor_slice": np.nan for k in self.planes})
+            position_tumor_slices.update({f"upper_{k}_tumor_slice": np.nan for k in self.planes})
         else:
-            position_tumor_slices.update({f"lower_{k}_tumor_slice": np.min(v) for k, v in
-                                          dict(zip(self.planes, self.get_tumor_slices())).items()})
-            position_tumor_slices.update({f"upper_{k}_tumor_slice": np.max(v) for k, v in
-                                          dict(zip(self.planes, self.get_tumor_slices())).items()})
+            tumor_slices = dict(zip(self.planes, self.get_tumor_slices()))
+            position_tumor_slices.update(
+                {f"lower_{k}_tumor_slice": min(v) if v else np.nan for k, v in tumor_slices.items()}
+            )
+            position_tumor_slices.update(
+                {f"upper_{k}_tumor_slice": max(v) if v else np.nan for k, v in tumor_slices.items()}
+            )
 
         return position_tumor_slices
 
     def calculate_tumor_pixel(self):
-        if self.segmentation is None:
+        if self.shape is None:
             return {f"lesion_size_{k.lower()}": np.nan for k in self.mapping_names.values()}
 
         number_pixels = self.count_tumor_pixels()
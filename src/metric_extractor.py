@@ -6,8 +6,12 @@ from loguru import logger
 from pprint import pformat
 
 from src.utils.operations.file_operations import load_config_file
+from src.utils.operations.file_operations import export_table
+from src.utils.operations.file_operations import remove_streamed_table
 from src.utils.operations.misc_operations import configure_logging
+from src.utils.operations.volume_cache_operations import configure_volume_cache
 from src.metrics.main import extract_custom_metrics
+from src.metrics.main import extract_error_matrices
 from src.metrics.main import extract_pymia_metrics
 
 
@@ -22,16 +26,34 @@ if __name__ == "__main__":
     output_path = config["output_path"]
     Path(output_path).mkdir(parents=True, exist_ok=True)
     logger.info(f"Config file: \n{pformat(config)}")
+    configure_volume_cache(config.get("volume_cache_path"), config.get("volume_cache_max_gb", 20))
+
+    # partial results streamed while the extraction runs
+    stream_path = None
+    if config.get("stream_results", False):
+        stream_format = config.get("stream_format", "csv")
+        stream_path = f"{output_path}/extracted_information_{config['filename']}.partial.{stream_format}"
 
     if config["package"] == 'custom':
-        extracted_metrics = extract_custom_metrics(config_file=config)
+        extracted_metrics = extract_custom_metrics(config_file=config, stream_path=stream_path)
     elif config["package"] == 'pymia':
-        extracted_metrics = extract_pymia_metrics(config_file=config)
+        extracted_metrics = extract_pymia_metrics(config_file=config, stream_path=stream_path)
     else:
         extracted_metrics = pd.DataFrame()
 
     logger.info(f"Finishing metric extraction")
 
     # store information
-    extracted_metrics.to_csv(f"{output_path}/extracted_information_{config['filename']}.csv", index=False)
-    logger.info(f"Results exported to CSV file")
+    output_format = config.get("output_format", "csv")
+    export_table(
+        extracted_metrics, f"{output_path}/extracted_information_{config['filename']}.{output_format}", output_format
+    )
+    logger.info(f"Results exported to {output_format.upper()} file")
+
+    # the partial results are superseded by the final output
+    if stream_path:
+        remove_streamed_table(stream_path)
+
+    # per-subject error matrices used by the Segmentation Error Matrix page
+    if config.get("error_matrices", False):
+        extract_error_matrices(config_file=config, path=f"{output_path}/error_matrices_{config['filename']}.npz")
@@ -1,5 +1,11 @@
+import os
+
 import numpy as np
 
+from src.utils.operations.cache_operations import cache_key
+from src.utils.operations.cache_operations import files_signature
+from src.utils.sequences import iter_slabs
+
 
 # TODO: A bit isolated. May be ok, but if so, the filename should be changed. Other option could be to include it
 #  within the commons
@@ -26,35 +32,136 @@ def mistakes_per_class(ground_truth, predicted, unique_classes):
     return errors
 
 
-def mistakes_per_class_optim(ground_truth, predicted, unique_classes):
-    # Find all unique classes present in the ground truth data and predictions
+def smallest_unsigned_dtype(max_value: int):
+    """Returns the smallest unsigned integer dtype able to hold `max_value`."""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def encode_labels(volume, unique_classes) -> np.ndarray:
+    """
+    Maps every voxel to the index of its label in `unique_classes`, using the smallest possible integer dtype. Voxels
+    whose label is not in `unique_classes` get the extra code len(unique_classes).
+
+    Args:
+        volume: Label map.
+        unique_classes: Label values to encode.
+
+    Returns:
+        np.ndarray: Flat array with the code of each voxel.
+    """
+    classes = np.asarray(unique_classes)
+    num_classes = len(classes)
+    dtype = smallest_unsigned_dtype(num_classes)
+    volume = np.ravel(volume)
+    if volume.size == 0:
+        return np.zeros(0, dtype=dtype)
+
+    if volume.dtype.kind in "ui" and classes.dtype.kind in "ui" and (num_classes == 0 or classes.min() >= 0):
+        low, high = volume.min(), volume.max()
+        if low >= 0 and high < 65536:
+            # small non-negative labels: a lookup table translates them in a single gather
+            lut = np.full(max(int(high), int(classes.max(initial=0))) + 1, num_classes, dtype=dtype)
+            lut[classes] = np.arange(num_classes, dtype=dtype)
+            return lut[volume]
+
+    order = np.argsort(classes, kind="stable")
+    sorted_classes = classes[order]
+    index = np.clip(np.searchsorted(sorted_classes, volume), 0, max(num_classes - 1, 0))
+    found = sorted_classes[index] == volume if num_classes else np.zeros(volume.shape, dtype=bool)
+
+    return np.where(found, order[index] if num_classes else 0, num_classes).astype(dtype)
+
+
+def label_pair_histogram(codes_a, codes_b, num_codes: int, chunk_size: int = None) -> np.ndarray:
+    """
+    Counts how many voxels have each pair of codes with a single bincount over the encoded pairs a * num_codes + b.
+
+    Args:
+        codes_a: Codes in [0, num_codes) of the first volume (e.g. the ground truth).
+        codes_b: Codes in [0, num_codes) of the second volume (e.g. the prediction).
+        num_codes: Number of different codes.
+        chunk_size: If given, the volumes are processed in chunks of this number of voxels, bounding the memory used by
+                    the temporary arrays.
+
+    Returns:
+        np.ndarray: A (num_codes, num_codes) int64 matrix whose element [i, j] counts the voxels coded i in the first
+                    volume and j in the second one.
+    """
+    codes_a, codes_b = np.ravel(codes_a), np.ravel(codes_b)
+    dtype = smallest_unsigned_dtype(num_codes * num_codes)
+    step = chunk_size or max(codes_a.size, 1)
+
+    joint = np.zeros(num_codes * num_codes, dtype=np.int64)
+    for start in range(0, codes_a.size, step):
+        encoded = codes_a[start:start + step].astype(dtype) * dtype(num_codes)
+        encoded += codes_b[start:start + step].astype(dtype, copy=False)
+        joint += np.bincount(encoded, minlength=num_codes * num_codes)
+
+    return joint.reshape(num_codes, num_codes)
+
+
+def multiclass_confusion_matrix(ground_truth, predicted, unique_classes, chunk_size: int = None) -> np.ndarray:
+    """
+    Computes the full KxK confusion matrix (diagonal included) of two label maps in a single pass.
+
+    Args:
+        ground_truth: Ground truth label map.
+        predicted: Predicted label map.
+        unique_classes: The K label values defining the rows (ground truth) and columns (prediction) of the matrix.
+                        Voxels with other labels are not counted.
+        chunk_size: If given, the volumes are encoded and counted in chunks of this number of voxels, so volumes that
+                    do not fit in memory twice can still be processed.
+
+    Returns:
+        np.ndarray: The KxK int64 confusion matrix.
+    """
     num_classes = len(unique_classes)
-
-    # Initialize a zero matrix with the maximum range of classes
-    errors = np.zeros((num_classes, num_classes), dtype=np.int32)
-
-    # Convert ground truth and predicted to arrays for indexing
-    ground_truth = np.array(ground_truth)
-    predicted = np.array(predicted)
-
-    # Calculate indices where ground truth and prediction match
-    match_indices = ground_truth == predicted
-
-    # Calculate errors per class
-    for i, class_i in enumerate(unique_classes):
-        # Find indices where ground truth equals class_i
-        class_indices = ground_truth == class_i
-
-        # Count errors for each unique class predicted when ground truth is class_i
-        unique, counts = np.unique(predicted[class_indices & ~match_indices], return_counts=True)
-
-        # Map unique classes to their indices in unique_classes
-        unique_to_index = {class_j: index for index, class_j in enumerate(unique_classes)}
-
-        # Update errors matrix
-        for class_j, count in zip(unique, counts):
-            if class_j in unique_to_index:
-                errors[i, unique_to_index[class_j]] = count
+    ground_truth, predicted = np.ravel(ground_truth), np.ravel(predicted)
+    step = chunk_size or max(ground_truth.size, 1)
+
+    matrix = np.zeros((num_classes + 1, num_classes + 1), dtype=np.int64)
+    for start in range(0, ground_truth.size, step):
+        matrix += label_pair_histogram(
+            encode_labels(ground_truth[start:start + step], unique_classes),
+            encode_labels(predicted[start:start + step], unique_classes),
+            num_classes + 1
+        )
+
+    # the last row and column count the voxels with labels out of unique_classes
+    return matrix[:num_classes, :num_classes]
+
+
+def confusion_matrix_by_slabs(path_ground_truth: str, path_predicted: str, unique_classes, slab_size: int):
+    """
+    Out-of-core version of `multiclass_confusion_matrix` that reads both label maps in axial slabs (see `iter_slabs`)
+    and sums the confusion matrices of each pair of slabs, so only one slab of each file is in memory at a time.
+
+    Args:
+        path_ground_truth: Path to the ground truth NIfTI file.
+        path_predicted: Path to the predicted NIfTI file.
+        unique_classes: The K label values defining the rows (ground truth) and columns (prediction) of the matrix.
+        slab_size: Number of planes per slab.
+
+    Returns:
+        np.ndarray: The KxK int64 confusion matrix.
+    """
+    matrix = np.zeros((len(unique_classes), len(unique_classes)), dtype=np.int64)
+    slabs = zip(iter_slabs(path_ground_truth, slab_size), iter_slabs(path_predicted, slab_size))
+    for (_, ground_truth), (_, predicted) in slabs:
+        if ground_truth.shape != predicted.shape:
+            raise ValueError(f"The shapes of {path_ground_truth} and {path_predicted} do not match")
+        matrix += multiclass_confusion_matrix(ground_truth, predicted, unique_classes)
+
+    return matrix
+
+
+def mistakes_per_class_optim(ground_truth, predicted, unique_classes, chunk_size: int = None):
+    # Full confusion matrix from a single bincount, keeping only the mistakes (off-diagonal elements)
+    errors = multiclass_confusion_matrix(ground_truth, predicted, unique_classes, chunk_size).astype(np.int32)
+    np.fill_diagonal(errors, 0)
 
     return errors
 
@@ -66,3 +173,83 @@ def normalize_matrix_per_row(matrix):
     normalized_matrix = 100 * matrix / row_sums[:, np.newaxis]
     normalized_matrix[zero_sum_mask] = 0
     return normalized_matrix
+
+
+def sources_signature(paths: list) -> str:
+    """
+    Signature of the files a matrix was computed from, based on their size and modification time. The paths themselves
+    are left out, so the same files are recognised when they are reached from a different root.
+
+    Args:
+        paths: List of file paths (e.g. ground truth and prediction).
+
+    Returns:
+        str: The signature. It changes whenever any of the files is modified, added or removed.
+    """
+    return cache_key(sorted([os.path.basename(path), size, mtime] for path, size, mtime in files_signature(paths)))
+
+
+def save_error_matrices(path: str, labels: list, store: dict):
+    """
+    Saves the per-subject error matrices of several models in a single compressed .npz file.
+
+    Args:
+        path: Output file path.
+        labels: Label values defining the rows and columns of the matrices.
+        store: Dictionary mapping each model name to a dictionary of subject IDs to (signature, matrix) tuples.
+    """
+    arrays = {"labels": np.asarray(labels), "models": np.asarray(list(store), dtype=str)}
+    for n, (model, subjects) in enumerate(store.items()):
+        ids = sorted(subjects)
+        arrays[f"subjects_{n}"] = np.asarray(ids, dtype=str)
+        arrays[f"signatures_{n}"] = np.asarray([subjects[i][0] for i in ids], dtype=str)
+        arrays[f"matrices_{n}"] = np.asarray(
+            [subjects[i][1] for i in ids], dtype=np.int64
+        ).reshape(len(ids), len(labels), len(labels))
+
+    tmp_path = f"{path}.tmp.npz"
+    np.savez_compressed(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_error_matrices(path: str):
+    """
+    Loads the per-subject error matrices saved by `save_error_matrices`.
+
+    Args:
+        path: Path of the .npz file.
+
+    Returns:
+        tuple: The label values and a dictionary mapping each model name to a dictionary of subject IDs to
+               (signature, matrix) tuples. An empty store is returned if the file does not exist.
+    """
+    if not os.path.exists(path):
+        return [], {}
+
+    with np.load(path) as data:
+        labels = data["labels"].tolist()
+        store = {}
+        for n, model in enumerate(data["models"].tolist()):
+            store[model] = {
+                subject_id: (signature, matrix)
+                for subject_id, signature, matrix in zip(
+                    data[f"subjects_{n}"].tolist(), data[f"signatures_{n}"].tolist(), data[f"matrices_{n}"]
+                )
+            }
+
+    return labels, store
+
+
+def reorder_matrix(matrix, from_labels: list, to_labels: list):
+    """
+    Reorders the rows and columns of a matrix computed for `from_labels` to follow the order of `to_labels`.
+
+    Returns:
+        np.array: The reordered matrix, or None if both lists do not contain the same labels.
+    """
+    if sorted(from_labels) != sorted(to_labels):
+        return None
+
+    order = [from_labels.index(label) for label in to_labels]
+
+    return matrix[np.ix_(order, order)]
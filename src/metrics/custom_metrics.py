@@ -1,38 +1,61 @@
-from collections import Counter
-
 import numpy as np
 from numpy import logical_and as l_and
 from numpy import logical_not as l_not
-from scipy.spatial.distance import directed_hausdorff
+from scipy.ndimage import binary_erosion
+from scipy.ndimage import distance_transform_edt
+
+from src.metrics.confusion_matrix import label_pair_histogram
+
+
+class LazyOneHot:
+    """
+    Lazy one-hot view of a segmentation map. The binary mask of a region is only computed when it is accessed, so the
+    whole (R*Z*Y*X) stack never needs to be held in memory.
+
+    Attributes:
+    - segmentation (np.ndarray): Input segmentation map.
+    - labels (list): Label (or list of labels) of each region in the view.
+    """
+
+    def __init__(self, segmentation, labels):
+        self.segmentation = segmentation
+        self.labels = labels
+
+    @property
+    def shape(self):
+        return (len(self.labels),) + tuple(self.segmentation.shape)
 
+    def __len__(self):
+        return len(self.labels)
 
-def one_hot_encoding(segmentation, labels, skip_background=True):
+    def __getitem__(self, n):
+        label = self.labels[n]
+        if not isinstance(label, list):
+            return self.segmentation == label
+        return np.isin(self.segmentation, label)
+
+
+def one_hot_encoding(segmentation, labels, skip_background=True, lazy=False):
     """
     Perform one-hot encoding on a segmentation map.
 
+    The binary images are boolean, which takes 8 times less memory than an integer encoding. With `lazy=True` no mask is
+    computed upfront and a `LazyOneHot` view is returned instead, computing each region's mask on demand.
+
     Parameters:
     - segmentation (np.ndarray): Input segmentation map.
     - labels (list): List of labels to be encoded.
     - skip_background (bool): Flag to skip encoding for the background label (default=True).
+    - lazy (bool): Flag to return a lazy per-region view instead of a stacked array (default=False).
 
     Returns:
-    - one_hot_enc (np.ndarray): One-hot encoded segmentation map.
+    - one_hot_enc (np.ndarray | LazyOneHot): One-hot encoded segmentation map.
     """
+    labels = [i for i in labels if not (skip_background and i == 0)]
+    one_hot_enc = LazyOneHot(segmentation, labels)
 
-    # initialize list of binary segmentations
-    binary_images = []
-
-    for i in labels:
-        if skip_background and i == 0:
-            continue
-
-        if not isinstance(i, list):
-            binary_image = np.where(segmentation == i, 1, 0)
-        else:
-            binary_image = np.where(np.isin(segmentation, i), 1, 0)
-        binary_images.append(binary_image)
-
-    one_hot_enc = np.stack(binary_images)
+    if not lazy:
+        one_hot_enc = np.stack([one_hot_enc[n] for n in range(len(one_hot_enc))])
 
     return one_hot_enc
 
@@ -60,6 +83,86 @@ def calculate_confusion_matrix_elements(gt, seg):
     return tp, tn, fp, fn
 
 
+def as_integer_labels(volume: np.ndarray) -> np.ndarray:
+    """
+    Converts a label map stored as floating point (as some tools save segmentations) to integers when all its values
+    are integral, so it can be counted with a bincount. Other label maps are returned unchanged.
+
+    Parameters:
+    - volume (np.ndarray): Label map.
+
+    Returns:
+    - volume (np.ndarray): The label map with an integer type if it was integral, or the input otherwise.
+    """
+    if volume.dtype.kind != "f" or not volume.size:
+        return volume
+
+    if not (np.abs(volume.min()) < 2 ** 31 and np.abs(volume.max()) < 2 ** 31):
+        return volume  # non-finite or too large to be a label value
+    labels = volume.astype(np.int32)
+
+    return labels if np.array_equal(labels, volume) else volume
+
+
+def joint_label_histogram(ground_truth: np.ndarray, segmentation: np.ndarray):
+    """
+    Counts, in a single pass, how many voxels have each pair of (ground truth, prediction) labels.
+
+    Parameters:
+    - ground_truth (np.ndarray): Ground truth label map.
+    - segmentation (np.ndarray): Predicted label map.
+
+    Returns:
+    - values (np.ndarray): Label values indexing the rows and columns of the histogram.
+    - joint (np.ndarray): Matrix whose element [i, j] is the number of voxels labelled values[i] in the ground truth and
+      values[j] in the prediction.
+    """
+    gt, seg = as_integer_labels(np.ravel(ground_truth)), as_integer_labels(np.ravel(segmentation))
+
+    is_integer = gt.dtype.kind in "ui" and seg.dtype.kind in "ui"
+    if is_integer and gt.size and min(gt.min(), seg.min()) >= 0 and max(gt.max(), seg.max()) < 1024:
+        # small non-negative integer labels are already valid codes
+        n_values = int(max(gt.max(), seg.max())) + 1
+        values = np.arange(n_values)
+        codes_gt, codes_seg = gt, seg
+    else:
+        values, inverse = np.unique(np.concatenate([gt, seg]), return_inverse=True)
+        n_values = len(values)
+        codes_gt, codes_seg = inverse[:gt.size], inverse[gt.size:]
+
+    joint = label_pair_histogram(codes_gt, codes_seg, n_values)
+
+    return values, joint
+
+
+def confusion_matrix_elements_per_region(ground_truth: np.ndarray, segmentation: np.ndarray, labels: list) -> list:
+    """
+    Calculate the elements tp, tn, fp, and fn of several regions at once from the label maps, without building any
+    binary mask.
+
+    Parameters:
+    - ground_truth (np.ndarray): Ground truth label map.
+    - segmentation (np.ndarray): Predicted label map.
+    - labels (list): Label of each region. A region can be made of several labels by passing a list.
+
+    Returns:
+    - elements (list): A (tp, tn, fp, fn) tuple of floats per region.
+    """
+    values, joint = joint_label_histogram(ground_truth, segmentation)
+    total = joint.sum()
+
+    elements = []
+    for label in labels:
+        in_region = np.isin(values, label)
+        tp = float(joint[np.ix_(in_region, in_region)].sum())
+        fp = float(joint[np.ix_(~in_region, in_region)].sum())
+        fn = float(joint[np.ix_(in_region, ~in_region)].sum())
+        tn = float(total - tp - fp - fn)
+        elements.append((tp, tn, fp, fn))
+
+    return elements
+
+
 def calculate_metrics(
     ground_truth: np.ndarray,
     segmentation: np.ndarray,
@@ -68,48 +171,64 @@ def calculate_metrics(
     metrics: list,
     skip_background=True,
     spacing: np.array = np.array([1, 1, 1]),
+    labels: list = None,
 ) -> list:
     """
-     Calculate evaluation metrics (Jaccard index, Accuracy, Hausdorff, DICE score, Sensitivity, Specificity, and
-     Precision) for a segmentation compared to its ground truth.
+     Calculate evaluation metrics (Jaccard index, Accuracy, Hausdorff, HD95, average surface distance, DICE score,
+     Sensitivity, Specificity, and Precision) for a segmentation compared to its ground truth.
+
+     If `labels` is given, the ground truth and the segmentation are label maps and the confusion matrix elements of all
+     the regions are computed in a single pass. Otherwise, they are one-hot encoded stacks.
 
      Parameters:
-     - ground_truth (np.ndarray): Ground truth segmentation data. (R*Z*Y*X)
-     - segmentation (np.ndarray): Predicted segmentation data. (R*Z*Y*X)
+     - ground_truth (np.ndarray): Ground truth segmentation data. (Z*Y*X label map or R*Z*Y*X one-hot stack)
+     - segmentation (np.ndarray): Predicted segmentation data. (Z*Y*X label map or R*Z*Y*X one-hot stack)
      - patient (str): Identifier for the patient.
      - regions (list): List of regions to evaluate.
      - skip_background (bool): Flag to skip background region (default=True).
+     - labels (list): Label (or list of labels) of each region, aligned with `regions` (default=None).
 
      Returns:
      - metrics_list (list): List of dictionaries containing metrics for each region {metric:value}.
      """
     assert segmentation.shape == ground_truth.shape, "Predicted segmentation and ground truth do not have the same size"
 
-    if skip_background and "BKG" in regions:
-        regions.remove("BKG")
+    if labels is None:
+        if skip_background and "BKG" in regions:
+            regions.remove("BKG")
+        ground_truth_regions, segmentation_regions = ground_truth, segmentation
+        elements = [calculate_confusion_matrix_elements(ground_truth[n], segmentation[n]) for n in range(len(regions))]
+    else:
+        regions_labels = [(r, l) for r, l in zip(regions, labels) if not (skip_background and r == "BKG")]
+        regions, labels = [r for r, _ in regions_labels], [l for _, l in regions_labels]
+        ground_truth_regions = LazyOneHot(ground_truth, labels)
+        segmentation_regions = LazyOneHot(segmentation, labels)
+        elements = confusion_matrix_elements_per_region(ground_truth, segmentation, labels)
 
     metrics_list = []
     for n, r in enumerate(regions):
 
         output_metrics = dict(ID=patient, region=r)
 
-        # Ground truth and segmentation for i-th region
-        gt = ground_truth[n]
-        seg = segmentation[n]
+        # Ground truth and segmentation masks for i-th region, only built if a metric needs them
+        def region_masks(n=n):
+            return ground_truth_regions[n], segmentation_regions[n]
 
         #  cardinalities metrics tp, tn, fp, fn
-        tp, tn, fp, fn = calculate_confusion_matrix_elements(gt, seg)
+        tp, tn, fp, fn = elements[n]
 
         # compute selected metrics
         available_metrics = {
-            'haus': lambda: hausdorff_distance(gt, seg),
-            'dice': lambda: dice_score(tp, fp, fn, gt, seg),
+            'haus': lambda: hausdorff_distance(*region_masks(), spacing=spacing),
+            'hd95': lambda: hausdorff_distance(*region_masks(), spacing=spacing, percentile=95),
+            'assd': lambda: average_surface_distance(*region_masks(), spacing=spacing),
+            'dice': lambda: dice_score(tp, fp, fn),
             'sens': lambda: sensitivity(tp, fn),
             'spec': lambda: specificity(tn, fp),
             'accu': lambda: accuracy(tp, tn, fp, fn),
-            'jacc': lambda: jaccard_index(tp, fp, fn, gt, seg),
+            'jacc': lambda: jaccard_index(tp, fp, fn),
             'prec': lambda: precision(tp, fp),
-            'size': lambda: Counter(seg.flatten()).get(1, np.nan) * spacing.prod()
+            'size': lambda: (tp + fp if tp + fp > 0 else np.nan) * spacing.prod()
         }
         for metric in metrics:
             if metric in available_metrics:
@@ -180,7 +299,7 @@ def accuracy(tp: float, tn: float, fp: float, fn: float) -> float:
     return accu
 
 
-def dice_score(tp: float, fp: float, fn: float, gt: np.ndarray, seg: np.ndarray) -> float:
+def dice_score(tp: float, fp: float, fn: float) -> float:
     """
     Computes the Dice coefficient.
 
@@ -188,21 +307,20 @@ def dice_score(tp: float, fp: float, fn: float, gt: np.ndarray, seg: np.ndarray)
     - tp (float): Number of true positives.
     - fp (float): Number of false positives.
     - fn (float): Number of false negatives.
-    - gt (np.ndarray): Ground truth segmentation mask.
-    - seg (np.ndarray): Segmented mask.
 
     Returns:
     - dice (float): Dice coefficient.
     """
-    if np.sum(gt) == 0:
-        dice = 1 if np.sum(seg) == 0 else 0
+    # empty ground truth: perfect score only if the segmentation is empty too
+    if tp + fn == 0:
+        dice = 1 if fp == 0 else 0
     else:
         dice = 2 * tp / (2 * tp + fp + fn)
 
     return dice
 
 
-def jaccard_index(tp: float, fp: float, fn: float, gt: np.ndarray, seg: np.ndarray) -> float:
+def jaccard_index(tp: float, fp: float, fn: float) -> float:
     """
     Computes the Jaccard index.
 
@@ -210,34 +328,97 @@ def jaccard_index(tp: float, fp: float, fn: float, gt: np.ndarray, seg: np.ndarr
     - tp (float): Number of true positives.
     - fp (float): Number of false positives.
     - fn (float): Number of false negatives.
-    - gt (np.ndarray): Ground truth segmentation mask.
-    - seg (np.ndarray): Segmented mask.
 
     Returns:
     - jac (float): Jaccard index.
     """
-    if np.sum(gt) == 0:
-        jac = 1 if np.sum(seg) == 0 else 0
+    # empty ground truth: perfect score only if the segmentation is empty too
+    if tp + fn == 0:
+        jac = 1 if fp == 0 else 0
     else:
         jac = tp / (tp + fp + fn)
 
     return jac
 
 
-def hausdorff_distance(gt: np.ndarray, seg: np.ndarray) -> float:
+def surface_distances(gt: np.ndarray, seg: np.ndarray, spacing=None) -> tuple:
+    """
+    Computes the distances between the surfaces of two binary masks using Euclidean distance transforms.
+
+    Both masks are cropped to the bounding box of their union (plus a one voxel margin) before extracting their boundary
+    voxels, so only the region around the structures is processed.
+
+    Parameters:
+    - gt (np.ndarray): Ground truth segmentation mask.
+    - seg (np.ndarray): Segmented mask.
+    - spacing (np.ndarray): Voxel spacing in SimpleITK (x, y, z) order, as returned by `get_spacing` (default=None,
+      distances in voxels).
+
+    Returns:
+    - seg_to_gt (np.ndarray): Distance from each boundary voxel of the segmentation to the ground truth surface.
+    - gt_to_seg (np.ndarray): Distance from each boundary voxel of the ground truth to the segmentation surface.
+    """
+    gt, seg = np.asarray(gt, dtype=bool), np.asarray(seg, dtype=bool)
+
+    # crop to the bounding box of both masks
+    union = gt | seg
+    box = []
+    for axis in range(union.ndim):
+        indexes = np.flatnonzero(union.any(axis=tuple(a for a in range(union.ndim) if a != axis)))
+        box.append(slice(max(indexes[0] - 1, 0), indexes[-1] + 2))
+    gt, seg = gt[tuple(box)], seg[tuple(box)]
+
+    # boundary voxels of each mask
+    gt_border = gt & ~binary_erosion(gt)
+    seg_border = seg & ~binary_erosion(seg)
+
+    # numpy arrays are indexed (z, y, x)
+    sampling = None if spacing is None else np.asarray(spacing, dtype=float)[::-1]
+    seg_to_gt = distance_transform_edt(~gt_border, sampling=sampling)[seg_border]
+    gt_to_seg = distance_transform_edt(~seg_border, sampling=sampling)[gt_border]
+
+    return seg_to_gt, gt_to_seg
+
+
+def hausdorff_distance(gt: np.ndarray, seg: np.ndarray, spacing=None, percentile: float = 100) -> float:
     """
-    Computes the Hausdorff distance.
+    Computes the symmetric Hausdorff distance between the surfaces of both masks, in physical units if the spacing is
+    provided.
 
     Parameters:
     - gt (np.ndarray): Ground truth segmentation mask.
     - seg (np.ndarray): Segmented mask.
+    - spacing (np.ndarray): Voxel spacing in SimpleITK (x, y, z) order (default=None, distances in voxels).
+    - percentile (float): Percentile of the surface distances used (default=100). Use 95 for the HD95.
 
     Returns:
     - hd (float): Hausdorff distance.
     """
-    if np.sum(gt) == 0:
+    if not np.any(gt) or not np.any(seg):
         hd = np.nan
     else:
-        hd = directed_hausdorff(np.argwhere(seg), np.argwhere(gt))[0]
+        seg_to_gt, gt_to_seg = surface_distances(gt, seg, spacing)
+        hd = max(np.percentile(seg_to_gt, percentile), np.percentile(gt_to_seg, percentile))
 
     return hd
+
+
+def average_surface_distance(gt: np.ndarray, seg: np.ndarray, spacing=None) -> float:
+    """
+    Computes the average symmetric surface distance between both masks, in physical units if the spacing is provided.
+
+    Parameters:
+    - gt (np.ndarray): Ground truth segmentation mask.
+    - seg (np.ndarray): Segmented mask.
+    - spacing (np.ndarray): Voxel spacing in SimpleITK (x, y, z) order (default=None, distances in voxels).
+
+    Returns:
+    - assd (float): Average symmetric surface distance.
+    """
+    if not np.any(gt) or not np.any(seg):
+        assd = np.nan
+    else:
+        seg_to_gt, gt_to_seg = surface_distances(gt, seg, spacing)
+        assd = (seg_to_gt.sum() + gt_to_seg.sum()) / (len(seg_to_gt) + len(gt_to_seg))
+
+    return assd
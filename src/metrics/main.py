@@ -1,6 +1,6 @@
 import os
+from functools import partial
 from pathlib import Path
-import SimpleITK as sitk
 import numpy as np
 import pandas as pd
 from loguru import logger
@@ -14,14 +14,22 @@ from colorama import Fore
 from loguru import logger
 from pprint import pformat
 
+from src.metrics.confusion_matrix import confusion_matrix_by_slabs
+from src.metrics.confusion_matrix import load_error_matrices
+from src.metrics.confusion_matrix import mistakes_per_class_optim
+from src.metrics.confusion_matrix import save_error_matrices
+from src.metrics.confusion_matrix import sources_signature
 from src.metrics.custom_metrics import calculate_metrics
-from src.metrics.custom_metrics import one_hot_encoding
 from src.utils.operations.file_operations import load_config_file
 from src.utils.operations.file_operations import ls_dirs
+from src.utils.operations.file_operations import StreamingTableWriter
 from src.utils.operations.misc_operations import fancy_print
 from src.utils.operations.misc_operations import fancy_tqdm
+from src.utils.operations.parallel_operations import map_subjects
 from src.utils.sequences import get_spacing
+from src.utils.sequences import load_nii
 from src.utils.sequences import load_nii_by_id
+from src.utils.sequences import load_subject
 
 
 """
@@ -29,8 +37,26 @@ CUSTOM METRICS
 """
 
 
+def get_evaluation_groups(models: dict, subject_major: bool = False) -> list:
+    """
+    Groups the models whose predictions are evaluated together in a single pass over the subjects.
+
+    Args:
+        models: Dictionary mapping model names to the path of their predictions.
+        subject_major: If True, all the models are evaluated together, so the ground truth of each subject is loaded
+                       only once and scored against every prediction. Otherwise, models are evaluated one by one.
+
+    Returns:
+        list: A list of dictionaries of models.
+    """
+    if subject_major:
+        return [models]
+
+    return [{model_name: path_predictions} for model_name, path_predictions in models.items()]
+
+
 @logger.catch
-def extract_custom_metrics(config_file) -> pd.DataFrame:
+def extract_custom_metrics(config_file, stream_path: str = None) -> pd.DataFrame:
     label_names, numeric_label = (
         list(config_file["labels"].keys()),
         list(config_file["labels"].values()),
@@ -40,61 +66,162 @@ def extract_custom_metrics(config_file) -> pd.DataFrame:
     path_ground_truth_dataset = config_file["data_path"]
     metrics_to_extract = [key for key, value in config_file["metrics"].items() if value]
     patients_list = ls_dirs(path_ground_truth_dataset)
+    n_workers = config_file.get("n_workers", 1)
 
-    # initializing output metrics
-    raw_metrics = pd.DataFrame()
+    # stream the rows of each subject to disk as they are produced
+    writer = open_stream_writer(config_file, stream_path)
 
     # load paths to predictions
     models = config_file["model_predictions_paths"]
-    for model_name, path_predictions in models.items():
-        fancy_print(f"\nStarting metric extraction for model {model_name}", Fore.LIGHTMAGENTA_EX, "✨")
-        logger.info(f"Starting metric extraction for model {model_name}")
+    subjects_metrics = {subject_id: {} for subject_id in patients_list}
+    for group in get_evaluation_groups(models, config_file.get("subject_major", False)):
+        fancy_print(f"\nStarting metric extraction for model {', '.join(group)}", Fore.LIGHTMAGENTA_EX, "✨")
+        logger.info(f"Starting metric extraction for model {', '.join(group)}")
 
         # loop over all the elements in the root folder
         with fancy_tqdm(total=len(patients_list), desc=f"{Fore.CYAN}Progress", leave=True) as pbar:
-            for n, ID in enumerate(patients_list):
+            subjects = map_subjects(
+                compute_subject_custom_metrics,
+                patients_list,
+                n_workers,
+                loader=partial(
+                    load_subject_segmentations, path_ground_truth=path_ground_truth_dataset, predictions=group
+                ),
+                n_prefetch=config_file.get("prefetch_subjects", 2),
+                path_ground_truth=path_ground_truth_dataset,
+                predictions=group,
+                label_names=label_names,
+                numeric_label=numeric_label,
+                metrics_to_extract=metrics_to_extract
+            )
+            for n, (ID, subject_metrics) in enumerate(subjects):
                 pbar.set_postfix_str(f"{Fore.CYAN}Current patient: {Fore.LIGHTBLUE_EX}{ID}{Fore.CYAN}")
                 pbar.update(1)
                 if n % 10 == 0 and n > 0:
                     fancy_print(f"Processed {n} patients", Fore.CYAN, "🔹")
 
-                # read ground truth segmentation and prediction
-                gt = load_nii_by_id(root=path_ground_truth_dataset, patient_id=ID, as_array=True)
-                pred = load_nii_by_id(root=path_predictions, patient_id=ID, seq="_pred", as_array=True)
-                spacing = get_spacing(load_nii_by_id(path_predictions, ID, seq="_pred"))
+                subjects_metrics[ID].update(subject_metrics or {})
+                if writer:
+                    writer.write([{**m, "model": model} for model, ms in (subject_metrics or {}).items() for m in ms])
 
-                # making the segmentations binary (one hot encoding for each region)
-                gt = one_hot_encoding(gt, numeric_label)
-                pred = one_hot_encoding(pred, numeric_label)
+        logger.info(f"Finishing metric extraction for model {', '.join(group)}")
 
-                # compute metrics
-                metrics = calculate_metrics(
-                    ground_truth=gt,
-                    segmentation=pred,
-                    patient=ID,
-                    regions=label_names,
-                    metrics=metrics_to_extract,
-                    spacing=spacing
-                )
+    if writer:
+        writer.close()
 
-                # from list of dict to dataframe
-                patient_info_df = pd.DataFrame(metrics)
+    # buffer the rows ordered by model and subject, adding the model info, and build the output DataFrame once
+    rows = [
+        {**region_metrics, "model": model_name}
+        for model_name in models
+        for ID in patients_list
+        for region_metrics in subjects_metrics[ID].get(model_name) or []
+    ]
+    raw_metrics = pd.DataFrame(rows)
 
-                # add model info
-                patient_info_df["model"] = model_name
+    return raw_metrics
 
-                # Add info to the main df
-                raw_metrics = pd.concat([raw_metrics, patient_info_df], ignore_index=True)
 
-        logger.info(f"Finishing metric extraction for model {model_name}")
+def open_stream_writer(config_file: dict, stream_path: str = None):
+    """
+    Opens the writer used to stream the rows to disk while the metrics are extracted.
+
+    Returns:
+        StreamingTableWriter: The writer, or None if no stream path is given.
+    """
+    if not stream_path:
+        return None
+
+    return StreamingTableWriter(
+        stream_path, config_file.get("stream_format", "csv"), config_file.get("stream_batch_size", 10)
+    )
 
-    return raw_metrics
+
+def compute_subject_custom_metrics(
+    subject_id: str,
+    path_ground_truth: str,
+    predictions: dict,
+    label_names: list,
+    numeric_label: list,
+    metrics_to_extract: list,
+    preloaded: tuple = None
+) -> dict:
+    """
+    Computes the custom metrics of a subject for several models, loading its ground truth only once.
+
+    Args:
+        subject_id: The ID of the subject.
+        path_ground_truth: Path to the dataset containing the ground truth segmentations.
+        predictions: Dictionary mapping model names to the path of their predictions.
+        label_names: Name of each region.
+        numeric_label: Label (or list of labels) of each region.
+        metrics_to_extract: Metrics to compute.
+        preloaded: Segmentations already read by `load_subject_segmentations`. They are read from disk if not given.
+
+    Returns:
+        dict: The list of metrics per region of each model. Models whose prediction could not be evaluated are skipped.
+    """
+    logger.info(f"Processing subject: {subject_id}")
+
+    # read ground truth segmentation once for all the models
+    gt, preloaded_predictions = preloaded or load_subject_segmentations(subject_id, path_ground_truth, {})
+    if gt is None:
+        raise FileNotFoundError(f"Ground truth segmentation of subject {subject_id} could not be read")
+
+    subject_metrics = {}
+    for model_name, path_predictions in predictions.items():
+        try:
+            # read prediction (each file is decoded only once)
+            pred, pred_metadata = preloaded_predictions.get(model_name) or load_subject(
+                root=path_predictions, patient_id=subject_id, sequences=["_pred"]
+            )
+            pred = pred.get("pred")
+            spacing = get_spacing(pred_metadata.get("pred"))
+
+            # compute metrics straight from the label maps (no one hot encoding needed)
+            subject_metrics[model_name] = calculate_metrics(
+                ground_truth=gt,
+                segmentation=pred,
+                patient=subject_id,
+                regions=list(label_names),
+                metrics=metrics_to_extract,
+                spacing=spacing,
+                labels=numeric_label
+            )
+        except Exception as e:
+            logger.error(f"Subject {subject_id} could not be evaluated for model {model_name}: {e}")
+
+    return subject_metrics
+
+
+def load_subject_segmentations(subject_id: str, path_ground_truth: str, predictions: dict) -> tuple:
+    """
+    Reads the ground truth of a subject and its predictions for several models.
+
+    Args:
+        subject_id: The ID of the subject.
+        path_ground_truth: Path to the dataset containing the ground truth segmentations.
+        predictions: Dictionary mapping model names to the path of their predictions.
+
+    Returns:
+        tuple: The ground truth array (None if it could not be read) and a dictionary with the arrays and metadata
+               returned by `load_subject` for each model.
+    """
+    gt = load_nii_by_id(root=path_ground_truth, patient_id=subject_id, as_array=True)
+    preds = {
+        model_name: load_subject(root=path_predictions, patient_id=subject_id, sequences=["_pred"])
+        for model_name, path_predictions in predictions.items()
+    }
+
+    return gt, preds
 
 
 """
 PYMIA METRICS
 """
 
+# pymia evaluators owned by the current process (one per worker when running in parallel)
+_PROCESS_EVALUATORS = {}
+
 
 def post_process_metrics(df_metrics):
     # Convert all metrics to a DataFrame
@@ -106,19 +233,23 @@ def post_process_metrics(df_metrics):
     return output
 
 
-def perform_evaluation(pymia_evaluator, path_gt, path_pred, subject):
+def perform_evaluation(pymia_evaluator, path_gt, path_pred, subject, ground_truth=None):
     path_gt = os.path.join(str(path_gt), subject, f"{subject}_seg.nii.gz")
     path_pred = os.path.join(str(path_pred), subject, f"{subject}_pred.nii.gz")
 
     try:
-        if not os.path.exists(path_gt):
+        if ground_truth is None and not os.path.exists(path_gt):
             raise FileNotFoundError(f'Ground truth file "{path_gt}" does not exist')
 
         if not os.path.exists(path_pred):
             raise FileNotFoundError(f'Prediction file "{path_pred}" does not exist')
 
-        ground_truth = sitk.ReadImage(path_gt)
-        prediction = sitk.ReadImage(path_pred)
+        # the ground truth can be read beforehand to score several predictions against it
+        if ground_truth is None:
+            ground_truth = load_nii(path_gt)
+        prediction = load_nii(path_pred)
+        if ground_truth is None or prediction is None:
+            raise RuntimeError(f"Segmentations of subject {subject} could not be read")
         pymia_evaluator.evaluate(prediction, ground_truth, subject)
     except Exception as e:
         print(f"{subject} -> {e}")
@@ -126,9 +257,47 @@ def perform_evaluation(pymia_evaluator, path_gt, path_pred, subject):
     return pymia_evaluator
 
 
-def aggregate_results(pymia_evaluator, model_name):
+def get_process_evaluator(metrics_to_extract: list, labels: dict):
+    """
+    Returns the pymia evaluator owned by the current process, creating it the first time it is requested. Each worker
+    of the pool keeps its own evaluator, so no state is shared between processes.
+    """
+    key = (tuple(metrics_to_extract), tuple(labels.items()))
+    if key not in _PROCESS_EVALUATORS:
+        metrics = instantiate_pymia_metrics(metrics_to_extract)
+        _PROCESS_EVALUATORS[key] = eval_.SegmentationEvaluator(metrics, labels)
+
+    return _PROCESS_EVALUATORS[key]
+
+
+def evaluate_subject_pymia(subject_id, path_ground_truth, predictions, metrics_to_extract, labels):
+    """
+    Evaluates a single subject for several models with the evaluator of the current process. The ground truth is read
+    only once and scored against every prediction.
+
+    Returns:
+        dict: The pymia results of each model as (ID, region, metric, value) tuples.
+    """
+    logger.info(f"Processing subject: {subject_id}")
+
+    evaluator = get_process_evaluator(metrics_to_extract, labels)
+
+    # read the ground truth once for all the models
+    path_gt = os.path.join(str(path_ground_truth), subject_id, f"{subject_id}_seg.nii.gz")
+    ground_truth = load_nii(path_gt) if os.path.exists(path_gt) else None
+
+    subject_results = {}
+    for model_name, path_predictions in predictions.items():
+        evaluator.clear()
+        evaluator = perform_evaluation(evaluator, path_ground_truth, path_predictions, subject_id, ground_truth)
+        subject_results[model_name] = [(r.id_, r.label, r.metric, r.value) for r in evaluator.results]
+
+    return subject_results
+
+
+def aggregate_results(results, model_name):
     raw_metrics = []
-    for result in pymia_evaluator.results:
+    for result in results:
         result_dict = {
             "ID": result.id_,
             "region": result.label,
@@ -141,7 +310,7 @@ def aggregate_results(pymia_evaluator, model_name):
     return raw_metrics
 
 
-def compute_statistics(pymia_evaluator, config, model_name):
+def compute_statistics(results, config, model_name):
     functions = {
         'MEAN': np.mean,
         'MEDIAN': np.median,
@@ -156,13 +325,14 @@ def compute_statistics(pymia_evaluator, config, model_name):
         'CI_97.5': lambda x: np.percentile(x, 97.5),
     }
     CSVStatisticsWriter(f"{config['output_path']}/stats/{model_name}/{config['filename']}.csv", delimiter=',',
-                        functions=functions).write(pymia_evaluator.results)
+                        functions=functions).write(results)
 
 
 def instantiate_pymia_metrics(selected_metrics: list):
     # Dict of available pymia metrics
     metric_map = {
         'haus': (metric.HausdorffDistance, {'percentile': 100}),
+        'hd95': (metric.HausdorffDistance, {'percentile': 95}),
         'dice': (metric.DiceCoefficient, {}),
         'sens': (metric.Sensitivity, {}),
         'spec': (metric.Specificity, {}),
@@ -189,7 +359,7 @@ def instantiate_pymia_metrics(selected_metrics: list):
     return create_metrics(selected_metrics)
 
 
-def extract_pymia_metrics(config_file):
+def extract_pymia_metrics(config_file, stream_path: str = None):
     labels, processed_labels = config_file["labels"], {}
     for key, value in labels.items():
         if isinstance(value, list):
@@ -200,39 +370,173 @@ def extract_pymia_metrics(config_file):
     path_ground_truth_dataset = config_file["data_path"]
     metrics_to_extract = [key for key, value in config_file["metrics"].items() if value]
     patients_list = ls_dirs(path_ground_truth_dataset)
+    n_workers = config_file.get("n_workers", 1)
 
-    # metrics to extract
-    metrics = instantiate_pymia_metrics(metrics_to_extract)
-
-    # initializing output metrics
-    evaluator = eval_.SegmentationEvaluator(metrics, processed_labels)
+    # stream the long-format rows of each subject to disk as they are produced
+    writer = open_stream_writer(config_file, stream_path)
 
     # load paths to predictions
     models = config_file["model_predictions_paths"]
-    for model_name, path_predictions in models.items():
-        fancy_print(f"\nStarting metric extraction for model {model_name}", Fore.LIGHTMAGENTA_EX, "✨")
-        logger.info(f"Starting metric extraction for model {model_name}")
+    subjects_results = {subject_id: {} for subject_id in patients_list}
+    for group in get_evaluation_groups(models, config_file.get("subject_major", False)):
+        fancy_print(f"\nStarting metric extraction for model {', '.join(group)}", Fore.LIGHTMAGENTA_EX, "✨")
+        logger.info(f"Starting metric extraction for model {', '.join(group)}")
 
-        # loop over all the elements in the root folder
+        # loop over all the elements in the root folder, each worker evaluates its subjects with its own evaluator
         with fancy_tqdm(total=len(patients_list), desc=f"{Fore.CYAN}Progress", leave=True) as pbar:
-            for n, subject_id in enumerate(patients_list):
-
+            subjects = map_subjects(
+                evaluate_subject_pymia,
+                patients_list,
+                n_workers,
+                path_ground_truth=path_ground_truth_dataset,
+                predictions=group,
+                metrics_to_extract=metrics_to_extract,
+                labels=processed_labels
+            )
+            for n, (subject_id, subject_results) in enumerate(subjects):
                 pbar.set_postfix_str(f"{Fore.CYAN}Current patient: {Fore.LIGHTBLUE_EX}{subject_id}{Fore.CYAN}")
                 pbar.update(1)
                 if n % 10 == 0 and n > 0:
                     fancy_print(f"Processed {n} patients", Fore.CYAN, "🔹")
 
-                logger.info(f"Processing subject: {subject_id}")
-                evaluator = perform_evaluation(evaluator, path_ground_truth_dataset, path_predictions, subject_id)
+                subjects_results[subject_id].update(subject_results or {})
+                if writer:
+                    writer.write([
+                        row
+                        for model_name, results in (subject_results or {}).items()
+                        for row in aggregate_results([eval_.Result(*result) for result in results], model_name)
+                    ])
 
-            # accumulate the results for each of the models
-            raw_metrics = aggregate_results(evaluator, model_name)
+    if writer:
+        writer.close()
 
-            if config_file.get("calculate_stats", None):
-                Path(os.path.join(config_file['output_path'], 'stats', f'{model_name}')).mkdir(parents=True, exist_ok=True)
-                compute_statistics(evaluator, config_file, model_name)
-            evaluator.clear()
+    # accumulate the results for each of the models keeping the order of the subjects
+    raw_metrics = []
+    for model_name in models:
+        results = [
+            eval_.Result(*result)
+            for subject_id in patients_list
+            for result in subjects_results[subject_id].get(model_name, [])
+        ]
+        raw_metrics.extend(aggregate_results(results, model_name))
+
+        if config_file.get("calculate_stats", None):
+            Path(os.path.join(config_file['output_path'], 'stats', f'{model_name}')).mkdir(parents=True, exist_ok=True)
+            compute_statistics(results, config_file, model_name)
 
     extracted_metrics = post_process_metrics(raw_metrics)
 
     return extracted_metrics
+
+
+"""
+ERROR MATRICES
+"""
+
+
+def extract_error_matrices(config_file, path: str):
+    """
+    Computes the error matrix (mistakes per class) of every subject and model and stores them in a .npz file, so the
+    Segmentation Error Matrix page can aggregate them without reading the segmentations. Subjects whose ground truth
+    and prediction did not change since the previous run are reused from the existing file.
+
+    Args:
+        config_file: Metric extraction configuration.
+        path: Path of the .npz file.
+    """
+    labels = [value for value in config_file["labels"].values() if not isinstance(value, list)]
+    path_ground_truth_dataset = config_file["data_path"]
+    patients_list = ls_dirs(path_ground_truth_dataset)
+    models = config_file["model_predictions_paths"]
+
+    # previous matrices are only reusable if they were computed for the same labels
+    stored_labels, store = load_error_matrices(path)
+    if stored_labels != labels:
+        store = {}
+    store = {model: store.get(model, {}) for model in models}
+
+    fancy_print(f"\nStarting error matrices extraction for model {', '.join(models)}", Fore.LIGHTMAGENTA_EX, "✨")
+    logger.info(f"Starting error matrices extraction for model {', '.join(models)}")
+    with fancy_tqdm(total=len(patients_list), desc=f"{Fore.CYAN}Progress", leave=True) as pbar:
+        subjects = map_subjects(
+            compute_subject_error_matrices,
+            patients_list,
+            config_file.get("n_workers", 1),
+            path_ground_truth=path_ground_truth_dataset,
+            predictions=models,
+            labels=labels,
+            slab_size=config_file.get("slab_size"),
+            stored_signatures={
+                model: {subject_id: entry[0] for subject_id, entry in subjects.items()}
+                for model, subjects in store.items()
+            }
+        )
+        for subject_id, subject_matrices in subjects:
+            pbar.set_postfix_str(f"{Fore.CYAN}Current patient: {Fore.LIGHTBLUE_EX}{subject_id}{Fore.CYAN}")
+            pbar.update(1)
+            for model_name, entry in (subject_matrices or {}).items():
+                store[model_name][subject_id] = entry
+
+    # subjects no longer present in the dataset are dropped
+    store = {model: {s: e for s, e in subjects.items() if s in patients_list} for model, subjects in store.items()}
+    save_error_matrices(path, labels, store)
+    logger.info(f"Error matrices stored in {path}")
+
+
+def compute_subject_error_matrices(
+    subject_id: str,
+    path_ground_truth: str,
+    predictions: dict,
+    labels: list,
+    stored_signatures: dict,
+    slab_size: int = None
+) -> dict:
+    """
+    Computes the error matrices of a subject for several models, loading its ground truth only once (and only if at
+    least one of the matrices must be recomputed).
+
+    If `slab_size` is given, the segmentations are never fully loaded: each matrix is accumulated from pairs of axial
+    slabs instead (see `confusion_matrix_by_slabs`).
+
+    Args:
+        subject_id: The ID of the subject.
+        path_ground_truth: Path to the dataset containing the ground truth segmentations.
+        predictions: Dictionary mapping model names to the path of their predictions.
+        labels: Label values defining the rows and columns of the matrices.
+        stored_signatures: Signatures of the matrices already stored, per model and subject.
+        slab_size: Number of planes per slab in the out-of-core mode. The whole volumes are loaded if None.
+
+    Returns:
+        dict: The (signature, matrix) tuple of each model whose matrix changed.
+    """
+    path_gt = f"{path_ground_truth}/{subject_id}/{subject_id}_seg.nii.gz"
+    gt, subject_matrices = None, {}
+    for model_name, path_predictions in predictions.items():
+        path_pred = f"{path_predictions}/{subject_id}/{subject_id}_pred.nii.gz"
+        signature = sources_signature([path_gt, path_pred])
+        if stored_signatures.get(model_name, {}).get(subject_id) == signature:
+            continue
+
+        if slab_size:
+            if not os.path.exists(path_gt):
+                raise FileNotFoundError(f"Ground truth segmentation of subject {subject_id} could not be read")
+            if not os.path.exists(path_pred):
+                logger.error(f"Subject {subject_id} has no readable prediction for model {model_name}")
+                continue
+            errors = confusion_matrix_by_slabs(path_gt, path_pred, labels, int(slab_size)).astype(np.int32)
+            np.fill_diagonal(errors, 0)
+            subject_matrices[model_name] = (signature, errors)
+            continue
+
+        if gt is None:
+            gt = load_nii_by_id(root=path_ground_truth, patient_id=subject_id, as_array=True)
+            if gt is None:
+                raise FileNotFoundError(f"Ground truth segmentation of subject {subject_id} could not be read")
+        pred = load_nii_by_id(root=path_predictions, patient_id=subject_id, seq="_pred", as_array=True)
+        if pred is None:
+            logger.error(f"Subject {subject_id} has no readable prediction for model {model_name}")
+            continue
+
+        subject_matrices[model_name] = (signature, mistakes_per_class_optim(gt, pred, labels))
+
+    return subject_matrices
@@ -0,0 +1,325 @@
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+
+import numpy as np
+from SimpleITK import GetImageFromArray
+from SimpleITK import WriteImage
+
+from src.features.sketches import IntensitySketch
+from src.features.sketches import SUMMARY_PERCENTILES
+from src.features.sketches import merge_intensity_sketches
+
+try:
+    import resource
+except ImportError:  # not available on Windows, where the peak memory is not reported
+    resource = None
+
+SEQUENCES = ("t1", "t1ce", "t2", "flair")
+
+
+def generate_synthetic_subject(path: str, subject_id: str, shape: tuple, spacing: tuple, labels: dict, seed: int):
+    """
+    Writes a synthetic BraTS-like subject: four MRI sequences with an ellipsoidal brain, a ground truth segmentation
+    with nested tumor regions and a prediction that slightly misses it.
+
+    The files follow the layout expected by the extractors: '<path>/images/<ID>/<ID>_<seq>.nii.gz' and
+    '<path>/predictions/<ID>/<ID>_pred.nii.gz'.
+
+    Args:
+        path: Root folder of the synthetic dataset.
+        subject_id: The ID of the subject.
+        shape: Shape of the volumes (z, y, x).
+        spacing: Voxel spacing (x, y, z), as stored in the NIfTI header.
+        labels: Mapping of label names to their values. The first three non-background labels are used for the
+                edema, enhancing tumor and necrosis, from the outside in.
+        seed: Seed of the random generator, so the same subject is always generated.
+    """
+    rng = np.random.default_rng(seed)
+    zz, yy, xx = np.ogrid[tuple(slice(0, n) for n in shape)]
+    center, radius = np.array(shape) / 2, np.array(shape) * rng.uniform(0.36, 0.44, size=3)
+
+    def save(array, file_path):
+        image = GetImageFromArray(array)
+        image.SetSpacing(tuple(float(s) for s in spacing))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        WriteImage(image, file_path)
+
+    # sequences: noisy intensities inside the brain, with a different contrast in each one
+    brain = ((zz - center[0]) / radius[0]) ** 2 + ((yy - center[1]) / radius[1]) ** 2 + \
+            ((xx - center[2]) / radius[2]) ** 2 < 1
+    for n, seq in enumerate(SEQUENCES):
+        volume = rng.normal(400 + 150 * n, 80 + 20 * n, size=shape) * brain
+        save(volume.clip(0).astype(np.int16), f"{path}/images/{subject_id}/{subject_id}_{seq}.nii.gz")
+        del volume
+
+    # segmentation: nested spheres inside the brain
+    tumor_labels = [value for value in labels.values() if value != 0][:3]
+    tumor_center = center + rng.uniform(-0.3, 0.3, size=3) * radius
+    distance = (zz - tumor_center[0]) ** 2 + (yy - tumor_center[1]) ** 2 + (xx - tumor_center[2]) ** 2
+    tumor_radius = min(shape) * rng.uniform(0.12, 0.18)
+    segmentation = np.zeros(shape, dtype=np.uint8)
+    for label, fraction in zip(tumor_labels, (1, 0.6, 0.3)):
+        segmentation[distance < (tumor_radius * fraction) ** 2] = label
+    segmentation *= brain
+    save(segmentation, f"{path}/images/{subject_id}/{subject_id}_seg.nii.gz")
+
+    # prediction: the segmentation shifted a few voxels
+    prediction = np.roll(segmentation, tuple(rng.integers(1, 4, size=3)), axis=(0, 1, 2))
+    save(prediction, f"{path}/predictions/{subject_id}/{subject_id}_pred.nii.gz")
+
+
+def prepare_synthetic_dataset(config: dict) -> list:
+    """
+    Generates the synthetic dataset described in the benchmark config, unless it already exists with the same
+    settings (a manifest with them is stored next to the data).
+
+    Args:
+        config: Config file 'benchmark.yml'.
+
+    Returns:
+        list: The IDs of the synthetic subjects.
+    """
+    path = config["data_path"]
+    settings = {key: config[key] for key in ("shape", "spacing", "n_subjects", "seed", "labels")}
+    subjects = [f"SYNTH_{n:03d}" for n in range(config["n_subjects"])]
+
+    manifest_path = os.path.join(path, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as file:
+            if json.load(file) == settings:
+                return subjects
+
+    for n, subject_id in enumerate(subjects):
+        generate_synthetic_subject(
+            path, subject_id, tuple(config["shape"]), tuple(config["spacing"]), config["labels"], config["seed"] + n
+        )
+    with open(manifest_path, "w") as file:
+        json.dump(settings, file)
+
+    return subjects
+
+
+def memory_usage_mb() -> tuple:
+    """
+    Current and peak resident set size (RSS) of the current process in megabytes.
+
+    On Linux they are read from /proc, since the peak reported by `getrusage` survives the exec of a spawned process
+    and would include the memory of its parent. Elsewhere the peak comes from `getrusage` and the current RSS is not
+    available.
+
+    Returns:
+        tuple: The current and the peak RSS. Each of them is None if it cannot be measured.
+    """
+    try:
+        with open("/proc/self/status", "r") as file:
+            status = dict(line.split(":", 1) for line in file if ":" in line)
+        return int(status["VmRSS"].split()[0]) / 1024, int(status["VmHWM"].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        pass
+
+    if resource is None:
+        return None, None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes and the rest of platforms kilobytes
+    return None, peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def reset_peak_memory():
+    """Resets the peak RSS of the current process to its current RSS, where the platform allows it (Linux)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def time_benchmark(setup, run, subjects: list, repetitions: int) -> dict:
+    """
+    Times a benchmark on every subject. The inputs of each subject are prepared by `setup` outside the timed region.
+
+    Args:
+        setup: Function called as setup(subject_id) that returns the inputs of the benchmark.
+        run: Function called as run(inputs) that performs the work being measured.
+        subjects: IDs of the subjects.
+        repetitions: Number of timed runs per subject.
+
+    Returns:
+        dict: The latencies (in seconds) of every run, grouped by subject, the peak RSS of the process and its RSS
+              before the benchmark started (i.e. the footprint of the interpreter and the imported modules).
+    """
+    reset_peak_memory()
+    initial_rss, latencies = memory_usage_mb()[0], {}
+    for subject_id in subjects:
+        inputs = setup(subject_id)
+        latencies[subject_id] = []
+        for _ in range(repetitions):
+            start = time.perf_counter()
+            run(inputs)
+            latencies[subject_id].append(time.perf_counter() - start)
+        del inputs
+
+    return {"latencies": latencies, "peak_rss_mb": memory_usage_mb()[1], "initial_rss_mb": initial_rss}
+
+
+def run_isolated(func, *args, **kwargs):
+    """
+    Runs a function in a fresh process, so the peak memory it reports only depends on its own work and not on the
+    benchmarks that ran before it.
+
+    Returns:
+        The output of the function.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(func, *args, **kwargs).result()
+
+
+def summarize_benchmark(timings: dict, voxels: int) -> dict:
+    """
+    Summarizes the timings of a benchmark.
+
+    Args:
+        timings: Output of `time_benchmark`.
+        voxels: Number of voxels processed per subject.
+
+    Returns:
+        dict: The median and minimum per-subject latency (the best run of each subject is taken, as it is the least
+              affected by noise), the throughput in voxels per second, the peak RSS and its increase during the
+              benchmark (reading the inputs included).
+    """
+    best = [min(runs) for runs in timings["latencies"].values()]
+    latency = float(np.median(best))
+    peak, initial = timings["peak_rss_mb"], timings["initial_rss_mb"]
+
+    return {
+        "latency_s": latency,
+        "min_latency_s": float(min(best)),
+        "voxels_per_s": voxels / latency if latency > 0 else None,
+        "peak_rss_mb": peak,
+        "peak_rss_increase_mb": peak - initial if peak is not None and initial is not None else None,
+    }
+
+
+def benchmark_metadata(config: dict) -> dict:
+    """Environment and settings of a benchmark run, stored with its results so runs can be told apart."""
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "shape": list(config["shape"]),
+        "n_subjects": config["n_subjects"],
+        "repetitions": config["repetitions"],
+    }
+
+
+def save_benchmark(path: str, results: dict):
+    """Stores the results of a benchmark run in a JSON file."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2)
+
+
+def load_benchmark(path: str):
+    """Loads the results stored by `save_benchmark`, or returns None if the file does not exist."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def check_sketches(sketch_size: int, bin_width: float, n_values: int, n_parts: int, seed: int) -> list:
+    """
+    Checks the invariants of the dataset-level intensity sketches on synthetic data: values drawn from a scan-like
+    integer distribution and from a skewed continuous one are split into parts, sketched separately (as the workers
+    do) and merged through their serialized form. The merged sketch is then compared against the exact statistics.
+
+    Args:
+        sketch_size: Capacity of the quantile sketch, as in feature_extractor.yml.
+        bin_width: Width of the bins of the histogram, as in feature_extractor.yml.
+        n_values: Number of values of each distribution.
+        n_parts: Number of sketches merged for each distribution.
+        seed: Seed of the random generator.
+
+    Returns:
+        list: One (distribution, check, value, bound, passed) tuple per check. The counts of the sketch, the total
+              weight of the quantile sketch and the histogram counts must match the data exactly, the worst rank error
+              of the percentiles in `SUMMARY_PERCENTILES` must stay below 3 / sketch_size and the mean and standard
+              deviation must match the exact ones up to rounding.
+    """
+    rng = np.random.default_rng(seed)
+    distributions = {
+        "integer": np.round(rng.normal(600, 150, size=n_values)).clip(0),
+        "lognormal": rng.lognormal(5, 1, size=n_values),
+    }
+
+    results = []
+    for name, values in distributions.items():
+        parts = [{"seq": IntensitySketch(sketch_size, bin_width).update(part).to_dict()}
+                 for part in np.array_split(values, n_parts)]
+        sketch = merge_intensity_sketches(parts)["seq"]
+        quantiles, histogram = sketch.quantiles, sketch.histogram
+
+        weight = sum(items.size * 2 ** level for level, items in enumerate(quantiles.levels))
+        bins, counts = np.unique(np.floor(values / bin_width).astype(np.int64), return_counts=True)
+        histogram_error = int(np.abs(counts - histogram.counts).sum()) if np.array_equal(bins, histogram.bins) else \
+            n_values
+
+        # distance between each percentile and the range of ranks its estimate takes in the sorted values
+        q = np.array(SUMMARY_PERCENTILES) / 100
+        sorted_values = np.sort(values)
+        estimates = quantiles.get_percentiles(SUMMARY_PERCENTILES)
+        lower = np.searchsorted(sorted_values, estimates, side="left") / n_values
+        upper = np.searchsorted(sorted_values, estimates, side="right") / n_values
+        rank_error = float(np.max(np.maximum(np.maximum(lower - q, q - upper), 0)))
+
+        statistics = sketch.moments.extract_features()
+        mean_error = abs(statistics["mean_intensity"] - values.mean()) / abs(values.mean())
+        std_error = abs(statistics["std_intensity"] - values.std()) / values.std()
+
+        results += [
+            (name, "n", sketch.moments.n, n_values, sketch.moments.n == n_values),
+            (name, "quantile_n", quantiles.n, n_values, quantiles.n == n_values),
+            (name, "quantile_weight", weight, n_values, weight == n_values),
+            (name, "histogram_total", int(histogram.counts.sum()), n_values, histogram.counts.sum() == n_values),
+            (name, "histogram_error", histogram_error, 0, histogram_error == 0),
+            (name, "rank_error", rank_error, 3 / sketch_size, rank_error <= 3 / sketch_size),
+            (name, "mean_relative_error", mean_error, 1e-9, mean_error <= 1e-9),
+            (name, "std_relative_error", std_error, 1e-9, std_error <= 1e-9),
+        ]
+
+    return results
+
+
+def compare_benchmarks(current: dict, baseline: dict, threshold: float = 0.2) -> list:
+    """
+    Compares a benchmark run against a baseline.
+
+    Args:
+        current: Results of the current run.
+        baseline: Results of the baseline run.
+        threshold: Relative increase of the latency or peak RSS considered a regression (0.2 = 20 % worse).
+
+    Returns:
+        list: One (benchmark, measure, baseline value, current value, ratio, is regression) tuple per measure of the
+              benchmarks present in both runs.
+    """
+    comparison = []
+    for name, result in current["results"].items():
+        reference = baseline["results"].get(name)
+        if reference is None:
+            continue
+        for measure in ("latency_s", "peak_rss_increase_mb"):
+            if not reference.get(measure) or result.get(measure) is None:
+                continue
+            ratio = result[measure] / reference[measure]
+            comparison.append((name, measure, reference[measure], result[measure], ratio, ratio > 1 + threshold))
+
+    return comparison
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+from loguru import logger
+
+# version of the layout of the cache entries. Entries written with another one are recomputed
+CACHE_FORMAT = 2
+
+
+def files_signature(paths: list) -> list:
+    """
+    Builds a signature of a list of files based on their path, size and modification time.
+
+    Args:
+        paths: List of file paths.
+
+    Returns:
+        list: A list of [path, size, mtime] entries, sorted by path. Missing files are skipped.
+    """
+    signature = []
+    for path in sorted(paths):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            signature.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+
+    return signature
+
+
+def config_signature(config: dict, ignore_keys: tuple = ()) -> str:
+    """
+    Computes a stable hash of a configuration dictionary.
+
+    Args:
+        config: The configuration dictionary.
+        ignore_keys: Top-level keys that do not affect the results and must not invalidate the cache.
+
+    Returns:
+        str: The SHA-1 hex digest of the configuration.
+    """
+    relevant = {k: v for k, v in config.items() if k not in ignore_keys}
+
+    return hashlib.sha1(json.dumps(relevant, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def cache_key(*signatures) -> str:
+    """
+    Combines several signatures into a single cache key.
+
+    Returns:
+        str: The SHA-1 hex digest of all the signatures.
+    """
+    return hashlib.sha1(json.dumps(signatures, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def load_cached_result(cache_dir: str, name: str, key: str):
+    """
+    Loads a cached result if it exists and was stored with the same key.
+
+    Args:
+        cache_dir: Directory where the cache entries are stored.
+        name: Name of the cache entry (e.g. the subject ID).
+        key: Key the entry must match to be valid.
+
+    Returns:
+        The cached value, or None if there is no valid entry.
+    """
+    path = os.path.join(cache_dir, f"{name}.json")
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, "r") as file:
+            entry = json.load(file, object_hook=decode_numpy_scalar)
+    except (OSError, ValueError, TypeError) as e:
+        logger.warning(f"Ignoring unreadable cache entry {path}: {e}")
+        return None
+
+    return entry["value"] if entry.get("key") == key and entry.get("format") == CACHE_FORMAT else None
+
+
+def store_cached_result(cache_dir: str, name: str, key: str, value):
+    """
+    Stores a result in the cache. The entry is written atomically, so an interrupted run never leaves a corrupt file.
+
+    Args:
+        cache_dir: Directory where the cache entries are stored.
+        name: Name of the cache entry (e.g. the subject ID).
+        key: Key identifying the inputs used to compute the value.
+        value: JSON serializable value. Numpy scalars are stored with their type, so they are loaded back as the same
+               numpy scalars (and the tables built from cached results keep the dtypes of a fresh run).
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{name}.json")
+    tmp_path = f"{path}.tmp"
+
+    with open(tmp_path, "w") as file:
+        json.dump({"key": key, "format": CACHE_FORMAT, "value": value}, file, default=encode_numpy_scalar)
+    os.replace(tmp_path, path)
+
+
+def encode_numpy_scalar(value):
+    """Converts a numpy scalar to a JSON serializable dictionary with its type. Other objects are stored as text."""
+    if isinstance(value, np.generic) and value.dtype.kind in "biuf":
+        return {"__dtype__": value.dtype.str, "value": value.item()}
+
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+def decode_numpy_scalar(entry: dict):
+    """Restores the numpy scalars encoded by `encode_numpy_scalar` while a JSON file is loaded."""
+    if entry.keys() == {"__dtype__", "value"}:
+        return np.dtype(entry["__dtype__"]).type(entry["value"])
+
+    return entry
@@ -220,13 +220,69 @@ def concatenate_csv_files(directory: str, output_file: str):
     print(f"Concatenated CSV files saved to: {output_file}")
 
 
-def read_datasets_from_dict(name_path_dict: dict, col_name: str = "set") -> pd.DataFrame:
+# identifier columns stored as dictionary-encoded (categorical) columns in the columnar outputs
+CATEGORICAL_COLUMNS = ("ID", "region", "model", "set")
+TABLE_FORMATS = ("csv", "parquet")
+
+
+def export_table(data: pd.DataFrame, path: str, output_format: str = "csv"):
+    """
+    Exports a table of extracted features or metrics.
+
+    In Parquet format the identifier columns (ID, region, model and set) are stored as dictionary-encoded columns and
+    the rest keep their numeric types, so the app can read them back without parsing and project only the columns it
+    needs.
+
+    Args:
+        data: The table to export.
+        path: The output file path, including its extension.
+        output_format: Either "csv" or "parquet".
+    """
+    if output_format not in TABLE_FORMATS:
+        raise ValueError(f"Unsupported output format '{output_format}'. Use 'csv' or 'parquet'")
+
+    if output_format == "parquet":
+        data = data.astype({col: "category" for col in CATEGORICAL_COLUMNS if col in data.columns})
+        data.to_parquet(path, index=False)
+    else:
+        data.to_csv(path, index=False)
+
+
+def read_table(path: str, columns: list = None) -> pd.DataFrame:
+    """
+    Reads a table exported by `export_table`. The format is inferred from the file extension.
+
+    Args:
+        path: Path of the CSV or Parquet file.
+        columns: Optional list of columns to load. Columns missing from the file are ignored. Defaults to all of them.
+
+    Returns:
+        pd.DataFrame: The table read.
+    """
+    if path.endswith(".parquet"):
+        if columns is not None:
+            import pyarrow.parquet as pq
+
+            available = pq.read_schema(path).names
+            columns = [col for col in columns if col in available]
+        return pd.read_parquet(path, columns=columns)
+
+    if columns is not None:
+        columns = set(columns)
+        return pd.read_csv(path, usecols=lambda col: col in columns)
+
+    return pd.read_csv(path)
+
+
+def read_datasets_from_dict(name_path_dict: dict, col_name: str = "set", columns: list = None) -> pd.DataFrame:
     """
     Reads multiple datasets from a dictionary of name-path pairs and concatenates them into a single DataFrame.
 
     Args:
-        name_path_dict: A dictionary where keys are dataset names and values are file paths to CSV files.
+        name_path_dict: A dictionary where keys are dataset names and values are file paths to CSV or Parquet files.
         col_name: The name of the column to add that will contain the dataset name. Defaults to "set".
+        columns: Optional list of columns to load from each file, so pages only read the columns they plot. Defaults
+                 to all of them.
 
     Returns:
         pd.DataFrame: A concatenated DataFrame containing all the datasets, with an additional column specifying
@@ -235,9 +291,120 @@ def read_datasets_from_dict(name_path_dict: dict, col_name: str = "set") -> pd.D
 
     out = []
     for name, path in name_path_dict.items():
-        data = pd.read_csv(path)
+        data = read_table(path, columns=columns)
+        # dictionary-encoded columns are decoded, since grouping by categoricals would yield unobserved combinations
+        categorical = data.select_dtypes("category").columns
+        data[categorical] = data[categorical].astype(object)
         data[col_name] = name
         out.append(data)
     out = pd.concat(out)
 
     return out
+
+
+class StreamingTableWriter:
+    """
+    Appends rows to a table on disk as they are produced, so partial results are usable while long jobs are still
+    running and are not lost if the job crashes.
+
+    Rows are buffered and flushed every `batch_size` calls to `write`. In CSV format they are appended to a single file;
+    if a later batch brings new columns, the file is rewritten once with the extended header. In Parquet format each
+    flush writes a new part file inside the `path` directory. Use `read_streamed_table` to load either of them.
+
+    Attributes:
+        path: Path of the CSV file or of the Parquet directory.
+        output_format: Either "csv" or "parquet".
+        batch_size: Number of `write` calls (e.g. subjects) buffered before each flush.
+    """
+
+    def __init__(self, path: str, output_format: str = "csv", batch_size: int = 10):
+        if output_format not in ("csv", "parquet"):
+            raise ValueError(f"Unsupported output format '{output_format}'. Use 'csv' or 'parquet'")
+
+        self.path = path
+        self.output_format = output_format
+        self.batch_size = max(1, batch_size)
+        self.columns = None
+        self.n_parts = 0
+        self._buffer = []
+        self._pending_writes = 0
+
+        # start from an empty table
+        self.remove()
+        if output_format == "parquet":
+            os.makedirs(path, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, rows: list):
+        """Buffers a list of rows (dictionaries) and flushes them if the batch is complete."""
+        self._buffer.extend(rows)
+        self._pending_writes += 1
+        if self._pending_writes >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes all the buffered rows to disk."""
+        if self._buffer:
+            batch = pd.DataFrame(self._buffer)
+            if self.output_format == "csv":
+                self._append_csv(batch)
+            else:
+                batch.to_parquet(os.path.join(self.path, f"part-{self.n_parts:05d}.parquet"), index=False)
+                self.n_parts += 1
+
+        self._buffer = []
+        self._pending_writes = 0
+
+    def _append_csv(self, batch: pd.DataFrame):
+        if self.columns is None:
+            batch.to_csv(self.path, index=False)
+        elif set(batch.columns).issubset(self.columns):
+            batch.reindex(columns=self.columns).to_csv(self.path, mode="a", header=False, index=False)
+        else:
+            # new columns appeared: rewrite the file once with the extended header
+            batch = pd.concat([pd.read_csv(self.path), batch], ignore_index=True)
+            batch.to_csv(self.path, index=False)
+        self.columns = list(batch.columns)
+
+    def close(self):
+        """Flushes the remaining rows."""
+        self.flush()
+
+    def remove(self):
+        """Deletes the table from disk (e.g. once the final output has been written)."""
+        remove_streamed_table(self.path)
+
+
+def remove_streamed_table(path: str):
+    """
+    Deletes a table written by `StreamingTableWriter`, either a CSV file or a directory of Parquet part files.
+
+    Args:
+        path: Path of the CSV file or of the Parquet directory.
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def read_streamed_table(path: str) -> pd.DataFrame:
+    """
+    Reads a table written by `StreamingTableWriter`, either a CSV file or a directory of Parquet part files.
+
+    Args:
+        path: Path of the CSV file or of the Parquet directory.
+
+    Returns:
+        pd.DataFrame: The rows written so far.
+    """
+    if os.path.isdir(path):
+        parts = sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".parquet"))
+        return pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True) if parts else pd.DataFrame()
+
+    return pd.read_csv(path)
@@ -0,0 +1,94 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+
+from loguru import logger
+
+from src.utils.sequences import prefetch_subjects
+
+
+def resolve_n_workers(n_workers) -> int:
+    """
+    Resolves the number of workers requested in a config file.
+
+    Args:
+        n_workers: Number of workers. None or 1 means sequential execution, while values lower than 1 use all the
+                   available cores.
+
+    Returns:
+        int: The number of workers to use.
+    """
+    if n_workers is None:
+        return 1
+    if n_workers < 1:
+        return os.cpu_count() or 1
+
+    return int(n_workers)
+
+
+def safe_subject_call(func, subject_id: str, **kwargs):
+    """
+    Calls a per-subject function isolating any failure, so one corrupt subject cannot abort the whole run.
+
+    Args:
+        func: Function to be called as func(subject_id, **kwargs).
+        subject_id: The ID of the subject being processed.
+        **kwargs: Extra arguments passed to the function.
+
+    Returns:
+        tuple: The subject ID and the output of the function, or None if it failed.
+    """
+    try:
+        return subject_id, func(subject_id, **kwargs)
+    except Exception as e:
+        logger.exception(f"Subject {subject_id} failed and will be skipped: {e}")
+        return subject_id, None
+
+
+def map_subjects(func, subjects: list, n_workers: int = 1, loader=None, n_prefetch: int = 0, **kwargs):
+    """
+    Applies a per-subject function to a list of subjects, optionally spreading them across a process pool.
+
+    Results are yielded as soon as they are available (completion order when running in parallel), so callers can keep
+    their progress bars updated. Callers that need a deterministic output must reorder the results by subject.
+
+    When running sequentially, a `loader` can read the next `n_prefetch` subjects on background threads while the
+    current one is being processed (see `prefetch_subjects`). Its output is passed to the function as `preloaded`.
+
+    Args:
+        func: Top-level (picklable) function called as func(subject_id, **kwargs).
+        subjects: List of subject IDs.
+        n_workers: Number of worker processes. Sequential execution if it is 1.
+        loader: Optional function called as loader(subject_id) that reads the data of a subject. The function must
+                accept a `preloaded` argument and read the data itself when it is None.
+        n_prefetch: Number of subjects read ahead by the loader. Prefetching is disabled if it is 0.
+        **kwargs: Extra arguments passed to the function. They must be picklable.
+
+    Yields:
+        tuple: The subject ID and the output of the function, or None if it failed.
+    """
+    n_workers = resolve_n_workers(n_workers)
+
+    if n_workers == 1 and loader is not None and n_prefetch > 0:
+        for subject_id, preloaded in prefetch_subjects(subjects, loader, n_prefetch):
+            result = safe_subject_call(func, subject_id, preloaded=preloaded, **kwargs)
+            del preloaded  # release the volumes before waiting for the next subject
+            yield result
+        return
+
+    if n_workers == 1:
+        for subject_id in subjects:
+            yield safe_subject_call(func, subject_id, **kwargs)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {
+            executor.submit(safe_subject_call, func, subject_id, **kwargs): subject_id for subject_id in subjects
+        }
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                # the worker process itself died (e.g. segmentation fault while decoding a file)
+                logger.error(f"Worker crashed while processing subject {futures[future]}: {e}")
+                yield futures[future], None
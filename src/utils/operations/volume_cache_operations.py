@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+from loguru import logger
+
+# the cache settings are stored in the environment, so worker processes inherit them whatever their start method is
+CACHE_PATH_VARIABLE = "AUDIT_VOLUME_CACHE_PATH"
+CACHE_MAX_SIZE_VARIABLE = "AUDIT_VOLUME_CACHE_MAX_GB"
+
+
+def configure_volume_cache(path: str = None, max_size_gb: float = 20):
+    """
+    Enables (or disables) the local cache of decompressed volumes used by the NIfTI loaders of `src.utils.sequences`.
+
+    Each NIfTI file is decompressed once into a raw .npy file plus a JSON sidecar with its spatial metadata, and later
+    reads memory-map it instead of decoding the .nii.gz again. Entries are invalidated when the source file changes and
+    the least recently used ones are evicted when the cache grows beyond `max_size_gb`.
+
+    Args:
+        path: Directory of the cache. The cache is disabled if it is None or empty.
+        max_size_gb: Maximum size of the cache in gigabytes.
+    """
+    if path:
+        os.makedirs(path, exist_ok=True)
+        os.environ[CACHE_PATH_VARIABLE] = str(path)
+        os.environ[CACHE_MAX_SIZE_VARIABLE] = str(max_size_gb)
+        logger.info(f"Volume cache enabled in {path} (up to {max_size_gb} GB)")
+    else:
+        os.environ.pop(CACHE_PATH_VARIABLE, None)
+        os.environ.pop(CACHE_MAX_SIZE_VARIABLE, None)
+
+
+def volume_cache_path():
+    """Returns the directory of the volume cache, or None if it is disabled."""
+    return os.environ.get(CACHE_PATH_VARIABLE) or None
+
+
+def volume_cache_entry(path_file: str) -> str:
+    """Name of the cache entry of a file. It changes whenever the file is modified."""
+    stat = os.stat(path_file)
+    signature = f"{os.path.abspath(path_file)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    return hashlib.sha1(signature.encode()).hexdigest()
+
+
+def load_cached_volume(path_file: str):
+    """
+    Loads a volume from the cache as a copy-on-write memory map, so callers can modify it without touching the cache.
+
+    Args:
+        path_file: Path of the source NIfTI file.
+
+    Returns:
+        tuple: The array and its metadata (spacing, origin and direction), or None if the cache is disabled or there
+               is no valid entry for the file.
+    """
+    cache_dir = volume_cache_path()
+    if not cache_dir or not os.path.exists(path_file):
+        return None
+
+    entry = os.path.join(cache_dir, volume_cache_entry(path_file))
+    try:
+        with open(f"{entry}.json", "r") as file:
+            metadata = {k: np.array(v) for k, v in json.load(file).items() if k != "source"}
+        array = np.load(f"{entry}.npy", mmap_mode="c")
+    except (OSError, ValueError):
+        return None
+
+    # the modification time of the entry tracks its last use for the LRU eviction
+    os.utime(f"{entry}.npy")
+
+    return array, metadata
+
+
+def store_cached_volume(path_file: str, array: np.ndarray, metadata: dict):
+    """
+    Stores a decompressed volume and its metadata in the cache, evicting the least recently used entries if the cache
+    exceeds its size. Nothing is done if the cache is disabled.
+
+    Args:
+        path_file: Path of the source NIfTI file.
+        array: The decompressed volume.
+        metadata: Its spacing, origin and direction.
+    """
+    cache_dir = volume_cache_path()
+    if not cache_dir:
+        return
+
+    entry = os.path.join(cache_dir, volume_cache_entry(path_file))
+    sidecar = {"source": os.path.abspath(path_file), **{k: np.asarray(v).tolist() for k, v in metadata.items()}}
+    try:
+        # the array is written last, since its presence is what makes an entry visible to the eviction
+        write_atomically(f"{entry}.json", lambda file: file.write(json.dumps(sidecar).encode()))
+        write_atomically(f"{entry}.npy", lambda file: np.save(file, array))
+    except OSError as e:
+        logger.warning(f"Volume {path_file} could not be cached: {e}")
+        return
+
+    evict_volume_cache(cache_dir, float(os.environ.get(CACHE_MAX_SIZE_VARIABLE, 20)))
+
+
+def write_atomically(path: str, write):
+    """
+    Writes a file through a uniquely named temporary file that is renamed once complete, so readers never see a
+    partial file and concurrent writers of the same entry (e.g. several workers caching the same volume) do not
+    clobber each other's temporary files.
+
+    Args:
+        path: Final path of the file.
+        write: Function called as write(file) with the temporary file opened in binary mode.
+    """
+    descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            write(file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def evict_volume_cache(cache_dir: str, max_size_gb: float):
+    """
+    Removes the least recently used entries of the cache until its size is below `max_size_gb`.
+
+    Args:
+        cache_dir: Directory of the cache.
+        max_size_gb: Maximum size of the cache in gigabytes.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".npy"):
+            try:
+                stat = os.stat(os.path.join(cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, name[:-len(".npy")]))
+
+    total, max_size = sum(size for _, size, _ in entries), max_size_gb * 1024 ** 3
+    for _, size, name in sorted(entries):
+        if total <= max_size:
+            break
+        for ext in (".npy", ".json"):
+            try:
+                os.remove(os.path.join(cache_dir, f"{name}{ext}"))
+            except OSError:
+                pass
+        total -= size
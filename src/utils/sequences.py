@@ -1,21 +1,44 @@
+import gzip
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from loguru import logger
 
 import numpy as np
 import SimpleITK
 from SimpleITK import GetArrayFromImage
 from SimpleITK import GetImageFromArray
+from SimpleITK import ImageFileReader
 from SimpleITK import ReadImage
 from SimpleITK import WriteImage
 
+from src.utils.operations.volume_cache_operations import load_cached_volume
+from src.utils.operations.volume_cache_operations import store_cached_volume
+from src.utils.operations.volume_cache_operations import volume_cache_path
+
+# numpy types of the NIfTI-1 datatype codes, and of the SimpleITK pixel types they are read as
+NIFTI_DTYPES = {
+    2: "u1", 4: "i2", 8: "i4", 16: "f4", 64: "f8", 256: "i1", 512: "u2", 768: "u4", 1024: "i8", 1280: "u8"
+}
+SITK_DTYPES = {
+    SimpleITK.sitkUInt8: "u1", SimpleITK.sitkInt8: "i1", SimpleITK.sitkUInt16: "u2", SimpleITK.sitkInt16: "i2",
+    SimpleITK.sitkUInt32: "u4", SimpleITK.sitkInt32: "i4", SimpleITK.sitkUInt64: "u8", SimpleITK.sitkInt64: "i8",
+    SimpleITK.sitkFloat32: "f4", SimpleITK.sitkFloat64: "f8",
+}
+
 
 def load_nii(path_folder: str, as_array: bool = False) -> SimpleITK.Image:
-    """  This function loads a NIfTI."""
+    """  This function loads a NIfTI. It is served from the volume cache when it is enabled."""
+    if as_array:
+        return load_nii_with_metadata(path_folder)[0]
+
+    if volume_cache_path():
+        array, metadata = load_nii_with_metadata(path_folder)
+        return image_from_array(array, metadata) if array is not None else None
+
     try:
-        if as_array:
-            return GetArrayFromImage(ReadImage(str(path_folder)))
-        else:
-            return ReadImage(str(path_folder))
+        return ReadImage(str(path_folder))
     except RuntimeError:
         return None
 
@@ -28,13 +51,17 @@ def load_nii_by_id(root: str, patient_id: str, seq: str = "_seg", as_array: bool
         logger.warning(f" Sequence '{seq}' not found.")
         return None
 
-    try:
-        if as_array:
-            return GetArrayFromImage(ReadImage(nii_path))
-        else:
-            return ReadImage(f"{root}/{patient_id}/{patient_id}{seq}.nii.gz")
-    except RuntimeError:
-        return None
+    return load_nii(nii_path, as_array=as_array)
+
+
+def image_from_array(array: np.ndarray, metadata: dict) -> SimpleITK.Image:
+    """ Builds a SimpleITK image from an array and the metadata returned by `load_nii_with_metadata`."""
+    img = GetImageFromArray(np.asarray(array))
+    img.SetSpacing([float(v) for v in metadata["spacing"]])
+    img.SetOrigin([float(v) for v in metadata["origin"]])
+    img.SetDirection([float(v) for v in metadata["direction"]])
+
+    return img
 
 
 def read_sequences_dict(root, patient_id, sequences=["_t1", "_t1ce", "_t2", "_flair"]):
@@ -53,8 +80,239 @@ def read_sequences_dict(root, patient_id, sequences=["_t1", "_t1ce", "_t2", "_fl
     return out
 
 
+def load_nii_with_metadata(path_file: str):
+    """
+    Loads a NIfTI file once and returns its array together with its spatial metadata.
+
+    Args:
+        path_file: Path to the NIfTI file.
+
+    Returns:
+        tuple: The image as a numpy array and a dictionary with its spacing, origin and direction. Both are None if the
+               file cannot be read.
+    """
+    # decompressed copy kept by the volume cache, if enabled
+    cached = load_cached_volume(str(path_file))
+    if cached is not None:
+        return cached
+
+    try:
+        img = ReadImage(str(path_file))
+    except RuntimeError:
+        return None, None
+
+    metadata = {
+        "spacing": np.array(img.GetSpacing()),
+        "origin": np.array(img.GetOrigin()),
+        "direction": np.array(img.GetDirection()),
+    }
+    array = GetArrayFromImage(img)
+    store_cached_volume(str(path_file), array, metadata)
+
+    return array, metadata
+
+
+def read_image_information(path_file: str):
+    """
+    Reads the header of a NIfTI file without decoding its voxels.
+
+    Args:
+        path_file: Path to the NIfTI file.
+
+    Returns:
+        tuple: The shape of the image as a numpy array (z, y, x) and a dictionary with its spacing, origin and
+               direction. Both are None if the file cannot be read.
+    """
+    reader = ImageFileReader()
+    reader.SetFileName(str(path_file))
+    try:
+        reader.ReadImageInformation()
+    except RuntimeError:
+        return None, None
+
+    metadata = {
+        "spacing": np.array(reader.GetSpacing()),
+        "origin": np.array(reader.GetOrigin()),
+        "direction": np.array(reader.GetDirection()),
+    }
+
+    return tuple(reversed(reader.GetSize())), metadata
+
+
+def iter_slabs(path_file: str, slab_size: int):
+    """
+    Reads a NIfTI file in axial slabs (blocks of consecutive planes along the first axis of the array), so the whole
+    volume never needs to be in memory.
+
+    Slabs are served from the volume cache when it holds the file, since reading a memory-mapped slab only touches its
+    own pages. Otherwise, 3D NIfTI-1 files whose voxels are stored as read by SimpleITK (no intensity scaling) are
+    streamed sequentially through a single (gzip) file handle, so the file is decompressed only once whatever the
+    number of slabs. Any other file is read slab by slab with SimpleITK, which decompresses .nii.gz files from their
+    start for every slab.
+
+    Args:
+        path_file: Path to the NIfTI file.
+        slab_size: Number of planes per slab.
+
+    Yields:
+        tuple: The index of the first plane of the slab and the slab as a numpy array.
+    """
+    cached = load_cached_volume(str(path_file))
+    if cached is not None:
+        volume = cached[0]
+        for start in range(0, volume.shape[0], slab_size):
+            yield start, volume[start:start + slab_size]
+        return
+
+    reader = ImageFileReader()
+    reader.SetFileName(str(path_file))
+    reader.ReadImageInformation()
+    size = reader.GetSize()
+
+    layout = read_nifti_layout(path_file)
+    if layout is not None and layout[0] == tuple(reversed(size)) and \
+            SITK_DTYPES.get(reader.GetPixelID()) == f"{layout[1].kind}{layout[1].itemsize}":
+        yield from stream_nifti_slabs(path_file, slab_size, *layout)
+        return
+
+    for start in range(0, size[2], slab_size):
+        reader.SetExtractIndex((0, 0, start))
+        reader.SetExtractSize((size[0], size[1], min(slab_size, size[2] - start)))
+        yield start, GetArrayFromImage(reader.Execute())
+
+
+def read_nifti_layout(path_file: str):
+    """
+    Reads the NIfTI-1 header of a (possibly gzipped) file to locate its voxels.
+
+    Args:
+        path_file: Path to the NIfTI file.
+
+    Returns:
+        tuple: The shape of the image (z, y, x), the numpy type of its voxels (with the byte order of the file) and
+               the offset of the voxels in the file. None if the file is not a single-file 3D NIfTI-1 image whose
+               voxels can be used as stored (e.g. when they have to be scaled).
+    """
+    opener = gzip.open if str(path_file).endswith(".gz") else open
+    try:
+        with opener(str(path_file), "rb") as file:
+            header = file.read(348)
+    except OSError:
+        return None
+    if len(header) < 348 or header[344:348] != b"n+1\0":
+        return None
+
+    endian = next((e for e in "<>" if np.frombuffer(header, f"{e}i4", 1, 0)[0] == 348), None)
+    if endian is None:
+        return None
+    dim = np.frombuffer(header, f"{endian}i2", 8, 40)
+    datatype = int(np.frombuffer(header, f"{endian}i2", 1, 70)[0])
+    vox_offset = float(np.frombuffer(header, f"{endian}f4", 1, 108)[0])
+    slope, intercept = np.frombuffer(header, f"{endian}f4", 2, 112)
+
+    is_scaled = slope != 0 and not (slope == 1 and intercept == 0)
+    if dim[0] != 3 or datatype not in NIFTI_DTYPES or is_scaled or not np.isfinite(slope):
+        return None
+
+    return (int(dim[3]), int(dim[2]), int(dim[1])), np.dtype(f"{endian}{NIFTI_DTYPES[datatype]}"), int(vox_offset)
+
+
+def stream_nifti_slabs(path_file: str, slab_size: int, shape: tuple, dtype: np.dtype, offset: int):
+    """
+    Reads the voxels of a NIfTI file in axial slabs through a single file handle, keeping its position between slabs
+    (see `read_nifti_layout` for the arguments describing the voxels).
+
+    Yields:
+        tuple: The index of the first plane of the slab and the slab as a numpy array, in native byte order.
+    """
+    opener = gzip.open if str(path_file).endswith(".gz") else open
+    with opener(str(path_file), "rb") as file:
+        file.seek(offset)
+        for start in range(0, shape[0], slab_size):
+            slab = np.empty((min(slab_size, shape[0] - start),) + tuple(shape[1:]), dtype=dtype)
+            buffer, filled = memoryview(slab.reshape(-1).view(np.uint8)), 0
+            while filled < slab.nbytes:
+                read = file.readinto(buffer[filled:])
+                if not read:
+                    raise RuntimeError(f"Unexpected end of file while reading {path_file}")
+                filled += read
+            yield start, slab if dtype.isnative else slab.astype(dtype.newbyteorder("="))
+
+
+def load_subject(root: str, patient_id: str, sequences=("_t1", "_t1ce", "_t2", "_flair", "_seg")):
+    """
+    Loads all the sequences of a subject decoding each NIfTI file only once.
+
+    Args:
+        root: Path to the dataset folder.
+        patient_id: The ID of the subject.
+        sequences: Suffixes of the sequences to load.
+
+    Returns:
+        tuple: Two dictionaries keyed by sequence name (without the leading underscore). The first one contains the
+               arrays and the second one their metadata (spacing, origin and direction). Missing sequences are None.
+    """
+    arrays, metadata = {}, {}
+
+    for seq in sequences:
+        nii_path = f"{root}/{patient_id}/{patient_id}{seq}.nii.gz"
+        name = seq.replace("_", "")
+
+        # load the sequence if it exists
+        if os.path.exists(nii_path):
+            arrays[name], metadata[name] = load_nii_with_metadata(nii_path)
+        else:
+            arrays[name], metadata[name] = None, None
+            logger.warning(f" Sequence '{seq}' not found.")
+
+    return arrays, metadata
+
+
+def prefetch_subjects(subjects: list, loader, n_prefetch: int = 2):
+    """
+    Reads the subjects ahead of their use on background threads, so decoding the next volumes overlaps with the
+    computation on the current one. At most `n_prefetch` subjects are waiting in memory at any time.
+
+    Args:
+        subjects: List of subject IDs.
+        loader: Function called as loader(subject_id) that reads the data of a subject (e.g. a partial of
+                `load_subject`).
+        n_prefetch: Number of subjects read ahead.
+
+    Yields:
+        tuple: The subject ID and the output of the loader, in the order of `subjects`. The output is None if the
+               loader failed.
+    """
+    def safe_loader(subject_id):
+        try:
+            return loader(subject_id)
+        except Exception as e:
+            logger.error(f"Subject {subject_id} could not be prefetched: {e}")
+            return None
+
+    executor = ThreadPoolExecutor(max_workers=max(1, n_prefetch))
+    try:
+        queue, pending = deque(), iter(subjects)
+        for subject_id in islice(pending, max(1, n_prefetch)):
+            queue.append((subject_id, executor.submit(safe_loader, subject_id)))
+
+        while queue:
+            subject_id, future = queue.popleft()
+            data = future.result()
+            # refill the queue before handing the subject over, so the next read starts right away
+            for next_id in islice(pending, 1):
+                queue.append((next_id, executor.submit(safe_loader, next_id)))
+            yield subject_id, data
+            del data
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
 def get_spacing(img):
-    if img is not None:
+    """ Gets the spacing of a SimpleITK image or of the metadata returned by `load_nii_with_metadata`."""
+    if isinstance(img, dict):
+        return np.array(img["spacing"])
+    elif img is not None:
         return np.array(img.GetSpacing())
     else:
         logger.warning(f" Sequence empty. Assuming isotropic spacing (1, 1, 1).")
@@ -179,17 +437,128 @@ def count_labels(segmentation, mapping_names=None):
     return pixels_dict
 
 
-def fit_brain_boundaries(sequence: np.ndarray):
-    sequence = sequence.copy()
+def get_bounding_box(volume: np.ndarray):
+    """
+    Computes the bounding box of the non-zero voxels of a 3D volume from its axis projections, without building any
+    list of coordinates.
 
-    # Getting all non-xero indexes
-    z_indexes, y_indexes, x_indexes = np.nonzero(sequence != 0)
+    Args:
+        volume: A 3D numpy array (e.g. a sequence or a segmentation).
 
-    # Calculating lower and upper boundaries by each dimension. Add a extra pixel in each dimension
-    zmin, ymin, xmin = [max(0, int(np.min(idx))) for idx in (z_indexes, y_indexes, x_indexes)]
-    zmax, ymax, xmax = [int(np.max(arr)) for arr in (z_indexes, y_indexes, x_indexes)]
+    Returns:
+        tuple: One slice per axis covering all the non-zero voxels (it can be used to index the volume directly), or
+               None if the volume is empty.
+    """
+    nonzero = volume != 0
+    first_second = nonzero.any(axis=2)
+    second_third = nonzero.any(axis=0)
+    projections = [first_second.any(axis=1), first_second.any(axis=0), second_third.any(axis=0)]
+    if not projections[0].any():
+        return None
+
+    bounds = [np.flatnonzero(p)[[0, -1]] for p in projections]
+
+    return tuple(slice(int(lower), int(upper) + 1) for lower, upper in bounds)
+
+
+def get_axis_marginals(volume: np.ndarray, bounding_box: tuple = None, value=None) -> list:
+    """
+    Counts the voxels of a 3D volume that are non-zero (or equal to `value`) along each axis. The volume is scanned
+    plane by plane, so only a 2D mask is alive at any time and the output only takes O(X+Y+Z) memory.
+
+    Args:
+        volume: A 3D numpy array.
+        bounding_box: Bounding box returned by `get_bounding_box`. Only the voxels inside it are scanned, so it must
+                      contain all the voxels to count.
+        value: Value of the voxels to count. If None, all the non-zero voxels are counted.
+
+    Returns:
+        list: One int64 array per axis, as long as the volume along that axis, with the number of voxels counted in
+              each plane.
+    """
+    marginals = [np.zeros(n, dtype=np.int64) for n in volume.shape]
+    if bounding_box is None:
+        bounding_box = tuple(slice(0, n) for n in volume.shape)
+
+    for index in range(bounding_box[0].start, bounding_box[0].stop):
+        plane = volume[index, bounding_box[1], bounding_box[2]]
+        mask = plane != 0 if value is None else plane == value
+        rows = mask.sum(axis=1)
+        marginals[0][index] = rows.sum()
+        marginals[1][bounding_box[1]] += rows
+        marginals[2][bounding_box[2]] += mask.sum(axis=0)
+
+    return marginals
 
-    # Fitting sequences and segmentation to brain boundaries
-    sequence = sequence[zmin:zmax, ymin:ymax, xmin:xmax]
 
-    return sequence
+def offset_slab_marginals(marginals: list, start: int, length: int) -> list:
+    """
+    Places the marginals of an axial slab (see `get_axis_marginals` and `iter_slabs`) in the frame of the whole
+    volume, so the marginals of all the slabs can be summed.
+
+    Args:
+        marginals: One array of counts per axis, computed on the slab.
+        start: Index of the first plane of the slab.
+        length: Size of the whole volume along the first axis.
+
+    Returns:
+        list: The marginals of the slab, the first one padded to the length of the volume.
+    """
+    first = np.zeros(length, dtype=np.int64)
+    first[start:start + len(marginals[0])] = marginals[0]
+
+    return [first, *marginals[1:]]
+
+
+def center_of_mass_from_marginals(marginals: list) -> np.ndarray:
+    """
+    Computes the center of mass (in voxels) from the per-axis counts returned by `get_axis_marginals`.
+
+    Args:
+        marginals: One array of counts per axis.
+
+    Returns:
+        np.ndarray: The coordinates of the center of mass, or NaN if there are no voxels.
+    """
+    if marginals is None or not np.any(marginals[0]):
+        return np.array([np.nan] * len(marginals or [0, 0, 0]))
+
+    return np.array([np.dot(m, np.arange(len(m))) / m.sum() for m in marginals])
+
+
+def crop_to_bounding_box(volume: np.ndarray, bounding_box: tuple = None) -> np.ndarray:
+    """
+    Crops a volume to a bounding box returned by `get_bounding_box`. The crop is a view, so no voxel is copied.
+
+    Args:
+        volume: A 3D numpy array.
+        bounding_box: One slice per axis. If None, the volume is returned as it is.
+
+    Returns:
+        np.ndarray: The cropped view of the volume.
+    """
+    if volume is None or bounding_box is None:
+        return volume
+
+    return volume[bounding_box]
+
+
+def fit_brain_boundaries(sequence: np.ndarray, bounding_box: tuple = None):
+    """
+    Crops a sequence to the boundaries of the brain.
+
+    Args:
+        sequence: A 3D numpy array.
+        bounding_box: Bounding box of the brain returned by `get_bounding_box`, if it was already computed.
+
+    Returns:
+        np.ndarray: A view of the sequence fitted to the brain boundaries. As it has always been done here, the upper
+                    boundary of each axis is exclusive, so the last plane containing brain is left out.
+    """
+    if bounding_box is None:
+        bounding_box = get_bounding_box(sequence)
+    if bounding_box is None:
+        raise ValueError("The sequence is empty, so it cannot be fitted to the brain boundaries")
+
+    # Fitting sequences and segmentation to brain boundaries
+    return sequence[tuple(slice(axis.start, axis.stop - 1) for axis in bounding_box)]
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from SimpleITK import GetArrayFromImage
+from SimpleITK import GetImageFromArray
+from SimpleITK import ReadImage
+from SimpleITK import WriteImage
+
+from src.utils.operations.benchmark_operations import SEQUENCES
+from src.utils.operations.benchmark_operations import generate_synthetic_subject
+from src.utils.operations.volume_cache_operations import configure_volume_cache
+
+LABELS = {"BKG": 0, "EDE": 1, "NEC": 2, "ENH": 3}
+SHAPE = (30, 40, 36)
+
+
+@pytest.fixture(autouse=True)
+def no_volume_cache():
+    """The volume cache is process-wide state, so every test starts without it."""
+    configure_volume_cache(None)
+    yield
+    configure_volume_cache(None)
+
+
+@pytest.fixture(scope="session")
+def integer_dataset(tmp_path_factory):
+    """A small synthetic BraTS-like subject with int16 sequences (see `generate_synthetic_subject`)."""
+    path = tmp_path_factory.mktemp("integer")
+    generate_synthetic_subject(str(path), "SUBJ_000", SHAPE, (1.0, 1.2, 1.5), LABELS, seed=0)
+
+    return path
+
+
+@pytest.fixture(scope="session")
+def float_dataset(tmp_path_factory, integer_dataset):
+    """The subject of `integer_dataset` with float32 sequences, as resampled scans are usually stored."""
+    path = tmp_path_factory.mktemp("float")
+    rng = np.random.default_rng(1)
+    for seq in SEQUENCES + ("seg",):
+        source = integer_dataset / "images" / "SUBJ_000" / f"SUBJ_000_{seq}.nii.gz"
+        image = ReadImage(str(source))
+        array = GetArrayFromImage(image)
+        if seq != "seg":
+            array = (array * rng.uniform(0.9, 1.1, size=array.shape)).astype(np.float32)
+        converted = GetImageFromArray(array)
+        converted.CopyInformation(image)
+        (path / "images" / "SUBJ_000").mkdir(parents=True, exist_ok=True)
+        WriteImage(converted, str(path / "images" / "SUBJ_000" / source.name))
+
+    return path
+
+
+@pytest.fixture
+def feature_config():
+    """Feature extractor settings with every feature group enabled."""
+    return {
+        "labels": dict(LABELS),
+        "features": {"statistical": True, "texture": True, "spatial": True, "tumor": True},
+        "texture_levels": 32,
+        "statistical_dtype": None,
+        "intensity_sketches": True,
+        "sketch_size": 400,
+        "sketch_bin_width": 10,
+        "slab_size": None,
+    }
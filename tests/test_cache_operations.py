@@ -0,0 +1,43 @@
+import json
+
+import numpy as np
+
+from src.utils.operations.cache_operations import load_cached_result
+from src.utils.operations.cache_operations import store_cached_result
+
+
+def test_cached_result_keeps_numpy_dtypes(tmp_path):
+    value = {
+        "max_intensity": np.int16(712),
+        "mean_intensity": np.float32(399.25),
+        "std_intensity": np.float64(82.7),
+        "has_tumor": np.bool_(True),
+        "axial_dim": 240,
+        "label": "ENH",
+    }
+    store_cached_result(str(tmp_path), "SUBJ_000", "key", value)
+    loaded = load_cached_result(str(tmp_path), "SUBJ_000", "key")
+
+    assert loaded == value
+    assert {name: np.asarray(item).dtype for name, item in loaded.items()} == {
+        name: np.asarray(item).dtype for name, item in value.items()
+    }
+
+
+def test_cached_result_with_another_key_is_ignored(tmp_path):
+    store_cached_result(str(tmp_path), "SUBJ_000", "key", {"a": 1})
+
+    assert load_cached_result(str(tmp_path), "SUBJ_000", "other key") is None
+    assert load_cached_result(str(tmp_path), "SUBJ_001", "key") is None
+
+
+def test_cached_result_of_an_older_format_is_ignored(tmp_path):
+    (tmp_path / "SUBJ_000.json").write_text(json.dumps({"key": "key", "value": {"a": 1}}))
+
+    assert load_cached_result(str(tmp_path), "SUBJ_000", "key") is None
+
+
+def test_unreadable_cached_result_is_ignored(tmp_path):
+    (tmp_path / "SUBJ_000.json").write_text("{not json")
+
+    assert load_cached_result(str(tmp_path), "SUBJ_000", "key") is None
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from src.metrics.confusion_matrix import mistakes_per_class
+from src.metrics.confusion_matrix import mistakes_per_class_optim
+from src.metrics.confusion_matrix import multiclass_confusion_matrix
+
+LABELS = [0, 1, 2, 4]
+
+
+def reference_confusion_matrix(ground_truth, predicted, unique_classes) -> np.ndarray:
+    """The confusion matrix counted one pair of classes at a time."""
+    return np.array([
+        [np.sum((ground_truth == a) & (predicted == b)) for b in unique_classes] for a in unique_classes
+    ])
+
+
+@pytest.fixture
+def label_maps():
+    rng = np.random.default_rng(0)
+    ground_truth = rng.choice(LABELS, size=(12, 16, 10), p=[0.7, 0.1, 0.1, 0.1])
+    # some predicted voxels have a label (3) that is not one of the classes
+    noise = rng.choice(LABELS + [3], size=ground_truth.shape)
+    predicted = np.where(rng.random(ground_truth.shape) < 0.8, ground_truth, noise)
+
+    return ground_truth, predicted
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.int16, np.int64, np.float32])
+@pytest.mark.parametrize("chunk_size", [None, 1, 97])
+def test_multiclass_confusion_matrix_matches_reference(label_maps, dtype, chunk_size):
+    ground_truth, predicted = (volume.astype(dtype) for volume in label_maps)
+    matrix = multiclass_confusion_matrix(ground_truth, predicted, LABELS, chunk_size)
+
+    np.testing.assert_array_equal(matrix, reference_confusion_matrix(ground_truth, predicted, LABELS))
+
+
+def test_mistakes_per_class_optim_matches_original(label_maps):
+    # the original implementation only supports predictions within the classes
+    ground_truth, predicted = label_maps[0], np.where(np.isin(label_maps[1], LABELS), label_maps[1], 0)
+
+    np.testing.assert_array_equal(
+        mistakes_per_class_optim(ground_truth, predicted, LABELS),
+        mistakes_per_class(ground_truth, predicted, np.array(LABELS))
+    )
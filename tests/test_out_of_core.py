@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+from src.features.main import extract_subject_features
+from src.metrics.confusion_matrix import confusion_matrix_by_slabs
+from src.metrics.confusion_matrix import mistakes_per_class_optim
+from src.utils.operations.volume_cache_operations import configure_volume_cache
+from src.utils.sequences import iter_slabs
+from src.utils.sequences import load_nii_with_metadata
+from tests.conftest import LABELS
+from tests.conftest import SHAPE
+
+SLAB_SIZES = [1, 7, SHAPE[0] + 5]
+
+
+def flatten_features(features: dict, prefix: str = "") -> dict:
+    """Flattens the nested feature dictionaries of a subject (sketches aside) into a single dictionary."""
+    flat = {}
+    for name, value in features.items():
+        if isinstance(value, dict) and name != "intensity_sketches":
+            flat.update(flatten_features(value, f"{prefix}{name}."))
+        elif not isinstance(value, dict):
+            flat[f"{prefix}{name}"] = value
+
+    return flat
+
+
+def assert_features_equal(expected: dict, actual: dict, skip: tuple = (), rtol: float = 1e-9, atol: float = 0):
+    expected, actual = flatten_features(expected), flatten_features(actual)
+    assert expected.keys() == actual.keys()
+    for name, value in expected.items():
+        if not name.endswith(skip):
+            np.testing.assert_allclose(actual[name], value, rtol=rtol, atol=atol, err_msg=name)
+
+
+@pytest.mark.parametrize("slab_size", SLAB_SIZES)
+@pytest.mark.parametrize("dataset", ["integer_dataset", "float_dataset"])
+@pytest.mark.parametrize("use_cache", [False, True])
+def test_iter_slabs_matches_whole_volume(request, tmp_path, dataset, slab_size, use_cache):
+    path = request.getfixturevalue(dataset) / "images" / "SUBJ_000"
+    if use_cache:
+        configure_volume_cache(str(tmp_path / "volumes"))
+
+    for file in sorted(path.glob("*.nii.gz")):
+        volume = load_nii_with_metadata(str(file))[0]
+        slabs = list(iter_slabs(str(file), slab_size))
+
+        assert [start for start, _ in slabs] == list(range(0, volume.shape[0], slab_size))
+        slab_volume = np.concatenate([slab for _, slab in slabs])
+        assert slab_volume.dtype == volume.dtype
+        np.testing.assert_array_equal(slab_volume, volume)
+
+
+@pytest.mark.parametrize("slab_size", SLAB_SIZES)
+def test_slab_mode_matches_in_memory_for_integer_scans(integer_dataset, feature_config, slab_size):
+    path_images = str(integer_dataset / "images")
+    expected = extract_subject_features("SUBJ_000", path_images, feature_config)
+    actual = extract_subject_features("SUBJ_000", path_images, {**feature_config, "slab_size": slab_size})
+
+    assert_features_equal(expected, actual)
+
+
+@pytest.mark.parametrize("slab_size", SLAB_SIZES)
+def test_slab_mode_percentiles_of_float_scans_within_rank_error(float_dataset, feature_config, slab_size):
+    path_images = str(float_dataset / "images")
+    expected = extract_subject_features("SUBJ_000", path_images, feature_config)
+    actual = extract_subject_features("SUBJ_000", path_images, {**feature_config, "slab_size": slab_size})
+
+    # everything but the percentiles is exact, up to the float32 rounding of the in-memory moments
+    percentiles = {"median_intensity": 50, "10_perc_intensity": 10, "90_perc_intensity": 90}
+    assert_features_equal(expected, actual, skip=tuple(percentiles), rtol=1e-5, atol=1e-5)
+
+    # the percentiles are estimated by a quantile sketch, whose rank error stays below 3 / sketch_size
+    bound = 3 / feature_config["sketch_size"]
+    for seq, features in actual["stats_features"].items():
+        volume = load_nii_with_metadata(f"{path_images}/SUBJ_000/SUBJ_000_{seq}.nii.gz")[0]
+        values = np.sort(volume[volume > 0])
+        for name, q in percentiles.items():
+            lower = np.searchsorted(values, features[name], side="left") / values.size
+            upper = np.searchsorted(values, features[name], side="right") / values.size
+            assert lower - bound <= q / 100 <= upper + bound, (seq, name)
+
+
+@pytest.mark.parametrize("slab_size", SLAB_SIZES)
+def test_confusion_matrix_by_slabs_matches_in_memory(integer_dataset, slab_size):
+    ground_truth = str(integer_dataset / "images" / "SUBJ_000" / "SUBJ_000_seg.nii.gz")
+    predicted = str(integer_dataset / "predictions" / "SUBJ_000" / "SUBJ_000_pred.nii.gz")
+    labels = list(LABELS.values())
+
+    matrix = confusion_matrix_by_slabs(ground_truth, predicted, labels, slab_size)
+    expected = mistakes_per_class_optim(
+        load_nii_with_metadata(ground_truth)[0], load_nii_with_metadata(predicted)[0], labels
+    )
+
+    assert matrix.sum() == np.prod(SHAPE)
+    np.fill_diagonal(matrix, 0)
+    np.testing.assert_array_equal(matrix, expected)
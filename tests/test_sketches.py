@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from src.features.sketches import FixedWidthHistogram
+from src.features.sketches import QuantileSketch
+
+PERCENTILES = np.arange(1, 100)
+
+
+def rank_errors(sketch: QuantileSketch, values: np.ndarray) -> np.ndarray:
+    """Distance between the requested ranks and the range of ranks of each estimated percentile."""
+    sorted_values = np.sort(values)
+    estimates = sketch.get_percentiles(PERCENTILES)
+    lower = np.searchsorted(sorted_values, estimates, side="left") / values.size
+    upper = np.searchsorted(sorted_values, estimates, side="right") / values.size
+    target = PERCENTILES / 100
+
+    return np.maximum(0, np.maximum(lower - target, target - upper))
+
+
+def total_weight(sketch: QuantileSketch) -> int:
+    return sum(items.size * 2 ** level for level, items in enumerate(sketch.levels))
+
+
+@pytest.fixture
+def values():
+    return np.random.default_rng(0).lognormal(5, 1, size=200_000)
+
+
+@pytest.mark.parametrize("k", [100, 400])
+def test_sketch_rank_error_within_bound(values, k):
+    sketch = QuantileSketch(k)
+    for chunk in np.array_split(values, 37):
+        sketch.update(chunk)
+
+    assert total_weight(sketch) == sketch.n == values.size
+    assert rank_errors(sketch, values).max() <= 3 / k
+
+
+def test_merged_sketches_within_bound(values):
+    k = 200
+    merged = QuantileSketch(k)
+    for chunk in np.array_split(values, 16):
+        merged.merge(QuantileSketch(k).update(chunk))
+
+    assert total_weight(merged) == merged.n == values.size
+    assert rank_errors(merged, values).max() <= 3 / k
+
+
+def test_sketch_update_counts_preserves_the_weight():
+    rng = np.random.default_rng(0)
+    distinct = np.arange(1000, dtype=np.float64)
+    counts = rng.integers(1, 500, size=distinct.size)
+    sketch = QuantileSketch(200).update_counts(distinct, counts)
+
+    assert total_weight(sketch) == sketch.n == counts.sum()
+    assert rank_errors(sketch, np.repeat(distinct, counts)).max() <= 3 / 200
+
+
+def test_sketch_is_deterministic_and_round_trips(values):
+    first, second = QuantileSketch(100).update(values), QuantileSketch(100).update(values)
+    restored = QuantileSketch.from_dict(first.to_dict())
+
+    np.testing.assert_array_equal(first.get_percentiles(PERCENTILES), second.get_percentiles(PERCENTILES))
+    np.testing.assert_array_equal(first.get_percentiles(PERCENTILES), restored.get_percentiles(PERCENTILES))
+
+
+def test_empty_sketch_returns_nan():
+    assert np.isnan(QuantileSketch().get_percentiles([50])).all()
+
+
+def test_histogram_merge_adds_counts(values):
+    halves = np.array_split(values, 2)
+    merged = FixedWidthHistogram(10).update(halves[0]).merge(FixedWidthHistogram(10).update(halves[1]))
+    expected_bins, expected_counts = np.unique(np.floor(values / 10).astype(np.int64), return_counts=True)
+
+    np.testing.assert_array_equal(merged.bins, expected_bins)
+    np.testing.assert_array_equal(merged.counts, expected_counts)
+    np.testing.assert_array_equal(merged.edges, expected_bins * 10.0)
+
+
+def test_histogram_merge_requires_the_same_bin_width():
+    with pytest.raises(ValueError):
+        FixedWidthHistogram(10).merge(FixedWidthHistogram(5))
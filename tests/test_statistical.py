@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+from scipy import stats
+
+from src.features.statistical import StatisticalFeatures
+from src.features.statistical import StatisticsAccumulator
+
+
+def reference_statistics(values: np.ndarray) -> dict:
+    """The statistical features computed directly with numpy and scipy, in float64."""
+    values = values.astype(np.float64)
+    return {
+        "max_intensity": values.max(),
+        "min_intensity": values.min(),
+        "mean_intensity": values.mean(),
+        "median_intensity": np.median(values),
+        "10_perc_intensity": np.percentile(values, 10),
+        "90_perc_intensity": np.percentile(values, 90),
+        "std_intensity": values.std(),
+        "range_intensity": values.max() - values.min(),
+        "skewness": stats.skew(values),
+        "kurtosis": stats.kurtosis(values),
+    }
+
+
+def split(values: np.ndarray, n_chunks: int, rng) -> list:
+    """Splits the values in chunks of random sizes (some of them empty)."""
+    return np.split(values, np.sort(rng.integers(0, values.size, size=n_chunks - 1)))
+
+
+@pytest.fixture
+def integer_values():
+    return np.round(np.random.default_rng(0).normal(600, 150, size=50_000)).clip(0).astype(np.int16)
+
+
+@pytest.fixture
+def float_values():
+    return np.random.default_rng(0).lognormal(5, 1, size=50_000)
+
+
+@pytest.mark.parametrize("values", ["integer_values", "float_values"])
+def test_statistical_features_match_reference(request, values):
+    values = request.getfixturevalue(values)
+    features = StatisticalFeatures(values.copy(), overwrite_input=True).extract_features()
+
+    for name, expected in reference_statistics(values).items():
+        np.testing.assert_allclose(features[name], expected, rtol=1e-9, err_msg=name)
+
+
+def test_statistical_features_keep_the_input_unchanged(float_values):
+    values = float_values.copy()
+    StatisticalFeatures(values).extract_features()
+
+    np.testing.assert_array_equal(values, float_values)
+
+
+@pytest.mark.parametrize("n_chunks", [1, 2, 17])
+def test_accumulator_matches_in_memory_for_integers(integer_values, n_chunks):
+    rng = np.random.default_rng(n_chunks)
+    accumulator = StatisticsAccumulator()
+    for chunk in split(integer_values, n_chunks, rng):
+        accumulator.update(chunk)
+
+    features = accumulator.extract_features()
+    for name, expected in StatisticalFeatures(integer_values).extract_features().items():
+        np.testing.assert_allclose(features[name], expected, rtol=1e-9, err_msg=name)
+
+
+def test_accumulator_merge_order_does_not_matter(integer_values):
+    rng = np.random.default_rng(0)
+    parts = [StatisticsAccumulator().update(chunk) for chunk in split(integer_values, 8, rng)]
+
+    forward, backward = StatisticsAccumulator(), StatisticsAccumulator()
+    for part in parts:
+        forward.merge(part)
+    for part in reversed(parts):
+        backward.merge(part)
+
+    for name, expected in forward.extract_features().items():
+        np.testing.assert_allclose(backward.extract_features()[name], expected, rtol=1e-9, err_msg=name)
+
+
+def test_accumulator_switches_to_a_sketch_past_max_distinct(float_values):
+    sketch_size = 200
+    values = np.round(float_values)
+    accumulator = StatisticsAccumulator(max_distinct=100, sketch_size=sketch_size)
+    for chunk in np.array_split(values.astype(np.int64), 20):
+        accumulator.update(chunk)
+
+    assert accumulator.values is None and accumulator.quantiles is not None
+    assert accumulator.quantiles.n == accumulator.n == values.size
+
+    # the moments are still exact, and the percentiles are estimated within the rank error of the sketch
+    features, expected = accumulator.extract_features(), reference_statistics(values)
+    for name in ("max_intensity", "min_intensity", "mean_intensity", "std_intensity", "skewness", "kurtosis"):
+        np.testing.assert_allclose(features[name], expected[name], rtol=1e-9, err_msg=name)
+
+    sorted_values = np.sort(values)
+    for name, q in {"median_intensity": 50, "10_perc_intensity": 10, "90_perc_intensity": 90}.items():
+        lower = np.searchsorted(sorted_values, features[name], side="left") / values.size
+        upper = np.searchsorted(sorted_values, features[name], side="right") / values.size
+        assert lower - 3 / sketch_size <= q / 100 <= upper + 3 / sketch_size, name
+
+
+@pytest.mark.parametrize("values", ["integer_values", "float_values"])
+def test_accumulator_round_trip(request, values):
+    accumulator = StatisticsAccumulator().update(request.getfixturevalue(values))
+    restored = StatisticsAccumulator.from_dict(accumulator.to_dict())
+
+    for name, expected in accumulator.extract_features().items():
+        np.testing.assert_allclose(restored.extract_features()[name], expected, rtol=1e-12, err_msg=name)
+
+
+def test_empty_accumulator_cannot_extract_features():
+    with pytest.raises(ValueError):
+        StatisticsAccumulator().update(np.empty(0)).extract_features()
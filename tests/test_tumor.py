@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from src.features.tumor import LabelMarginalsAccumulator
+from src.features.tumor import compute_label_marginals
+
+
+def reference_marginals(segmentation: np.ndarray) -> dict:
+    """The per-axis counts of each non-background label, one label at a time."""
+    return {
+        label: [np.sum(segmentation == label, axis=axes) for axes in ((1, 2), (0, 2), (0, 1))]
+        for label in np.unique(segmentation) if label != 0
+    }
+
+
+def assert_marginals_equal(actual: dict, expected: dict):
+    assert list(actual) == list(expected)
+    for label in expected:
+        for axis in range(3):
+            np.testing.assert_array_equal(actual[label][axis], expected[label][axis])
+
+
+def make_segmentation(dtype, labels=(0, 1, 2, 4)):
+    rng = np.random.default_rng(0)
+    segmentation = np.zeros((20, 24, 18), dtype=dtype)
+    segmentation[4:15, 6:20, 3:12] = rng.choice(labels, size=(11, 14, 9))
+
+    return segmentation
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.int16, np.int32, np.float32])
+@pytest.mark.parametrize("chunk_voxels", [1, 300, 2 ** 20])
+def test_label_marginals_match_reference(dtype, chunk_voxels):
+    segmentation = make_segmentation(dtype)
+
+    assert_marginals_equal(compute_label_marginals(segmentation, chunk_voxels=chunk_voxels),
+                           reference_marginals(segmentation))
+
+
+def test_label_marginals_with_negative_labels():
+    segmentation = make_segmentation(np.int16, labels=(0, -1, 3, 7))
+
+    assert_marginals_equal(compute_label_marginals(segmentation), reference_marginals(segmentation))
+
+
+def test_label_marginals_of_empty_segmentation():
+    assert compute_label_marginals(np.zeros((4, 5, 6), dtype=np.uint8)) == {}
+
+
+@pytest.mark.parametrize("slab_size", [1, 3, 7, 25])
+def test_marginals_accumulator_matches_whole_volume(slab_size):
+    segmentation = make_segmentation(np.uint8)
+
+    # the slabs are split between two accumulators and merged afterwards
+    even, odd = LabelMarginalsAccumulator(segmentation.shape), LabelMarginalsAccumulator(segmentation.shape)
+    for n, start in enumerate(range(0, segmentation.shape[0], slab_size)):
+        (even if n % 2 == 0 else odd).update(segmentation[start:start + slab_size], start)
+
+    assert_marginals_equal(odd.merge(even).marginals, reference_marginals(segmentation))